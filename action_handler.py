@@ -1,12 +1,17 @@
 """Methods for handling user interaction"""
-import json
-import requests
 import settings
+import delivery
+import metrics
+import tracing
 import sessions
 import traceback
+import upstream
 import app
-from ibm_watson import ApiException
-from classes import EventType
+import cache
+import capture
+import codec
+import logs
+from classes import EventType, InvalidSessionError, SlackEvent
 
 LOGGER = settings.get_logger("action_handler")
 
@@ -25,13 +30,40 @@ def handle_action(form_json):
 
         # print("selection was " + action + " response url is " + url)
 
-        new_blocks = send_message(url, form_json["message"]["blocks"], "> _You replied: " + message_info[0] + "_")
+        channel = form_json["channel"]["id"]
+        new_blocks = send_message(url, form_json["message"]["blocks"], "> _You replied: " + message_info[0] + "_", channel)
 
-        call_WA(url, new_blocks, form_json, text=message_info[0], time_stamp=message_info[1], event_type=message_info[2])
+        # fetch the session and user profile together and hold back writes until the turn is done
+        user_id = form_json["user"]["id"]
+        with tracing.trace(form_json.get("trigger_id"), "handle_action", user=user_id, button=message_info[0]), \
+                capture.turn(form_json.get("trigger_id")), cache.batch(), upstream.deadline(upstream.get_turn_deadline()):
+            cache.get_many([(sessions.SESSIONS, user_id), (cache.user_cache, user_id)])
+            call_WA(url, new_blocks, form_json, text=message_info[0], time_stamp=message_info[1], event_type=message_info[2])
+
+    except upstream.UpstreamUnavailableError:
+        LOGGER.warning(traceback.format_exc())
+        metrics.count_error(EventType.UNHANDLED, "upstream")
+        send_message(url, form_json["message"]["blocks"], "> _" + settings.UPSTREAM_DEGRADED_MESSAGE + "_",
+                     form_json["channel"]["id"])
 
     except Exception:
         LOGGER.error(traceback.format_exc())
-        send_message(url, form_json["message"]["blocks"], "> _Sorry, something went wrong handling action._")
+        metrics.count_error(EventType.UNHANDLED, "handle_action")
+        send_message(url, form_json["message"]["blocks"], "> _Sorry, something went wrong handling action._",
+                     form_json["channel"]["id"])
+
+
+def get_lane(form_json):
+    """Returns the dispatcher lane for a button click and the key a double click of the same button coalesces on"""
+
+    action = form_json["actions"][0]
+    value = action.get("value", "")
+    time_stamp = value.split(":")[1] if value.count(":") >= 2 else None
+
+    lane = app.get_lane(form_json["user"]["id"], time_stamp)
+    coalesce_key = ("action", value) if settings.WORKER_COALESCE else None
+
+    return lane, coalesce_key
 
 
 def call_WA(url, blocks, form_json, text, time_stamp, event_type):
@@ -39,56 +71,61 @@ def call_WA(url, blocks, form_json, text, time_stamp, event_type):
 
     user_id = form_json["user"]["id"]
 
-    session = sessions.get_wa_session(user_id, app.WA, False)
-
-    user_context = app.get_user_context(user_id)
-
-    context = {
-        'global': {
-            'system': {
-                'timezone': user_context["timezone"],
-            }
-        },
-        'skills': {
-            'main skill': {
-                'user_defined': {
-                    'userContext': user_context
-                }
-            }
-        },
-        'metadata': {
-            'deployment': 'slackbot'
-        }
-    }
+    session = sessions.get_wa_session(user_id, app.get_watson_assistant(), False)
 
-    # this simulates a slack_event that slack would create
-    class Object(object):
-        pass
+    context = app.get_assistant_context(app.get_user_context(user_id))
 
-    slack_event = Object()
-    slack_event.channel = form_json["channel"]["id"]
-    if event_type == "EventType.APP_MENTION":
-        slack_event.event_type = EventType.APP_MENTION
-    else:
-        slack_event.event_type = EventType.MESSAGE
-    slack_event.user = user_id
-    slack_event.time_stamp = time_stamp
+    slack_event = get_action_event(form_json, time_stamp, event_type)
+
+    # the button's text is the user's turn, so it can be replayed if the session was lost
+    sessions.add_to_session_conversation(user_id, text)
 
     try:
         app.call_assistant(text, context, slack_event, session)
 
-    except ApiException:
-        app.force_create_new_session(slack_event.user)
-        send_message(url, blocks,
-                     "Sorry, I've lost the context of what we were talking about.  Please start from the beginning.")
+    except InvalidSessionError:
+        app.recover_session(slack_event, lambda message: send_message(url, blocks, message, slack_event.channel))
+
+    except upstream.UpstreamUnavailableError:
+        LOGGER.warning(traceback.format_exc())
+        metrics.count_error(slack_event.event_type, "upstream")
+        send_message(url, blocks, "> _" + settings.UPSTREAM_DEGRADED_MESSAGE + "_", slack_event.channel)
 
     except Exception:
         LOGGER.error(traceback.format_exc())
-        send_message(url, blocks, "> _Sorry, something went wrong calling WA._")
+        metrics.count_error(slack_event.event_type, "call_assistant")
+        send_message(url, blocks, "> _Sorry, something went wrong calling WA._", slack_event.channel)
+
 
+def get_action_event(form_json, time_stamp, event_type):
+    """returns the SlackEvent of the message the button was on"""
+
+    if event_type == "EventType.APP_MENTION":
+        button_event_type = EventType.APP_MENTION
+    else:
+        button_event_type = EventType.MESSAGE
 
-def send_message(url, blocks, message):
-    """Send reply back to slack so user sees what was sent in response to button"""
+    return SlackEvent(button_event_type, time_stamp, channel=form_json["channel"]["id"], user=form_json["user"]["id"])
+
+
+def send_message(url, blocks, message, channel=None):
+    """Send reply back to slack so user sees what was sent in response to button, queued behind the channel's
+    other messages so it arrives before the answer"""
+
+    new_blocks, payload = get_reply(blocks, message)
+
+    delivery.send(url, payload, REPLY_HEADERS, channel or url, "response_url", delivery.PRIORITY_DIRECT)
+
+    return new_blocks
+
+
+REPLY_HEADERS = {
+    'Content-Type': 'application/json'
+}
+
+
+def get_reply(blocks, message):
+    """returns the message's blocks without buttons and images plus the reply, and the response_url payload for them"""
 
     new_blocks = []
     for block in blocks:
@@ -103,19 +140,8 @@ def send_message(url, blocks, message):
         }
     })
 
-    payload = {
-        "blocks": new_blocks
-    }
-
-    payload = json.dumps(payload)
-    LOGGER.debug("Slack Message Post Payload: " + str(payload))
+    payload = codec.dumps({"blocks": new_blocks})
+    LOGGER.debug("Slack Message Post Payload: %s", logs.Lazy(bytes.decode, payload))
 
-    headers = {
-        'Content-Type': 'application/json'
-    }
-
-    response = requests.request("POST", url, data=payload, headers=headers)
-    LOGGER.debug("Slack Response: " + response.text)
-
-    return new_blocks
+    return new_blocks, payload
 
@@ -2,20 +2,41 @@
 Flask wrapped main python application, includes code initialization of the app and for various endpoints
 """
 
+import concurrent.futures
+import contextvars
 import json
+import os
+import time
 import warnings
-import requests
-import sys
-from ibm_watson import AssistantV2, ApiException
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-from flask import Flask, request, Response
-
-import cache
-from classes import EventType, SlackEvent
-import settings
-import sessions
-import action_handler
-import traceback
+import threading
+
+import startup
+
+with startup.timed("flask"):
+    from flask import Flask, request, Response
+
+with startup.timed("settings"):
+    import settings
+
+with startup.timed("modules"):
+    import cache
+    import capture
+    import codec
+    import logs
+    from classes import EventType, SlackEvent, ASSISTANT, InvalidSessionError
+    import http_client
+    import sessions
+    import action_handler
+    import dispatcher
+    import dedup
+    import delivery
+    import metrics
+    import profiles
+    import tracing
+    import upstream
+    import session_pool
+    import socket_mode
+    import traceback
 
 # Configure Logger
 LOGGER = settings.get_logger("main")
@@ -23,20 +44,55 @@ LOGGER = settings.get_logger("main")
 # Initialize flask
 APP = Flask(__name__)
 
-BOT_ID = settings.BOT_ID
+# Watson Assistant client, only created when talking to WA directly, see get_watson_assistant
+WA = None
+WA_LOCK = threading.Lock()
 
-WA = {}
-if not settings.CALL_PROXY:
-    authenticator = IAMAuthenticator(settings.WA_IAM_KEY)
-    WA = AssistantV2(
-        version=settings.WA_VERSION,
-        authenticator=authenticator
-    )
 
-    if settings.WA_OPT_OUT:
-        WA.set_default_headers({'x-watson-learning-opt-out': "true"})
+def get_watson_assistant():
+    """Returns the Watson Assistant client, importing the SDK and creating it on first use, None when using the proxy"""
 
-THREADS = {}
+    global WA
+
+    if settings.CALL_PROXY:
+        return None
+
+    if WA is None:
+        with WA_LOCK:
+            if WA is None:
+                with startup.timed("watson sdk"):
+                    from ibm_watson import AssistantV2
+                    from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+
+                    if settings.WA_IAM_URL:
+                        authenticator = IAMAuthenticator(settings.WA_IAM_KEY, url=settings.WA_IAM_URL)
+                    else:
+                        authenticator = IAMAuthenticator(settings.WA_IAM_KEY)
+                    assistant = AssistantV2(
+                        version=settings.WA_VERSION,
+                        authenticator=authenticator
+                    )
+
+                    if settings.WA_URL:
+                        assistant.set_service_url(settings.WA_URL)
+
+                    if settings.WA_OPT_OUT:
+                        assistant.set_default_headers({'x-watson-learning-opt-out': "true"})
+
+                    # the longest a call may take, calls stop waiting sooner near the turn's deadline, see
+                    # upstream.call_blocking
+                    assistant.set_http_config({'timeout': settings.UPSTREAM_TIMEOUTS['watson']})
+
+                WA = assistant
+
+    return WA
+
+
+# Slack users talking to the bot keyed by thread time stamp
+THREADS = cache.thread_cache
+
+# Set while a lost session is being recovered on this thread, so a replay that loses it again doesn't recover again
+RECOVERING = threading.local()
 
 def check_auth(headers):
     """Ensures API key is in header when required"""
@@ -45,21 +101,56 @@ def check_auth(headers):
     return auth == settings.API_KEY
 
 
+def start_new_session(user):
+    """gives the user a pooled session when one is ready, otherwise creates a new WA session"""
+    pooled_session = session_pool.take()
+    if pooled_session is not None:
+        return sessions.assign_session_to_user(user, pooled_session)
+    return sessions.new_session_for_user(user, get_watson_assistant())
+
+
 def force_create_new_session(user):
     """creates new WA session for user and initializes it with 'hi'"""
-    new_session = sessions.new_session_for_user(user, WA)
+
+    # pooled sessions were already greeted
+    pooled_session = session_pool.take()
+    if pooled_session is not None:
+        return sessions.assign_session_to_user(user, pooled_session)
+
+    new_session = sessions.new_session_for_user(user, get_watson_assistant())
 
     user_context = get_user_context(user)
 
     try:
         if settings.CALL_PROXY:
             call_proxy("hi", user_context, user, new_session)
-            new_session = sessions.get_wa_session(user, WA, False)
+            new_session = sessions.get_wa_session(user, get_watson_assistant(), False)
         else:
             call_watson_assistant("hi", user_context, new_session)
-    except Exception as ex:
+    except Exception:
         LOGGER.error(traceback.format_exc())
-        LOGGER.error("Handle message method failed with status code " + str(ex.code) + ": " + ex.message)
+        LOGGER.error("Greeting the new session failed")
+
+    return new_session
+
+
+# Sent with the greeting of a pooled session, encoded once
+GREETING_CONTEXT = codec.Encoded({
+    'metadata': {
+        'deployment': 'slackbot'
+    }
+}, codec.Template('{"metadata":{"deployment":"slackbot"}}'))
+
+
+def create_greeted_session():
+    """creates a WA session not yet tied to a user and initializes it with 'hi', used to fill the session pool"""
+
+    new_session = sessions.create_wa_session(get_watson_assistant())
+
+    if settings.CALL_PROXY:
+        call_proxy("hi", GREETING_CONTEXT, None, new_session)
+    else:
+        call_watson_assistant("hi", GREETING_CONTEXT, new_session)
 
     return new_session
 
@@ -116,10 +207,92 @@ def get_image_block(image_response):
     }
 
 
+# The context sent to the skill, its skeleton is encoded once and only the timezone and user_defined every time
+CONTEXT_TEMPLATE = codec.Template('{"global":{"system":{"timezone":%s}},"skills":{"main skill":{"user_defined":%s}},'
+                                  '"metadata":{"deployment":"slackbot"}}')
+
+
+def get_context(timezone, user_defined):
+    """returns the context sent to the skill, pre-encoded for the proxy"""
+
+    return codec.Encoded({
+        'global': {
+            'system': {
+                'timezone': timezone,
+            }
+        },
+        'skills': {
+            'main skill': {
+                'user_defined': user_defined
+            }
+        },
+        'metadata': {
+            'deployment': 'slackbot'
+        }
+    }, CONTEXT_TEMPLATE, timezone, user_defined)
+
+
+def get_assistant_context(user_context):
+    """returns the context sent to the skill with a user's message"""
+
+    return get_context(user_context["timezone"], {'userContext': user_context})
+
+
 def post_to_slack(slack_event, response):
-    """Posts messages to slack as the bot on the specified channel"""
+    """Posts messages to slack as the bot on the specified channel, through the delivery queue so slack's rate
+    limits are kept, returns False if the queue was full"""
+
+    payload = get_slack_post_payload(slack_event, response)
+
+    return delivery.send(SLACK_POST_URL, payload, get_slack_post_headers(), slack_event.channel, "chat.postMessage",
+                         delivery.get_priority(slack_event.channel))
+
+
+SLACK_POST_URL = settings.SLACK_API_URL + "/chat.postMessage"
+
+# Posts running next to the rest of the turn, only used when the delivery queue is off, see post_concurrently
+POSTS = None
+POSTS_PID = None
+POSTS_LOCK = threading.Lock()
+
+
+def post_concurrently(slack_event, response):
+    """Starts post_to_slack without waiting for it, returns a Future of its result. With the delivery queue on
+    posting only queues the message, so it is done right away"""
+
+    global POSTS, POSTS_PID
+
+    if settings.DELIVERY_ENABLED:
+        posted = concurrent.futures.Future()
+        posted.set_result(post_to_slack(slack_event, response))
+        return posted
 
-    url = "https://slack.com/api/chat.postMessage"
+    with POSTS_LOCK:
+        # threads don't survive a fork, a worker starts its own
+        if POSTS_PID != os.getpid():
+            POSTS = concurrent.futures.ThreadPoolExecutor(settings.WORKER_POOL_SIZE, thread_name_prefix="post")
+            POSTS_PID = os.getpid()
+
+    # keeps the turn's trace and deadline
+    return POSTS.submit(contextvars.copy_context().run, post_to_slack, slack_event, response)
+
+
+def get_slack_post_headers():
+    """returns the headers of a chat.postMessage call"""
+
+    return {
+        'Authorization': 'Bearer ' + settings.SLACK_BOT_USER_TOKEN,
+        'Content-Type': 'application/json'
+    }
+
+
+# The chat.postMessage payload, in a thread or not
+SLACK_POST_TEMPLATE = codec.Template('{"channel":%s,"as_user":true,"username":%s,"blocks":%s}')
+SLACK_THREAD_POST_TEMPLATE = codec.Template('{"channel":%s,"as_user":true,"username":%s,"blocks":%s,"thread_ts":%s}')
+
+
+def get_slack_post_payload(slack_event, response):
+    """returns the chat.postMessage payload for a skill response or text, and remembers who is talking in the thread"""
 
     # Create blocks for slack responses
     blocks = []
@@ -137,198 +310,188 @@ def post_to_slack(slack_event, response):
             if generic["response_type"] == "image":
                 blocks.append(get_image_block(generic))
 
-    # Create the slack POST data payload
-    payload = {
-        "channel": str(slack_event.channel),
-        # "text": text,
-        "as_user": True,
-        "username": settings.BOT_NAME,
-        "blocks": blocks
-    }
-
     # determine if the message is from public channel (!= APP_MENTION)
     # set thread_ts to create a thread when talking in a public channel
-    LOGGER.debug("event type is " + str(slack_event.event_type))
+    LOGGER.debug("event type is %s", slack_event.event_type)
     if slack_event.event_type != EventType.APP_MENTION:
-        LOGGER.debug("setting thread_ts as " + slack_event.time_stamp)
-        payload["thread_ts"] = slack_event.time_stamp
-        # if already talking capture the user in an array keyed off the time stamp
-        # to handle the case where multiple people talking to assistant in the same thread
-        if slack_event.time_stamp in THREADS:
-            users = THREADS[slack_event.time_stamp]
-            users.append(slack_event.user)
-            THREADS[slack_event.time_stamp] = users
-        else:
-            THREADS[slack_event.time_stamp] = [slack_event.user]
-
-    payload = json.dumps(payload)
-
-    LOGGER.debug("Slack Message Post Payload: " + str(payload))
-
-    headers = {
-        'Authorization': 'Bearer ' + settings.SLACK_BOT_USER_TOKEN,
-        'Content-Type': 'application/json'
-    }
-
-    response = requests.request("POST", url, data=payload, headers=headers)
+        LOGGER.debug("setting thread_ts as %s", slack_event.time_stamp)
+        # capture the user in a set keyed off the time stamp to handle the case where multiple people
+        # talking to assistant in the same thread, replying keeps the thread from timing out
+        THREADS.add_member(slack_event.time_stamp, slack_event.user)
+        payload = SLACK_THREAD_POST_TEMPLATE.render(str(slack_event.channel), settings.BOT_NAME, blocks,
+                                                    slack_event.time_stamp)
+    else:
+        payload = SLACK_POST_TEMPLATE.render(str(slack_event.channel), settings.BOT_NAME, blocks)
 
-    LOGGER.debug("Slack Response: " + response.text)
+    LOGGER.debug("Slack Message Post Payload: %s", logs.Lazy(bytes.decode, payload))
 
-    return response.text
+    return payload
 
 
 def get_user_context(slack_user):
     """Returns dictionary to be used as the userContext passed to the skill"""
-    """Checks cache of user names first before calling Slack for it"""
-
-    if slack_user not in cache.user_cache:
-
-        user_profile = get_slack_user_profile(slack_user)
-
-        first_name = user_profile["name"].split(" ")[0]
-        last_name = user_profile["name"].split(" ")[1]
-
-        user_context = {}
-        user_context["name"] = {}
-        user_context["name"]["first"] = first_name
-        user_context["name"]["last"] = last_name
-        user_context["email"] = user_profile["email"]
-        user_context["timezone"] = user_profile["timezone"]
-
-        cache.user_cache[slack_user] = user_context
+    """Checks cache of user profiles first before calling Slack for it"""
 
-    return cache.user_cache[slack_user]
+    return profiles.get_user_context(slack_user)
 
 
-def get_slack_user_profile(slack_user):
-    """Returns a dictionary with the real name and email for the slack user after getting info from slack API"""
+def get_lane(user, time_stamp):
+    """Returns the dispatcher lane for a turn, turns in the same lane are handled one at a time in order"""
 
-    url = "https://slack.com/api/users.info"
-    url += "?token=" + settings.SLACK_BOT_USER_TOKEN
-    url += "&user=" + slack_user
+    if settings.WORKER_LANE == 'THREAD':
+        return time_stamp
+    return user
 
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-
-    response = requests.request("GET", url, headers=headers)
-
-    response_json = response.json()
-
-    try:
-        user = {}
-        user["name"] = response_json["user"]["profile"]["real_name"]
-        user["email"] = response_json["user"]["profile"]["email"]
-        user["timezone"] = response_json["user"]["tz"]
-        return user
-    except:
-        LOGGER.error(response.text)
-        return {}
-
-
-def cache_event(event_id):
-    """Caches event_id from events responded to"""
 
-    LOGGER.debug("Caching: " + str(event_id))
+def get_coalesce_key(slack_event):
+    """Returns the key a repeat of the same message waiting in its lane is coalesced on, its event_id. Two messages
+    with the same text are two turns, only a second delivery of one event, ex: a retry let through while the shared
+    store is down, is dropped"""
 
-    # LOGGER.debug('Message Cache: \n    ' + str(cache.event_cache))
-
-    # Pop the oldest item in the cache to make room if needed
-    if len(cache.event_cache) >= settings.MAX_EVENT_CACHE:
-        cache.event_cache.popitem(last=False)
-
-    # If the event is already cached, skip it
-    if event_id not in cache.event_cache:
-        cache.event_cache[event_id] = event_id
-        return True
-
-    return False
+    if not settings.WORKER_COALESCE:
+        return None
+    return "message", slack_event.event_id
 
 
 def clean_message(message_text):
     """Cleans up message text from slack, pulls out @bot in text and returns boolean indicating if bot id was found"""
 
-    found_bot = False
-
     if message_text is None:
         return None
 
-    new_text = message_text
-
-    if ' ' + settings.AT_BOT in message_text:
-        new_text = message_text.replace(' ' + settings.AT_BOT, '')
-        found_bot = True
-    elif settings.AT_BOT + ' ' in message_text:
-        new_text = message_text.replace(settings.AT_BOT + ' ', '')
-        found_bot = True
-    elif settings.AT_BOT in message_text:
-        new_text = message_text.replace(settings.AT_BOT, '')
-        found_bot = True
+    # only text mentioning someone can mention the bot
+    if '<@' not in message_text:
+        return message_text, False
 
-    # LOGGER.debug("new text is " + new_text)
+    new_text, found = settings.get_at_bot_pattern().subn('', message_text)
 
-    return new_text, found_bot
+    return new_text, found > 0
 
 
 def handle_message(slack_event):
     """Takes necessary actions upon message events, ex: responding to slack users"""
 
     # Stop bot from responding to itself
-    if settings.BOT_ID == slack_event.user:
+    if settings.get_bot_id() == slack_event.user:
         return
 
+    # fetch the session and user profile together and hold back writes, so a turn costs one or two store round trips
+    with tracing.trace(slack_event.event_id, "handle_message", user=slack_event.user,
+                       event_type=metrics.get_event_type(slack_event.event_type)), \
+            capture.turn(slack_event.event_id), cache.batch(), upstream.deadline(upstream.get_turn_deadline()):
+        try:
+            cache.get_many([(sessions.SESSIONS, slack_event.user), (cache.user_cache, slack_event.user)])
+            respond_to_message(slack_event)
+        except upstream.UpstreamUnavailableError:
+            # answer quickly while the assistant or the shared store is down instead of leaving the user waiting
+            LOGGER.warning(traceback.format_exc())
+            metrics.count_error(slack_event.event_type, "upstream")
+            post_to_slack(slack_event, settings.UPSTREAM_DEGRADED_MESSAGE)
+
+
+def respond_to_message(slack_event):
+    """Gets or creates the user's session and sends their message to the assistant"""
+
     # if user says hi or hello, then create new session
     # if they didn't say that and they don't have a session, then create one, say hi to it and
     # then send message so they don't have to repeat what they said initially.
     # TODO: many ways to say hi use a function here to check all variations
     if slack_event.text.lower().strip(' ') == "hi" or slack_event.text.lower().strip(' ') == "hello":
         LOGGER.debug("found hi or hello, creating new session")
-        session = sessions.new_session_for_user(slack_event.user, WA)
+        session = start_new_session(slack_event.user)
     else:
-        session = sessions.get_wa_session(slack_event.user, WA, False)
+        session = sessions.get_wa_session(slack_event.user, get_watson_assistant(), False)
         if session is None or sessions.check_expired(session):
             LOGGER.debug(
                 "found command to bot and no session, creating session and sending hi, so user doesn't have to repeat")
+            if session is not None:
+                metrics.SESSIONS_EXPIRED.inc(event_type=metrics.get_event_type(slack_event.event_type))
+            old_session = session
             session = force_create_new_session(slack_event.user)
+            # a renewed session keeps the conversation history so it can still be replayed
+            session = sessions.keep_history(slack_event.user, old_session) or session
 
-    sessions.add_to_session_conversation(slack_event.user, slack_event.text, "")
-
-    user_context = get_user_context(slack_event.user)
+    sessions.add_to_session_conversation(slack_event.user, slack_event.text)
 
-    context = {
-        'global' : {
-            'system': {
-                'timezone': user_context["timezone"],
-            }
-        },
-        'skills': {
-            'main skill': {
-                'user_defined': {
-                    'userContext': user_context
-                }
-            }
-        },
-        'metadata': {
-            'deployment': 'slackbot'
-        }
-    }
+    context = get_assistant_context(get_user_context(slack_event.user))
 
     try:
         call_assistant(slack_event.text, context, slack_event, session)
-    except ApiException:
-        force_create_new_session(slack_event.user)
-        post_to_slack(slack_event, "Sorry, I have lost the context.  Please, let's restart our conversation.")
+    except InvalidSessionError:
+        recover_session(slack_event, lambda text: post_to_slack(slack_event, text))
+    except upstream.UpstreamUnavailableError:
+        raise
     except Exception:
         LOGGER.error(traceback.format_exc())
         LOGGER.error("exception in response from assistant")
+        metrics.count_error(slack_event.event_type, "call_assistant")
+
+
+def recover_session(slack_event, reply):
+    """replaces a session the assistant no longer knows and replays the user's last message on the new one,
+    reply(text) is used to tell the user when the conversation can't be recovered"""
+
+    lost_context = "Sorry, I have lost the context.  Please, let's restart our conversation."
+
+    old_session = sessions.get_wa_session(slack_event.user, get_watson_assistant(), False)
+    session = force_create_new_session(slack_event.user)
+
+    if not settings.RECOVER_SESSIONS or getattr(RECOVERING, "active", False):
+        reply(lost_context)
+        return
+
+    session = sessions.keep_history(slack_event.user, old_session) or session
+    text = session.last_user_text()
+    if text is None:
+        reply(lost_context)
+        return
+
+    LOGGER.debug("session was lost, replaying '%s' on %s", text, session)
+
+    context = get_assistant_context(get_user_context(slack_event.user))
+
+    RECOVERING.active = True
+    try:
+        call_assistant(text, context, slack_event, session)
+    except InvalidSessionError:
+        # the new session was lost too, don't keep trying
+        LOGGER.error(traceback.format_exc())
+        reply(lost_context)
+    finally:
+        RECOVERING.active = False
 
 
 def handle_skill_response(slack_event, session, response):
     """handles the response from WA"""
 
-    LOGGER.debug("\nWA Message Response:" + json.dumps(response, indent=2))
+    with tracing.span("handle_skill_response"):
+        record_skill_response(slack_event, response)
 
-    output = response["output"]
+        if not needs_fulfillment(response):
+            return post_to_slack(slack_event, response)
+
+        # the skill passed client fulfillment info, its message and the call to the webhook it provided don't depend
+        # on each other so they run together, the answer to the webhook's result waits for the message
+        posted = post_concurrently(slack_event, response)
+        try:
+            do_fulfillment(slack_event, session, response, posted)
+        except upstream.UpstreamUnavailableError:
+            LOGGER.warning(traceback.format_exc())
+            metrics.count_error(slack_event.event_type, "upstream")
+            concurrent.futures.wait([posted])
+            post_to_slack(slack_event, settings.UPSTREAM_DEGRADED_MESSAGE)
+        except Exception:
+            metrics.count_error(slack_event.event_type, "do_fulfillment")
+            concurrent.futures.wait([posted])
+            post_to_slack(slack_event, "Something went wrong. Please try your request again.")
+
+        return posted.result()
+
+
+def record_skill_response(slack_event, response):
+    """adds the skill's answer to the user's conversation history and keeps their session alive"""
+
+    LOGGER.debug("WA Message Response: %s", logs.Lazy(json.dumps, response))
 
     try:
         response_text = ""
@@ -336,7 +499,7 @@ def handle_skill_response(slack_event, session, response):
             if generic["response_type"] == "text":
                 response_text = response_text + generic["text"]
 
-        LOGGER.debug("response_text is " + response_text)
+        LOGGER.debug("response_text is %s", response_text)
 
     except IndexError:
         response_text = "{ NO TEXT RETURNED FROM WA }"
@@ -344,34 +507,74 @@ def handle_skill_response(slack_event, session, response):
     sessions.add_to_session_conversation(
         slack_event.user,
         response_text,
-        response)
+        response,
+        speaker=ASSISTANT)
 
     sessions.refresh_wa_session(slack_event.user)
 
-    response_text = transform_response_if_html(response_text)
-
     # ToDo: Do this safely in stages
-    LOGGER.debug("Response Text: " + response_text)
-    slack_output = post_to_slack(slack_event, response)
+    LOGGER.debug("Response Text: %s", logs.Lazy(transform_response_if_html, response_text))
+
+
+def needs_fulfillment(response):
+    """returns True when the skill passed client fulfillment info, so the webhook it provided has to be called"""
+
+    output = response["output"]
 
-    # if skill passed client fulfillment info, then make REST call to webhook provided
     try:
         if "actions" in output:
-            if output["actions"][0]["type"] == "client":
-                try:
-                    do_fulfillment(slack_event, session, response)
-                except Exception:
-                    post_to_slack(slack_event, "Something went wrong. Please try your request again.")
+            return output["actions"][0]["type"] == "client"
     except KeyError:
         LOGGER.warn(traceback.format_exc())
         # ok if didn't find actions[0].type
         LOGGER.debug("didn't find client action, so not calling webhook")
 
-    return slack_output
+    return False
+
 
+def do_fulfillment(slack_event, session, response, posted=None):
+    """make call to webhook to fulfill user request and provide the result back to the skill, once posted, the
+    Future of the skill's message from post_concurrently, is done"""
 
-def do_fulfillment(slack_event, session, response):
-    """make call to webhook to fulfill user request and provide the result back to the skill"""
+    webhook_url, payload = get_webhook_request(response)
+
+    try:
+        with metrics.timed("do_fulfillment"):
+            webhook_response = upstream.request("webhook", "POST", webhook_url, data=payload, headers=JSON_HEADERS)
+        webhook_response_json = codec.loads(webhook_response.content)
+    except upstream.UpstreamUnavailableError:
+        raise
+    except Exception as ex:
+        LOGGER.error(traceback.format_exc())
+        LOGGER.error("exception in response from webhook")
+        raise ex
+
+    context = get_fulfillment_context(slack_event.user, webhook_response_json)
+
+    if posted is not None:
+        posted.result()
+
+    try:
+        call_assistant("", context, slack_event, session)
+    except InvalidSessionError:
+        # replaying the user's request runs the fulfillment again on the new session
+        recover_session(slack_event, lambda text: post_to_slack(slack_event, text))
+    except upstream.UpstreamUnavailableError:
+        raise
+    except Exception as ex:
+        LOGGER.error(traceback.format_exc())
+        LOGGER.error("exception in response from assistant after fulfillment")
+        raise ex
+
+
+JSON_HEADERS = {
+    'cache-control': 'no-cache',
+    'Content-Type': 'application/json'
+}
+
+
+def get_webhook_request(response):
+    """returns the webhook url and payload for the client action the skill asked for"""
 
     LOGGER.debug("Calling webhook...")
     try:
@@ -392,39 +595,19 @@ def do_fulfillment(slack_event, session, response):
         LOGGER.error("unable to get parameters to send to webhook")
         raise ex
 
-    headers = {
-        'cache-control': 'no-cache',
-        'Content-Type': 'application/json'
-    }
-
     payload = {
         'cloudFunction': parameters
     }
 
-    try:
-        webhook_response = requests.request("POST", webhook_url, data=json.dumps(payload), headers=headers)
-        webhook_response_json = json.loads(webhook_response.content)
-    except Exception as ex:
-        LOGGER.error(traceback.format_exc())
-        LOGGER.error("exception in response from webhook")
-        raise ex
+    return webhook_url, codec.dumps(payload)
 
-    context = {
-        'global': {
-            'system': {
-                'timezone': cache.user_cache[slack_event.user]["timezone"],
-            }
-        },
-        'skills': {
-            'main skill': {
-                'user_defined': {
-                    'tririgaResult': webhook_response_json
-                }
-            }
-        },
-        'metadata': {
-            'deployment': 'slackbot'
-        }
+
+def get_fulfillment_context(slack_user, webhook_response_json):
+    """returns the context that passes the webhook's result back to the skill"""
+
+    timezone = get_user_context(slack_user)["timezone"]
+    user_defined = {
+        'tririgaResult': webhook_response_json
     }
 
     # update the user context in the user_cache with what is returned from cloud function as it might
@@ -432,86 +615,110 @@ def do_fulfillment(slack_event, session, response):
 
     if "userContext" in webhook_response_json:
         cache.user_cache["userContext"] = webhook_response_json["userContext"]
-        context["skills"]["main skill"]["user_defined"]["userContext"] = cache.user_cache[slack_event.user]
+        user_defined["userContext"] = get_user_context(slack_user)
 
-    try:
-        call_assistant("", context, slack_event, session)
-    except ApiException:
-        force_create_new_session(slack_event.user)
-        post_to_slack(slack_event, "Sorry, I have lost the context.  Please, let's restart our conversation.")
-    except Exception as ex:
-        LOGGER.error(traceback.format_exc())
-        LOGGER.error("Handle message method failed with status code " + str(ex.code) + ": " + ex.message)
-        raise ex
+    return get_context(timezone, user_defined)
 
 
 def call_assistant(message, context, slack_event, session):
     """Sends the user's message to proxy or directly to a Watson Assistant."""
 
-    if settings.CALL_PROXY:
-        skill_response = call_proxy(message, context, slack_event.user, session)
-    else:
-        skill_response = call_watson_assistant(message, context, session)
+    with tracing.span("call_assistant", fulfillment=message == ""):
+        if settings.CALL_PROXY:
+            skill_response = call_proxy(message, context, slack_event.user, session)
+        else:
+            skill_response = call_watson_assistant(message, context, session)
 
-    handle_skill_response(slack_event, session, skill_response)
+        handle_skill_response(slack_event, session, skill_response)
 
 
 def call_watson_assistant(message, context, session):
     """Sends the user's message directly to a Watson Assistant."""
 
-    skill_response = WA.message(
-        assistant_id=settings.WA_ASSISTANT_ID,
-        session_id=session[0],
-        input={'text': message, 'options': {'return_context': True}},
-        context=context
-    ).get_result()
+    from ibm_watson import ApiException
+
+    breaker = upstream.check("watson")
+    started = time.perf_counter()
+    try:
+        with metrics.timed("call_watson_assistant"):
+            # the SDK's timeout is set once on the client, this stops waiting at the turn's deadline
+            skill_response = upstream.call_blocking(
+                "watson",
+                get_watson_assistant().message,
+                assistant_id=settings.WA_ASSISTANT_ID,
+                session_id=session.session_id,
+                input={'text': message, 'options': {'return_context': True}},
+                context=context
+            ).get_result()
+    except ApiException as ex:
+        capture.call("watson", time.perf_counter() - started, ex.code, {"error": ex.message}, {"input": {"text": message}})
+        if ex.code is None or ex.code >= 500:
+            breaker.failure()
+            raise upstream.UpstreamUnavailableError("Watson Assistant failed: " + str(ex.message)) from ex
+        breaker.success()
+        raise InvalidSessionError(ex.message) from ex
+    except Exception as ex:
+        capture.call("watson", time.perf_counter() - started)
+        breaker.failure()
+        raise upstream.UpstreamUnavailableError("Watson Assistant could not be reached: " + str(ex)) from ex
 
+    capture.call("watson", time.perf_counter() - started, 200, skill_response, {"input": {"text": message}})
+    breaker.success()
     return skill_response
 
 
 def call_proxy(message, context, user, session):
     """Sends the user's message to proxy."""
 
-    proxy_url = settings.TA_PROXY
+    payload = get_proxy_payload(message, context, session)
 
-    headers = {
-        'cache-control': 'no-cache',
-        'Content-Type': 'application/json'
-    }
+    # the proxy may have handled the message before failing, so it isn't retried
+    with metrics.timed("call_proxy"):
+        proxy_response = upstream.request("proxy", "POST", settings.TA_PROXY, data=payload, headers=JSON_HEADERS)
+
+    return read_proxy_response(proxy_response.ok, parse_proxy_response(proxy_response.content), proxy_response.text,
+                               user, session)
+
+
+def parse_proxy_response(content):
+    """returns the proxy's JSON answer, or {} when it isn't JSON, ex: an error page"""
+
+    try:
+        return codec.loads(content)
+    except ValueError:
+        return {}
+
+
+PROXY_PAYLOAD_TEMPLATE = codec.Template('{"sessionId":%s,"integration_id":%s,"wa_payload":{"input":{"message_type":"text",'
+                                        '"text":%s,"options":{"return_context":true}},"context":%s}}')
 
-    payload = {
-        'sessionId': session[0],
-        'integration_id': settings.TA_INTEGRATION_ID,
-        'wa_payload': {
-            'input': {
-                'message_type': 'text',
-                'text': message,
-                'options': {
-                    'return_context': True
-                }
-            },
-            'context': context
-        }
-    }
 
-    proxy_response = requests.request("POST", proxy_url, data=json.dumps(payload), headers=headers)
-    proxy_response_json = json.loads(proxy_response.content)
+def get_proxy_payload(message, context, session):
+    """returns the proxy payload for a message"""
 
-    if not proxy_response.ok or "result" not in proxy_response_json:
+    return PROXY_PAYLOAD_TEMPLATE.render(session.session_id, settings.TA_INTEGRATION_ID, message, context)
+
+
+def read_proxy_response(ok, proxy_response_json, proxy_response_text, user, session):
+    """Checks the proxy's answer, updates the session id it returned and returns the skill response"""
+
+    if not ok or "result" not in proxy_response_json:
         if "message" in proxy_response_json and proxy_response_json["message"] == "Invalid Session":
-            raise ApiException("Invalid Session")
+            raise InvalidSessionError("Invalid Session")
         else:
             LOGGER.error("Check TA_PROXY in config/assistant.ini.  TRIRIGA Assistant Proxy unreachable, incorrect or not running.\n")
-            LOGGER.error("Call to TRIRIGA Assistant proxy failed with: " + proxy_response.text)
-            sys.exit(1)
-
+            # a proxy refusing every message, ex: with a 401 or 404, is as unavailable as one that doesn't answer
+            upstream.get_breaker("proxy").failure()
+            raise upstream.UpstreamUnavailableError("Call to TRIRIGA Assistant proxy failed with: " + proxy_response_text)
 
     if "cf_error_code" in proxy_response_json["result"]:
         LOGGER.error("Check the TA_INTEGRATION_ID in .env file and if correct contact IBM support team to validate ID exists in proxy.\n")
-        LOGGER.error("Error occurred when talking to proxy: " + proxy_response_json["result"]["cf_error_code"])
-        sys.exit(1)
+        raise upstream.UpstreamUnavailableError("Error occurred when talking to proxy: " + proxy_response_json["result"]["cf_error_code"])
 
-    sessions.replace_session_id_for_user(user, proxy_response_json["result"]["sessionId"])
+    session.session_id = proxy_response_json["result"]["sessionId"]
+    # pooled sessions aren't tied to a user yet
+    if user is not None:
+        sessions.replace_session_id_for_user(user, session.session_id)
 
     return proxy_response_json["result"]["result"]
 
@@ -592,10 +799,11 @@ def create_event(event_dict):
 
     # found message in thread and bot not mentioned, check THREADS cache to see if bot started or mentioned in thread
     elif "thread_ts" in event_dict and event_string == 'message':
-        if event_dict["thread_ts"] in THREADS:
+        in_thread = THREADS.has_member(event_dict["thread_ts"], user)
+        if in_thread is not None:
             event_type = get_message_event_enum(event_dict)
             # don't reply to others in thread that haven't mentioned bot first
-            if event_type == EventType.MESSAGE and user not in THREADS[event_dict["thread_ts"]]:
+            if event_type == EventType.MESSAGE and not in_thread:
                 event_type = EventType.UNHANDLED
             # don't reply if bot wasn't mentioned and someone else was
             if event_type == EventType.MESSAGE and '<@' in text and not bot_mentioned:
@@ -615,7 +823,7 @@ def create_event(event_dict):
 
     # ToDo: Move logic for handling repeat events here
 
-    LOGGER.debug("Timestamp: " + str(time_stamp))
+    LOGGER.debug("Timestamp: %s", time_stamp)
 
     # Create event object
     slack_event = SlackEvent(event_type, time_stamp, channel=channel, user=user, text=text)
@@ -628,13 +836,20 @@ def create_event(event_dict):
 @APP.route('/slack/handle_action', methods=['POST'])
 def handle_action():
     """Method for handling menu actions from Slack"""
-    form_json = json.loads(request.form["payload"])
-    LOGGER.debug(json.dumps(form_json))
+    form_json = codec.loads(request.form["payload"])
+    LOGGER.debug("Action: %s", request.form["payload"])
 
     if form_json["token"] != settings.SLACK_WEBHOOK_SECRET:
         return Response("OK"), 200  # if something other than slack is calling, just act like it all worked.
 
-    action_handler.handle_action(form_json)
+    capture.action(form_json)
+
+    if settings.ACK_FIRST:
+        lane, coalesce_key = action_handler.get_lane(form_json)
+        if not dispatcher.submit(action_handler.handle_action, form_json, lane=lane, coalesce_key=coalesce_key):
+            return Response("Busy, try again."), 503
+    else:
+        action_handler.handle_action(form_json)
 
     return Response("OK"), 200
 
@@ -643,83 +858,132 @@ def handle_action():
 def inbound():
     """Method for receiving messages from Slack"""
 
-    LOGGER.debug("Request:\n" + str(request.content_type))
+    LOGGER.debug("Request: %s", request.content_type)
     # logger.debug("Slack Headers: " + str(request.headers))
     # LOGGER.debug("Slack Event JSON:")
-    body = request.get_json()
-    LOGGER.debug("Body:\n" + str(body))
+    try:
+        body = codec.loads(request.get_data())
+    except ValueError:
+        return Response("Bad Request"), 400
+    capture.event(body, request.headers.get("X-Slack-Retry-Num"))
+
+    text, status, slack_event = check_event(body, request.headers.get("X-Slack-Retry-Num"),
+                                            request.headers.get("X-Slack-Retry-Reason"))
+
+    if slack_event is not None:
+        if not settings.ACK_FIRST:
+            handle_message(slack_event)
+        elif not dispatcher.submit(handle_message, slack_event,
+                                   lane=get_lane(slack_event.user, slack_event.time_stamp),
+                                   coalesce_key=get_coalesce_key(slack_event)):
+            # forget the event so slack's retry of it gets handled
+            dedup.forget(body["event_id"])
+            text, status = "Busy, try again.", 503
+
+    return Response(text), status
+
+
+def check_event(body, retry_num=None, retry_reason=None):
+    """Validates and de-duplicates a request body sent to /slack, returns the response text and status
+    and the SlackEvent to reply to, or None when the bot shouldn't reply. retry_num and retry_reason are
+    set when slack sends the event again"""
+
+    LOGGER.debug("Body: %s", body)
 
     # Validation for slack webhook
     if "challenge" in body:
         challenge = body["challenge"]
-        LOGGER.debug("Challenge: %d", challenge)
-        response = Response(challenge), 200
-        LOGGER.debug("Response: " + str(response))
-        return response
+        LOGGER.debug("Challenge: %s", challenge)
+        return challenge, 200, None
     # If some other request from slack with valid secret
     if "token" in body and "event_id" in body:
-        LOGGER.debug("event_id is " + body["event_id"])
+        LOGGER.debug("event_id is %s", body["event_id"])
         if body["token"] == settings.SLACK_WEBHOOK_SECRET:
 
-            # return Response(status=200)
-
             # Initialize response
-            response = Response("Event not supported yet"), 204
+            response = "Event not supported yet", 204
+            reply_to = None
 
             # Ensure there is an event JSON object in the body
             if "event" in body:
                 event_dict = body["event"]
             else:
                 warnings.warn("Got a call from slack that wasn't an event or challenge, not handling", UserWarning)
-                return Response("Non events not handled"), 204
+                return "Non events not handled", 204, None
+
+            # Drop an event slack sent again before parsing it
+            if dedup.seen(body["event_id"], str(event_dict.get("type")).upper(), retry_num, retry_reason):
+                return "Repeated event, not responding.", 204, None
 
             # Parse event JSON and create a SlackEvent object
             try:
-                slack_event = create_event(event_dict)
+                with metrics.timed("create_event"):
+                    slack_event = create_event(event_dict)
             except TypeError:
-                return Response("Invalid event JSON."), 400
-
-            repeated_message = not cache_event(body["event_id"])
+                return "Invalid event JSON.", 400, None
+            slack_event.event_id = body["event_id"]
 
             if slack_event and slack_event.event_type == EventType.MESSAGE or slack_event.event_type == EventType.APP_MENTION:
                 # Don't let the bot reply to itself
-                response = Response("Message Received"), 200
-                if slack_event.user is not None and slack_event.user != settings.BOT_ID:
-                    if not repeated_message:
-                        handle_message(slack_event)
-                    else:
-                        response = Response("Repeated event, not responding."), 204
+                response = "Message Received", 200
+                if slack_event.user is not None and slack_event.user != settings.get_bot_id():
+                    reply_to = slack_event
 
             if slack_event.event_type == EventType.EDIT_MESSAGE or slack_event.event_type == EventType.DELETE_MESSAGE:
                 # ToDo: Maybe change this to delete bot response via REST?
-                response = Response("Message subtype not used."), 204
+                response = "Message subtype not used.", 204
 
             # ToDo: Cleanup a this logging/catchall
             if slack_event.user is None:
                 warnings.warn(
                     "No user found for event.")
-                response = Response("Not Supported yet"), 204
+                response = "Not Supported yet", 204
 
             # ToDo: Once reactions do something, fix this
             if slack_event.text is None:
                 warnings.warn(
                     "No text found, and non text input is not handled yet.")
-                response = Response("Not Supported yet"), 204
+                response = "Not Supported yet", 204
 
             # Return the response if it's slack calling this
-            LOGGER.debug("Response To Slack: " + str(response))
-            LOGGER.debug("---------------------------------------------------------------------------\n")
-            return response
+            LOGGER.debug("Response To Slack: %s", response)
+            return response[0], response[1], reply_to
         # If no valid secret present, deny access
-        response = Response("Unauthorized or no Event ID"), 403
         LOGGER.error("token sent from slack doesn't match SLACK_WEBHOOK_SECRET env var, check verification token setting and .env file.")
-        LOGGER.debug("Response: " + str(response))
-        return response
+        return "Unauthorized or no Event ID", 403, None
     # Not Sure what's going on but it isn't slack or it isn't handled
-    response = Response("Bad Request"), 400
     LOGGER.error("no token sent in body from slack")
-    LOGGER.debug("Response: " + str(response))
-    return response
+    return "Bad Request", 400, None
+
+
+@APP.route('/stats')
+def stats():
+    """Respond with worker pool stats, requires the API key"""
+    if not check_auth(request.headers):
+        return Response("Unauthorized"), 401
+
+    return Response(json.dumps({
+        "dispatcher": dispatcher.stats(),
+        "http": http_client.stats(),
+        "delivery": delivery.stats(),
+        "upstream": upstream.stats(),
+        "cache": cache.stats(),
+        "dedup": dedup.stats(),
+        "session_pool": session_pool.stats(),
+        "profiles": profiles.stats(),
+        "socket_mode": socket_mode.stats(),
+        "logs": logs.stats(),
+        "startup": startup.report()
+    }), mimetype="application/json"), 200
+
+
+@APP.route('/metrics')
+def metrics_endpoint():
+    """Respond with stage latencies and event counters in the Prometheus text format, requires the API key"""
+    if not check_auth(request.headers):
+        return Response("Unauthorized"), 401
+
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE), 200
 
 
 @APP.route('/')
@@ -728,5 +992,14 @@ def health_check():
     return Response("Healthy"), 200
 
 
+session_pool.register(create_greeted_session)
+
+LOGGER.info("Startup times: %s", logs.Lazy(json.dumps, startup.report()))
+
 if __name__ == '__main__':
+    # Development server, use server.py in production
+    # Start greeting sessions in the background now so the first users don't wait for one
+    session_pool.start()
+    profiles.start()
+    socket_mode.start()
     APP.run(host='0.0.0.0', port=settings.PORT, debug=True)
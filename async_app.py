@@ -0,0 +1,594 @@
+"""
+Asyncio serving engine, same routes as the flask app but every call to Slack, the proxy and webhooks is awaited
+so a single process can keep thousands of conversations in flight. app.py and server.py stay available as fallback
+"""
+
+import asyncio
+import contextvars
+import functools
+import time
+import traceback
+
+import aiohttp
+from aiohttp import web
+
+import startup
+
+with startup.timed("settings"):
+    import settings
+
+with startup.timed("modules"):
+    import app
+    import action_handler
+    import async_http_client
+    import cache
+    import capture
+    import codec
+    import dedup
+    import delivery
+    import logs
+    import metrics
+    import profiles
+    import tracing
+    import sessions
+    import session_pool
+    import upstream
+    from classes import EventType, InvalidSessionError
+
+LOGGER = settings.get_logger("async_app")
+
+# Set while a lost session is being recovered in this task, so a replay that loses it again doesn't recover again
+RECOVERING = contextvars.ContextVar("recovering", default=False)
+
+
+async def request_upstream(name, method, url, retries=0, data=None, headers=None):
+    """Awaited upstream.request, through the upstream's breaker and timeout with jittered retries"""
+
+    attempt = 0
+    while True:
+        breaker = upstream.check(name)
+        started = time.perf_counter()
+        try:
+            response = await async_http_client.request(method, url, data=data, headers=headers,
+                                                       timeout=upstream.get_timeout(name)[1])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            response, wait = upstream.finish_attempt(name, breaker, started, attempt, retries,
+                                                     error=str(ex) or type(ex).__name__)
+        else:
+            response, wait = upstream.finish_attempt(name, breaker, started, attempt, retries, response=response,
+                                                     data=data)
+        if response is not None:
+            return response
+
+        attempt += 1
+        await asyncio.sleep(wait)
+
+
+async def run_blocking(func, *args):
+    """Runs a blocking call, ex: the Watson SDK, on the default thread pool, keeping the task's trace and deadline"""
+
+    context = contextvars.copy_context()
+    return await asyncio.get_event_loop().run_in_executor(None, functools.partial(context.run, func, *args))
+
+
+async def run_store(func, *args):
+    """Runs a call that reads or writes the caches, on the thread pool when they are kept in the shared store so a
+    slow round trip to it doesn't hold up every other turn on the event loop"""
+
+    if settings.TYPE == 'REDIS':
+        return await run_blocking(func, *args)
+    return func(*args)
+
+
+class _Lane(object):
+    """Turns of one user or thread, run one at a time in the order received"""
+
+    __slots__ = ("lock", "waiting", "keys")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+        self.keys = []
+
+
+class Scheduler(object):
+    """Runs turns as tasks, ordered within a lane and bounded in number so the process sheds load instead of growing"""
+
+    def __init__(self, max_in_flight, lane_max_queue):
+        self.max_in_flight = max_in_flight
+        self.lane_max_queue = lane_max_queue
+        self._tasks = set()
+        self._lanes = {}
+        self._submitted = 0
+        self._rejected = 0
+        self._completed = 0
+        self._failed = 0
+        self._coalesced = 0
+
+    def submit(self, coroutine_function, *args, lane=None, coalesce_key=None):
+        """Starts coroutine_function(*args) as a task, returns False when too many turns are in flight or queued
+        in the lane, a turn whose coalesce_key matches one waiting in its lane is dropped as a duplicate"""
+
+        if len(self._tasks) >= self.max_in_flight:
+            self._rejected += 1
+            LOGGER.warning("Too many turns in flight, rejecting " + coroutine_function.__name__)
+            return False
+
+        each_lane = None
+        if lane is not None:
+            each_lane = self._lanes.get(lane)
+            if each_lane is None:
+                each_lane = self._lanes[lane] = _Lane()
+            elif coalesce_key is not None and coalesce_key in each_lane.keys:
+                self._coalesced += 1
+                return True
+            # waiting counts the running turn too, like the dispatcher up to lane_max_queue wait behind it
+            elif each_lane.waiting - 1 >= self.lane_max_queue:
+                self._rejected += 1
+                LOGGER.warning("Lane " + str(lane) + " is full, rejecting " + coroutine_function.__name__)
+                return False
+            each_lane.waiting += 1
+            each_lane.keys.append(coalesce_key)
+
+        task = asyncio.ensure_future(self._run(lane, each_lane, coalesce_key, coroutine_function, args))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self._submitted += 1
+        return True
+
+    async def _run(self, lane, each_lane, coalesce_key, coroutine_function, args):
+        try:
+            if each_lane is None:
+                await coroutine_function(*args)
+            else:
+                async with each_lane.lock:
+                    each_lane.keys.remove(coalesce_key)
+                    await coroutine_function(*args)
+            self._completed += 1
+        except Exception:
+            LOGGER.error(traceback.format_exc())
+            self._failed += 1
+        finally:
+            if each_lane is not None:
+                each_lane.waiting -= 1
+                if each_lane.waiting == 0:
+                    self._lanes.pop(lane, None)
+
+    async def drain(self, timeout):
+        """Waits up to timeout seconds for the turns in flight, returns True if they all finished"""
+
+        if not self._tasks:
+            return True
+        done, pending = await asyncio.wait(list(self._tasks), timeout=timeout)
+        return not pending
+
+    def stats(self):
+        return {
+            "max_in_flight": self.max_in_flight,
+            "in_flight": len(self._tasks),
+            "submitted": self._submitted,
+            "rejected": self._rejected,
+            "completed": self._completed,
+            "failed": self._failed,
+            "lanes": len(self._lanes),
+            "lane_depth_max": max((each_lane.waiting for each_lane in self._lanes.values()), default=0),
+            "coalesced": self._coalesced
+        }
+
+
+SCHEDULER = Scheduler(settings.ASYNC_MAX_IN_FLIGHT, settings.WORKER_LANE_MAX_QUEUE)
+
+
+async def post_to_slack(slack_event, response):
+    """Posts messages to slack as the bot on the specified channel, queued on the delivery queue when it's enabled"""
+
+    payload = await run_store(app.get_slack_post_payload, slack_event, response)
+
+    if settings.DELIVERY_ENABLED:
+        return delivery.send(app.SLACK_POST_URL, payload, app.get_slack_post_headers(), slack_event.channel,
+                             "chat.postMessage", delivery.get_priority(slack_event.channel))
+
+    with metrics.timed("post_to_slack"):
+        response = await async_http_client.request("POST", app.SLACK_POST_URL, data=payload,
+                                                   headers=app.get_slack_post_headers())
+
+    LOGGER.debug("Slack Response: %s", logs.Lazy(getattr, response, "text"))
+
+    return True
+
+
+async def get_user_context(slack_user):
+    """Returns dictionary to be used as the userContext passed to the skill, from the cache or Slack"""
+
+    user_context = await run_store(profiles.get_cached, slack_user)
+
+    if user_context is None:
+        with metrics.timed("users_info"):
+            response = await request_upstream("slack", "GET", profiles.get_slack_user_profile_url(slack_user),
+                                              retries=settings.UPSTREAM_RETRIES, headers=profiles.SLACK_FORM_HEADERS)
+        user_profile = profiles.read_users_info_response(response)
+        user_context = await run_store(profiles.store, slack_user, user_profile)
+
+    return user_context
+
+
+async def start_new_session(user):
+    """gives the user a pooled session when one is ready, otherwise creates a new WA session"""
+
+    if settings.CALL_PROXY:
+        # the proxy creates the session on the first message, nothing to wait for
+        return await run_store(app.start_new_session, user)
+    return await run_blocking(app.start_new_session, user)
+
+
+async def force_create_new_session(user):
+    """creates new WA session for user and initializes it with 'hi'"""
+
+    if not settings.CALL_PROXY:
+        return await run_blocking(app.force_create_new_session, user)
+
+    # pooled sessions were already greeted
+    pooled_session = session_pool.take()
+    if pooled_session is not None:
+        return await run_store(sessions.assign_session_to_user, user, pooled_session)
+
+    new_session = await run_store(sessions.new_session_for_user, user, None)
+
+    user_context = await get_user_context(user)
+
+    try:
+        await call_proxy("hi", user_context, user, new_session)
+        new_session = await run_store(sessions.get_wa_session, user, None, False)
+    except Exception:
+        LOGGER.error(traceback.format_exc())
+
+    return new_session
+
+
+async def handle_message(slack_event):
+    """Takes necessary actions upon message events, ex: responding to slack users"""
+
+    # Stop bot from responding to itself
+    if settings.get_bot_id() == slack_event.user:
+        return
+
+    # cache.batch isn't used here, it is per thread and every task shares the event loop's thread
+    with tracing.trace(slack_event.event_id, "handle_message", user=slack_event.user,
+                       event_type=metrics.get_event_type(slack_event.event_type)), \
+            capture.turn(slack_event.event_id), upstream.deadline(upstream.get_turn_deadline()):
+        try:
+            await respond_to_message(slack_event)
+        except upstream.UpstreamUnavailableError:
+            # answer quickly while the assistant is down instead of leaving the user waiting
+            LOGGER.warning(traceback.format_exc())
+            metrics.count_error(slack_event.event_type, "upstream")
+            await post_to_slack(slack_event, settings.UPSTREAM_DEGRADED_MESSAGE)
+
+
+async def respond_to_message(slack_event):
+    """Gets or creates the user's session and sends their message to the assistant"""
+
+    if slack_event.text.lower().strip(' ') == "hi" or slack_event.text.lower().strip(' ') == "hello":
+        LOGGER.debug("found hi or hello, creating new session")
+        session = await start_new_session(slack_event.user)
+    else:
+        session = await run_store(sessions.get_wa_session, slack_event.user, None, False)
+        if session is None or sessions.check_expired(session):
+            if session is not None:
+                metrics.SESSIONS_EXPIRED.inc(event_type=metrics.get_event_type(slack_event.event_type))
+            old_session = session
+            session = await force_create_new_session(slack_event.user)
+            # a renewed session keeps the conversation history so it can still be replayed
+            session = await run_store(sessions.keep_history, slack_event.user, old_session) or session
+
+    await run_store(sessions.add_to_session_conversation, slack_event.user, slack_event.text)
+
+    context = app.get_assistant_context(await get_user_context(slack_event.user))
+
+    try:
+        await call_assistant(slack_event.text, context, slack_event, session)
+    except InvalidSessionError:
+        await recover_session(slack_event, lambda text: post_to_slack(slack_event, text))
+    except upstream.UpstreamUnavailableError:
+        raise
+    except Exception:
+        LOGGER.error(traceback.format_exc())
+        LOGGER.error("exception in response from assistant")
+        metrics.count_error(slack_event.event_type, "call_assistant")
+
+
+async def recover_session(slack_event, reply):
+    """replaces a session the assistant no longer knows and replays the user's last message on the new one,
+    await reply(text) is used to tell the user when the conversation can't be recovered"""
+
+    lost_context = "Sorry, I have lost the context.  Please, let's restart our conversation."
+
+    old_session = await run_store(sessions.get_wa_session, slack_event.user, None, False)
+    session = await force_create_new_session(slack_event.user)
+
+    if not settings.RECOVER_SESSIONS or RECOVERING.get():
+        await reply(lost_context)
+        return
+
+    session = await run_store(sessions.keep_history, slack_event.user, old_session) or session
+    text = session.last_user_text()
+    if text is None:
+        await reply(lost_context)
+        return
+
+    context = app.get_assistant_context(await get_user_context(slack_event.user))
+
+    token = RECOVERING.set(True)
+    try:
+        await call_assistant(text, context, slack_event, session)
+    except InvalidSessionError:
+        # the new session was lost too, don't keep trying
+        LOGGER.error(traceback.format_exc())
+        await reply(lost_context)
+    finally:
+        RECOVERING.reset(token)
+
+
+async def call_assistant(message, context, slack_event, session):
+    """Sends the user's message to proxy or directly to a Watson Assistant."""
+
+    with tracing.span("call_assistant", fulfillment=message == ""):
+        if settings.CALL_PROXY:
+            skill_response = await call_proxy(message, context, slack_event.user, session)
+        else:
+            skill_response = await run_blocking(app.call_watson_assistant, message, context, session)
+
+        await handle_skill_response(slack_event, session, skill_response)
+
+
+async def call_proxy(message, context, user, session):
+    """Sends the user's message to proxy."""
+
+    payload = app.get_proxy_payload(message, context, session)
+
+    # the proxy may have handled the message before failing, so it isn't retried
+    with metrics.timed("call_proxy"):
+        proxy_response = await request_upstream("proxy", "POST", settings.TA_PROXY, data=payload, headers=app.JSON_HEADERS)
+
+    return await run_store(app.read_proxy_response, proxy_response.ok,
+                           app.parse_proxy_response(proxy_response.content), proxy_response.text, user, session)
+
+
+async def handle_skill_response(slack_event, session, response):
+    """handles the response from WA"""
+
+    with tracing.span("handle_skill_response"):
+        await run_store(app.record_skill_response, slack_event, response)
+
+        if not app.needs_fulfillment(response):
+            return await post_to_slack(slack_event, response)
+
+        # the skill passed client fulfillment info, its message and the call to the webhook it provided don't depend
+        # on each other so they run together, the answer to the webhook's result waits for the message
+        posted = asyncio.ensure_future(post_to_slack(slack_event, response))
+        try:
+            await do_fulfillment(slack_event, session, response, posted)
+        except upstream.UpstreamUnavailableError:
+            LOGGER.warning(traceback.format_exc())
+            metrics.count_error(slack_event.event_type, "upstream")
+            await asyncio.wait([posted])
+            await post_to_slack(slack_event, settings.UPSTREAM_DEGRADED_MESSAGE)
+        except Exception:
+            metrics.count_error(slack_event.event_type, "do_fulfillment")
+            await asyncio.wait([posted])
+            await post_to_slack(slack_event, "Something went wrong. Please try your request again.")
+
+        return await posted
+
+
+async def do_fulfillment(slack_event, session, response, posted=None):
+    """make call to webhook to fulfill user request and provide the result back to the skill, once posted, the
+    task posting the skill's message, is done"""
+
+    webhook_url, payload = app.get_webhook_request(response)
+
+    async def call_webhook():
+        with metrics.timed("do_fulfillment"):
+            return await request_upstream("webhook", "POST", webhook_url, data=payload, headers=app.JSON_HEADERS)
+
+    try:
+        # makes sure the profile is cached meanwhile so building the context doesn't call slack synchronously
+        webhook_response, _ = await asyncio.gather(call_webhook(), get_user_context(slack_event.user))
+        webhook_response_json = codec.loads(webhook_response.content)
+    except upstream.UpstreamUnavailableError:
+        raise
+    except Exception as ex:
+        LOGGER.error(traceback.format_exc())
+        LOGGER.error("exception in response from webhook")
+        raise ex
+
+    context = await run_store(app.get_fulfillment_context, slack_event.user, webhook_response_json)
+
+    if posted is not None:
+        await posted
+
+    try:
+        await call_assistant("", context, slack_event, session)
+    except InvalidSessionError:
+        # replaying the user's request runs the fulfillment again on the new session
+        await recover_session(slack_event, lambda text: post_to_slack(slack_event, text))
+
+
+async def send_message(url, blocks, message, channel=None):
+    """Send reply back to slack so user sees what was sent in response to button"""
+
+    new_blocks, payload = action_handler.get_reply(blocks, message)
+
+    if settings.DELIVERY_ENABLED:
+        delivery.send(url, payload, action_handler.REPLY_HEADERS, channel or url, "response_url", delivery.PRIORITY_DIRECT)
+        return new_blocks
+
+    with metrics.timed("send_message"):
+        response = await async_http_client.request("POST", url, data=payload, headers=action_handler.REPLY_HEADERS)
+    LOGGER.debug("Slack Response: %s", logs.Lazy(getattr, response, "text"))
+
+    return new_blocks
+
+
+async def handle_button(form_json):
+    """handle button actions"""
+
+    url = form_json["response_url"]
+
+    with tracing.trace(form_json.get("trigger_id"), "handle_action", user=form_json["user"]["id"]), \
+            capture.turn(form_json.get("trigger_id")), upstream.deadline(upstream.get_turn_deadline()):
+        try:
+            # the buttons have data encoded in their value to help facilitate the
+            # response so it goes to thread or not to thread appropriately.
+            message_info = []
+            if form_json["actions"][0]["type"] == "button":
+                message_info = form_json["actions"][0]["value"].split(":")
+
+            channel = form_json["channel"]["id"]
+            blocks = await send_message(url, form_json["message"]["blocks"], "> _You replied: " + message_info[0] + "_", channel)
+
+            text = message_info[0]
+            slack_event = action_handler.get_action_event(form_json, message_info[1], message_info[2])
+            session = await run_store(sessions.get_wa_session, slack_event.user, None, False)
+            context = app.get_assistant_context(await get_user_context(slack_event.user))
+
+            # the button's text is the user's turn, so it can be replayed if the session was lost
+            await run_store(sessions.add_to_session_conversation, slack_event.user, text)
+
+            try:
+                await call_assistant(text, context, slack_event, session)
+            except InvalidSessionError:
+                await recover_session(slack_event, lambda message: send_message(url, blocks, message, channel))
+            except upstream.UpstreamUnavailableError:
+                LOGGER.warning(traceback.format_exc())
+                metrics.count_error(slack_event.event_type, "upstream")
+                await send_message(url, blocks, "> _" + settings.UPSTREAM_DEGRADED_MESSAGE + "_", channel)
+            except Exception:
+                LOGGER.error(traceback.format_exc())
+                metrics.count_error(slack_event.event_type, "call_assistant")
+                await send_message(url, blocks, "> _Sorry, something went wrong calling WA._", channel)
+
+        except upstream.UpstreamUnavailableError:
+            LOGGER.warning(traceback.format_exc())
+            metrics.count_error(EventType.UNHANDLED, "upstream")
+            await send_message(url, form_json["message"]["blocks"], "> _" + settings.UPSTREAM_DEGRADED_MESSAGE + "_",
+                               form_json["channel"]["id"])
+
+        except Exception:
+            LOGGER.error(traceback.format_exc())
+            metrics.count_error(EventType.UNHANDLED, "handle_action")
+            await send_message(url, form_json["message"]["blocks"], "> _Sorry, something went wrong handling action._",
+                               form_json["channel"]["id"])
+
+
+async def handle_action(request):
+    """Method for handling menu actions from Slack"""
+
+    form = await request.post()
+    form_json = codec.loads(form["payload"])
+
+    if form_json["token"] != settings.SLACK_WEBHOOK_SECRET:
+        return web.Response(text="OK", status=200)  # if something other than slack is calling, just act like it all worked.
+
+    capture.action(form_json)
+
+    lane, coalesce_key = action_handler.get_lane(form_json)
+    if not SCHEDULER.submit(handle_button, form_json, lane=lane, coalesce_key=coalesce_key):
+        return web.Response(text="Busy, try again.", status=503)
+
+    return web.Response(text="OK", status=200)
+
+
+async def inbound(request):
+    """Method for receiving messages from Slack"""
+
+    try:
+        body = codec.loads(await request.read())
+    except ValueError:
+        return web.Response(text="Bad Request", status=400)
+    capture.event(body, request.headers.get("X-Slack-Retry-Num"))
+
+    # de-duplicates the event and looks up its thread in the caches
+    text, status, slack_event = await run_store(app.check_event, body, request.headers.get("X-Slack-Retry-Num"),
+                                                request.headers.get("X-Slack-Retry-Reason"))
+
+    if slack_event is not None and not SCHEDULER.submit(handle_message, slack_event,
+                                                        lane=app.get_lane(slack_event.user, slack_event.time_stamp),
+                                                        coalesce_key=app.get_coalesce_key(slack_event)):
+        # forget the event so slack's retry of it gets handled
+        await run_store(dedup.forget, body["event_id"])
+        text, status = "Busy, try again.", 503
+
+    # 204 responses can't have a body
+    return web.Response(text=text if status != 204 else None, status=status)
+
+
+async def stats(request):
+    """Respond with scheduler, connection pool, cache and session pool stats, requires the API key"""
+
+    if not app.check_auth(request.headers):
+        return web.Response(text="Unauthorized", status=401)
+
+    return web.json_response({
+        "scheduler": SCHEDULER.stats(),
+        "http": async_http_client.stats(),
+        "delivery": delivery.stats(),
+        "upstream": upstream.stats(),
+        "cache": await run_store(cache.stats),
+        "dedup": dedup.stats(),
+        "session_pool": session_pool.stats(),
+        "profiles": profiles.stats(),
+        "logs": logs.stats(),
+        "startup": startup.report()
+    })
+
+
+async def metrics_endpoint(request):
+    """Respond with stage latencies and event counters in the Prometheus text format, requires the API key"""
+
+    if not app.check_auth(request.headers):
+        return web.Response(text="Unauthorized", status=401)
+
+    return web.Response(body=metrics.render().encode("utf-8"), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+async def health_check(request):
+    """Respond with healthy."""
+    return web.Response(text="Healthy", status=200)
+
+
+async def on_startup(application):
+    """Resolves the bot id before serving, so the first event doesn't wait on auth.test"""
+
+    await run_blocking(settings.get_bot_id)
+
+
+async def on_shutdown(application):
+    """Lets the turns already acknowledged to slack finish, then closes the upstream connections"""
+
+    if not await SCHEDULER.drain(settings.SERVER_DRAIN_TIMEOUT):
+        LOGGER.warning("Stopped before every turn was handled")
+    if not await run_blocking(delivery.shutdown, settings.SERVER_DRAIN_TIMEOUT):
+        LOGGER.warning("Stopped before every queued message was sent to slack")
+    await async_http_client.close()
+
+
+def create_app():
+    """Returns the aiohttp application serving the bot's routes"""
+
+    application = web.Application()
+    application.router.add_post('/slack/handle_action', handle_action)
+    application.router.add_post('/slack', inbound)
+    application.router.add_get('/stats', stats)
+    application.router.add_get('/metrics', metrics_endpoint)
+    application.router.add_get('/', health_check)
+    application.on_startup.append(on_startup)
+    application.on_shutdown.append(on_shutdown)
+    return application
+
+
+if __name__ == '__main__':
+    # Start greeting sessions in the background now so the first users don't wait for one
+    session_pool.start()
+    profiles.start()
+    web.run_app(create_app(), host='0.0.0.0', port=settings.PORT)
@@ -0,0 +1,103 @@
+"""
+Shared asyncio HTTP clients for the async serving engine, one keep-alive connection pool per upstream host
+"""
+
+from urllib.parse import urlsplit
+
+import aiohttp
+
+import codec
+import settings
+
+LOGGER = settings.get_logger("async_http_client")
+
+_SESSIONS = {}
+_POOL_HITS = 0
+_POOL_MISSES = 0
+
+
+class Response(object):
+    """Body and status of a finished request, with the parts of requests.Response the bot uses"""
+
+    __slots__ = ("status_code", "content")
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+
+    def json(self):
+        return codec.loads(self.content)
+
+
+def _host_limit(host):
+    """Returns the max number of connections open at once to a host"""
+
+    return settings.HTTP_HOST_MAXSIZE.get(host, settings.ASYNC_CONNECTIONS_PER_HOST)
+
+
+def get_session(url):
+    """Returns the shared client session for the url's host, creating it on first use, must run in the event loop"""
+
+    global _POOL_HITS, _POOL_MISSES
+
+    parts = urlsplit(url)
+    key = parts.scheme + "://" + parts.netloc
+
+    session = _SESSIONS.get(key)
+    if session is None or session.closed:
+        _POOL_MISSES += 1
+        limit = _host_limit(parts.hostname or "")
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=limit, keepalive_timeout=settings.ASYNC_KEEPALIVE),
+            timeout=aiohttp.ClientTimeout(total=settings.ASYNC_TIMEOUT)
+        )
+        _SESSIONS[key] = session
+        LOGGER.debug("Created async connection pool for " + key + " with " + str(limit) + " connections")
+    else:
+        _POOL_HITS += 1
+
+    return session
+
+
+async def request(method, url, data=None, headers=None, timeout=None):
+    """Sends a request through the pooled session for the host and reads the whole body, timeout in seconds
+    overrides the session's"""
+
+    kwargs = {} if timeout is None else {"timeout": aiohttp.ClientTimeout(total=timeout)}
+    async with get_session(url).request(method, url, data=data, headers=headers, **kwargs) as response:
+        return Response(response.status, await response.read())
+
+
+async def close():
+    """Closes every pooled session, call before the event loop stops"""
+
+    for session in list(_SESSIONS.values()):
+        await session.close()
+    _SESSIONS.clear()
+
+
+def stats():
+    """Returns pool hit/miss counters and the connections open per host"""
+
+    result = {
+        "pool_hits": _POOL_HITS,
+        "pool_misses": _POOL_MISSES,
+        "hosts": {}
+    }
+
+    for key, session in _SESSIONS.items():
+        connector = session.connector
+        result["hosts"][key] = {
+            "limit": connector.limit if connector is not None else 0,
+            "connections_in_use": len(getattr(connector, "_acquired", ())) if connector is not None else 0
+        }
+
+    return result
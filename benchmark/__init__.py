@@ -0,0 +1 @@
+"""Load test harness, stub upstream servers and a driver that replays synthetic slack traffic at the bot"""
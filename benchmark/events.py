@@ -0,0 +1,118 @@
+"""
+Micro-benchmark of how long the bot takes to decode a request body sent to /slack and turn it into a SlackEvent,
+for an event of each EventType, with every JSON decoder that is installed. Runs in process, without the stubs.
+
+    python -m benchmark.events --number 20000 --json events.json
+"""
+
+import argparse
+import json
+import os
+import time
+
+from benchmark import stubs
+
+CHANNEL = "C0BENCH01"
+USER = "U00001"
+# A thread the bot already replied to USER in
+THREAD_TS = "1600000000.000100"
+MENTION = "<@" + stubs.BOT_ID + ">"
+
+# (name, expected EventType name, event) for each kind of event slack sends the bot
+EVENTS = [
+    ("dm", "APP_MENTION", {"type": "message", "channel_type": "im", "text": "book a room for tomorrow at 10"}),
+    ("app_mention", "APP_MENTION", {"type": "app_mention", "text": MENTION + " where is my desk"}),
+    ("channel_mention", "MESSAGE", {"type": "message", "channel_type": "channel",
+                                    "text": "hey " + MENTION + " what rooms are free"}),
+    ("thread_reply", "MESSAGE", {"type": "message", "channel_type": "channel", "thread_ts": THREAD_TS,
+                                 "text": "the one on the third floor"}),
+    ("file_upload", "FILE_UPLOAD", {"type": "message", "channel_type": "channel", "thread_ts": THREAD_TS, "text": "",
+                                    "files": [{"id": "F0BENCH01", "name": "floor.png"}]}),
+    ("empty_message", "EMPTY_MESSAGE", {"type": "message", "channel_type": "channel", "thread_ts": THREAD_TS,
+                                        "text": ""}),
+    ("message_changed", "EDIT_MESSAGE", {"type": "message", "subtype": "message_changed", "channel_type": "channel",
+                                         "thread_ts": THREAD_TS, "text": "edited",
+                                         "message": {"text": "the one on the fourth floor"}}),
+    ("message_deleted", "DELETE_MESSAGE", {"type": "message", "subtype": "message_deleted", "channel_type": "channel",
+                                           "thread_ts": THREAD_TS, "text": "deleted"}),
+    ("reaction_added", "REACTION_ADDED", {"type": "reaction_added", "reaction": "thumbsup",
+                                          "item": {"type": "message", "channel": CHANNEL, "ts": THREAD_TS}}),
+    ("channel_message", "UNHANDLED", {"type": "message", "channel_type": "channel", "text": "lunch anyone?"}),
+]
+
+
+def get_body(number, event):
+    """Returns the request body slack would send for event, as bytes"""
+
+    event = dict(event, user=USER, ts="1600000001.%06d" % number, event_ts="1600000001.%06d" % number)
+    event.setdefault("channel", CHANNEL)
+    return json.dumps({"token": "bench-secret", "team_id": "T0BENCH01", "api_app_id": "A0BENCH01",
+                       "type": "event_callback", "event_id": "Ev0BENCH%04d" % number, "event_time": 1600000001,
+                       "event": event}).encode("utf-8")
+
+
+def time_decoder(app, codec, name, number):
+    """Returns microseconds per event to decode a body and create its SlackEvent, and to decode it alone"""
+
+    codec.set_decoder(name)
+    results = {}
+    for index, (event_name, expected, event) in enumerate(EVENTS):
+        body = get_body(index, event)
+        slack_event = app.create_event(codec.loads(body)["event"])
+        if slack_event.event_type.name != expected:
+            raise Exception(event_name + " was parsed as " + slack_event.event_type.name + ", expecting " + expected)
+
+        started = time.perf_counter()
+        for _ in range(number):
+            codec.loads(body)
+        decode = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for _ in range(number):
+            app.create_event(codec.loads(body)["event"])
+        total = time.perf_counter() - started
+
+        results[event_name] = {"event_type": expected, "decode_us": round(decode / number * 1e6, 2),
+                               "total_us": round(total / number * 1e6, 2)}
+    return results
+
+
+def main(args):
+    os.environ.update(stubs.get_bot_env(args.stub_port))
+    os.environ.setdefault("LOGGING_LEVEL", "ERROR")
+
+    import app
+    import codec
+    import settings
+
+    # the bot id is normally looked up from slack on first use
+    settings._set_bot_id(stubs.BOT_ID)
+    app.THREADS.add_member(THREAD_TS, USER)
+
+    decoders = [name for name in codec.DECODERS if codec.get_decoder(name) is not None]
+    return {name: time_decoder(app, codec, name, args.number) for name in decoders}
+
+
+def print_report(result):
+    decoders = list(result)
+    print("%-18s %-15s" % ("event", "type") + "".join("%22s" % (name.lower() + " decode/total us") for name in decoders))
+    for event_name, expected, _ in EVENTS:
+        row = "%-18s %-15s" % (event_name, expected)
+        for name in decoders:
+            timing = result[name][event_name]
+            row += "%22s" % ("%.2f / %.2f" % (timing["decode_us"], timing["total_us"]))
+        print(row)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time decoding and parsing an event of each type")
+    parser.add_argument("--number", type=int, default=20000, help="times each event is parsed")
+    parser.add_argument("--stub-port", type=int, default=9000, help="only used to build the bot's env vars")
+    parser.add_argument("--json", help="also write the results to this file, to compare builds")
+    arguments = parser.parse_args()
+
+    report = main(arguments)
+    print_report(report)
+    if arguments.json:
+        with open(arguments.json, "w") as json_file:
+            json.dump(report, json_file, indent=2)
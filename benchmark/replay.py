@@ -0,0 +1,483 @@
+"""
+Replays a capture recorded with [CAPTURE] ENABLED=TRUE against a build. The events and button clicks are sent in
+the recorded order, at the recorded pace, N times faster or as fast as the bot takes them, while the stubs answer
+each turn's proxy, Watson and webhook calls with what the real ones answered in the recording and as slowly.
+Run it against two builds with --json to compare their latency and memory on real traffic shapes.
+
+    python -m benchmark.replay capture.jsonl --speed 1 --engine gunicorn --json before.json
+    python -m benchmark.replay capture.jsonl --speed 0 --engine async --json after.json
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import time
+import uuid
+
+import aiohttp
+from aiohttp import web
+
+from benchmark import stubs
+from benchmark.run import ENGINES, percentile, get_rss_kb, start_bot, wait_for_bot
+
+# Calls the stubs have no recorded timing for take this long, in ms
+DEFAULT_LATENCY = dict(stubs.DEFAULT_LATENCY, **{"chat.postMessage": 30, "response_url": 30, "watson_session": 100})
+
+
+class Recording(object):
+    """A capture file read back, the inputs to send and the upstream calls each turn made"""
+
+    def __init__(self, path):
+        self.bot_id = None
+        self.inputs = []
+        # turn id -> upstream name -> calls in the order they were made
+        self.turns = {}
+        # upstream name -> every call, for the ones that can't be tied to a turn
+        self.calls = {}
+
+        with open(path) as capture_file:
+            for line in capture_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut short when the bot was stopped
+                    continue
+                kind = record.get("k")
+                if kind == "start" and self.bot_id is None:
+                    self.bot_id = record.get("bot")
+                elif kind in ("event", "action"):
+                    self.inputs.append(record)
+                elif kind == "call":
+                    self.calls.setdefault(record["up"], []).append(record)
+                    if record.get("turn") is not None:
+                        self.turns.setdefault(record["turn"], {}).setdefault(record["up"], []).append(record)
+
+        self.inputs.sort(key=lambda record: record["t"])
+
+    @property
+    def assistant(self):
+        return "watson" if "watson" in self.calls else "proxy"
+
+    @property
+    def seconds(self):
+        return self.inputs[-1]["t"] - self.inputs[0]["t"] if self.inputs else 0
+
+    def get_turn_id(self, record):
+        if record["k"] == "event":
+            return record["body"].get("event_id")
+        return record["payload"].get("trigger_id")
+
+    def is_answered(self, record):
+        """Returns True if the bot answered the input when it was recorded, it asked the assistant something"""
+
+        if record.get("retry"):
+            return False
+        calls = self.turns.get(self.get_turn_id(record), {})
+        return any(each_call.get("status") == 200 for name in ("proxy", "watson") for each_call in calls.get(name, []))
+
+
+class ReplayState(stubs.StubState):
+    """Stub state answering every call as it was answered in the recording"""
+
+    def __init__(self, recording):
+        super(ReplayState, self).__init__()
+        self.recording = recording
+        # input number -> upstream name -> recorded calls not replayed yet
+        self.pending = {}
+        self.matched = {}
+        self._next = {}
+
+    def start_turn(self, number, record):
+        calls = self.recording.turns.get(self.recording.get_turn_id(record), {})
+        self.pending[number] = {name: list(each_calls) for name, each_calls in calls.items()}
+
+    async def delay(self, name):
+        """Waits as long as the next recorded call to the named upstream took, returns True if it failed"""
+
+        self.calls[name] = self.calls.get(name, 0) + 1
+        recorded = self.recording.calls.get(name)
+        if not recorded:
+            await asyncio.sleep(DEFAULT_LATENCY.get(name, 0) / 1000.0)
+            return False
+
+        index = self._next.get(name, 0)
+        self._next[name] = index + 1
+        each_call = recorded[index % len(recorded)]
+        await asyncio.sleep(each_call["ms"] / 1000.0)
+        if each_call["status"] is None or each_call["status"] >= 500:
+            self.injected_failures[name] = self.injected_failures.get(name, 0) + 1
+            return True
+        return False
+
+    async def answer(self, name, number, text):
+        """Returns the recorded call of turn number answering text, after waiting as long as it took, None when the
+        turn made no such call and the stub should make an answer up"""
+
+        calls = self.pending.get(number, {}).get(name)
+        if not calls:
+            return None
+
+        # a turn can greet a new session, send the user's text and send the webhook's result, pick the one sent text
+        each_call = next((each_call for each_call in calls if each_call.get("in") == text), calls[0])
+        calls.remove(each_call)
+
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.matched[name] = self.matched.get(name, 0) + 1
+        await asyncio.sleep(each_call["ms"] / 1000.0)
+        if each_call["status"] is None or each_call["status"] >= 500:
+            self.injected_failures[name] = self.injected_failures.get(name, 0) + 1
+        return each_call
+
+
+def get_number(text):
+    match = stubs.MARKER.search(text)
+    return int(match.group(1)) if match else None
+
+
+def strip_marker(text):
+    return stubs.MARKER.sub("", text or "").rstrip(" ")
+
+
+def tag_skill_response(response, number, webhook_url):
+    """Returns a recorded skill response with the turn's marker in its first text, so the reply can be matched to the
+    input, and its webhook pointed at the stub"""
+
+    response = copy.deepcopy(response) if isinstance(response, dict) else {"output": {"generic": []}}
+    marker = " bench-" + str(number)
+
+    generic = response.setdefault("output", {}).setdefault("generic", [])
+    for each_generic in generic:
+        for key in ("text", "title"):
+            if isinstance(each_generic.get(key), str):
+                each_generic[key] += marker
+                break
+        else:
+            continue
+        break
+    else:
+        generic.append({"response_type": "text", "text": marker.strip()})
+
+    cloud_functions = response.get("context", {}).get("skills", {}).get("main skill", {}).get("user_defined", {}) \
+        .get("private", {}).get("cloudfunctions")
+    if isinstance(cloud_functions, dict) and "webhook" in cloud_functions:
+        cloud_functions["webhook"] = webhook_url + "/" + str(number)
+
+    return response
+
+
+def create_app(state, base_url):
+    """Returns the aiohttp application serving the slack, proxy, Watson and webhook stubs from the recording"""
+
+    webhook_url = base_url + "/webhook"
+    bot_id = state.recording.bot_id or stubs.BOT_ID
+
+    def get_skill_response(recorded, number, text, context):
+        """Returns the recorded skill response tagged for the turn, or an echo of text when there is none"""
+
+        if not isinstance(recorded, dict):
+            return stubs.get_skill_response(text, context, webhook_url)
+        return tag_skill_response(recorded, number, webhook_url)
+
+    def get_failure(each_call):
+        """Returns the status a recorded call failed with, 504 when it got no answer, None when it succeeded"""
+
+        if each_call is None:
+            return None
+        if each_call["status"] is None:
+            return 504
+        return each_call["status"] if each_call["status"] >= 400 else None
+
+    async def auth_test(request):
+        await state.delay("slack")
+        return web.json_response({"ok": True, "user_id": bot_id})
+
+    async def users_info(request):
+        if await state.delay("slack"):
+            return web.json_response({"ok": False, "error": "internal_error"}, status=500)
+        return web.json_response({"ok": True, "user": {
+            "tz": "America/New_York",
+            "profile": {"real_name": "Replay User", "email": request.query.get("user", "U0").lower() + "@example.com"}
+        }})
+
+    async def post_message(request):
+        body = await request.text()
+        if await state.delay("chat.postMessage"):
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        state.record(state.posts, body)
+        return web.json_response({"ok": True, "ts": "%.6f" % time.time()})
+
+    async def response_url(request):
+        body = await request.text()
+        if await state.delay("response_url"):
+            return web.Response(status=500)
+        state.record(state.responses, body)
+        return web.Response(text="ok")
+
+    async def proxy(request):
+        body = await request.text()
+        payload = json.loads(body)
+        wa_payload = payload.get("wa_payload", {})
+        text = wa_payload.get("input", {}).get("text", "")
+        number = get_number(body)
+
+        each_call = await state.answer("proxy", number, strip_marker(text))
+        if each_call is None and await state.delay("proxy"):
+            return web.json_response({"message": "Recorded failure"}, status=500)
+        status = get_failure(each_call)
+        if status is not None:
+            return web.json_response(each_call.get("body") or {"message": "Recorded failure"}, status=status)
+
+        recorded = (each_call.get("body") or {}).get("result", {}).get("result") if each_call is not None else None
+        response = get_skill_response(recorded, number, text, wa_payload.get("context"))
+        return web.json_response({"result": {"sessionId": payload.get("sessionId") or uuid.uuid4().hex,
+                                             "result": response}})
+
+    async def iam_token(request):
+        return web.json_response({"access_token": "replay", "refresh_token": "replay", "token_type": "Bearer",
+                                  "expires_in": 3600, "expiration": int(time.time()) + 3600})
+
+    async def watson_session(request):
+        if await state.delay("watson_session"):
+            return web.json_response({"error": "Recorded failure", "code": 500}, status=500)
+        return web.json_response({"session_id": uuid.uuid4().hex}, status=201)
+
+    async def watson_message(request):
+        body = await request.text()
+        payload = json.loads(body)
+        text = payload.get("input", {}).get("text", "")
+        number = get_number(body)
+
+        each_call = await state.answer("watson", number, strip_marker(text))
+        if each_call is None and await state.delay("watson"):
+            return web.json_response({"error": "Recorded failure", "code": 500}, status=500)
+        status = get_failure(each_call)
+        if status is not None:
+            return web.json_response({"error": str((each_call.get("body") or {}).get("error")), "code": status},
+                                     status=status)
+        recorded = each_call.get("body") if each_call is not None else None
+        return web.json_response(get_skill_response(recorded, number, text, payload.get("context")))
+
+    async def webhook(request):
+        number = int(request.match_info["number"])
+        each_call = await state.answer("webhook", number, None)
+        if each_call is None and await state.delay("webhook"):
+            return web.json_response({"error": "Recorded failure"}, status=500)
+        status = get_failure(each_call)
+        if status is not None:
+            return web.json_response({"error": "Recorded failure"}, status=status)
+
+        response = dict(each_call.get("body") or {}) if each_call is not None else {}
+        # the webhook's result goes back to the assistant, the marker ties that call to the turn too
+        response["marker"] = "bench-" + str(number)
+        return web.json_response(response)
+
+    application = web.Application()
+    application.router.add_post("/api/auth.test", auth_test)
+    application.router.add_get("/api/users.info", users_info)
+    application.router.add_post("/api/chat.postMessage", post_message)
+    application.router.add_post("/response/{id}", response_url)
+    application.router.add_post("/proxy", proxy)
+    application.router.add_post("/identity/token", iam_token)
+    application.router.add_post("/v2/assistants/{assistant_id}/sessions", watson_session)
+    application.router.add_post("/v2/assistants/{assistant_id}/sessions/{session_id}/message", watson_message)
+    application.router.add_post("/webhook/{number}", webhook)
+    return application
+
+
+def get_request(record, number, stub_url):
+    """Returns the path, json body, form and headers that send a recorded input to the bot, with the input's marker
+    in its text so the stubs and the reply can be tied to it"""
+
+    marker = " bench-" + str(number)
+
+    if record["k"] == "event":
+        body = copy.deepcopy(record["body"])
+        body["token"] = "bench-secret"
+        event = body.get("event", {})
+        if isinstance(event.get("text"), str):
+            event["text"] += marker
+        headers = {"X-Slack-Retry-Num": str(record["retry"])} if record.get("retry") else {}
+        return "/slack", body, None, headers
+
+    payload = copy.deepcopy(record["payload"])
+    payload["token"] = "bench-secret"
+    payload["response_url"] = stub_url + "/response/" + str(number)
+    for action in payload.get("actions", []):
+        if isinstance(action.get("value"), str) and ":" in action["value"]:
+            head, tail = action["value"].split(":", 1)
+            action["value"] = head + marker + ":" + tail
+    return "/slack/handle_action", None, {"payload": json.dumps(payload)}, {}
+
+
+async def replay(recording, state, bot_url, stub_url, args):
+    """Sends every input at its recorded time divided by speed, as fast as possible when speed is 0, and waits for
+    the replies to drain, returns the send times, ack latencies and statuses"""
+
+    sent_at = {}
+    ack_latency = []
+    ack_status = {}
+
+    async def send(session, number, record):
+        path, body, form, headers = get_request(record, number, stub_url)
+        state.start_turn(number, record)
+        sent_at[number] = started = time.monotonic()
+        try:
+            if body is not None:
+                response = await session.post(bot_url + path, json=body, headers=headers)
+            else:
+                response = await session.post(bot_url + path, data=form, headers=headers)
+            await response.read()
+            status = str(response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            status = type(ex).__name__
+        ack_latency.append(time.monotonic() - started)
+        ack_status[status] = ack_status.get(status, 0) + 1
+
+    inputs = recording.inputs[:args.count] if args.count else recording.inputs
+    first = inputs[0]["t"] if inputs else 0
+
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30)) as session:
+        started = time.monotonic()
+        tasks = []
+        for number, record in enumerate(inputs):
+            if args.speed > 0:
+                wait = started + (record["t"] - first) / args.speed - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            tasks.append(asyncio.ensure_future(send(session, number, record)))
+        await asyncio.gather(*tasks)
+        sending = time.monotonic() - started
+
+        expected = [number for number, record in enumerate(inputs) if recording.is_answered(record)]
+        deadline = time.monotonic() + args.drain
+        while time.monotonic() < deadline and any(number not in state.posts for number in expected):
+            await asyncio.sleep(0.1)
+
+    return inputs, started, sending, sent_at, ack_latency, ack_status
+
+
+def get_report(recording, state, args, inputs, started, sending, sent_at, ack_latency, ack_status, rss_start, rss_end):
+    """Returns the results of a replay, comparable between builds replaying the same recording"""
+
+    reply_latency = []
+    answered = missing = duplicated = 0
+    for number, record in enumerate(inputs):
+        replies = state.posts.get(number, [])
+        if replies and number in sent_at:
+            reply_latency.append(replies[0] - sent_at[number])
+        if record.get("retry"):
+            duplicated += 1 if replies else 0
+        elif recording.is_answered(record):
+            if replies:
+                answered += 1
+            else:
+                missing += 1
+
+    last_reply = max([replies[-1] for replies in state.posts.values()] or [started])
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 1)
+
+    def summarize(values):
+        return {"p50": ms(percentile(values, 50)), "p95": ms(percentile(values, 95)),
+                "p99": ms(percentile(values, 99)), "max": ms(max(values or [0]))}
+
+    return {
+        "capture": args.capture,
+        "engine": args.engine,
+        "assistant": args.assistant,
+        "speed": args.speed,
+        "sent": len(sent_at),
+        "events": sum(1 for record in inputs if record["k"] == "event"),
+        "actions": sum(1 for record in inputs if record["k"] == "action"),
+        "recorded_seconds": round(recording.seconds, 2),
+        "send_seconds": round(sending, 2),
+        "throughput_per_second": round(answered / (last_reply - started), 2) if last_reply > started else None,
+        "ack_status": ack_status,
+        "ack_ms": summarize(ack_latency),
+        "reply_ms": summarize(reply_latency),
+        "answered": answered,
+        "missing": missing,
+        "duplicated": duplicated,
+        "rss_kb": {"start": rss_start, "end": rss_end,
+                   "growth": rss_end - rss_start if rss_start is not None and rss_end is not None else None},
+        "stub_calls": state.calls,
+        "stub_calls_from_recording": state.matched,
+        "stub_failures": state.injected_failures
+    }
+
+
+async def main(args):
+    recording = Recording(args.capture)
+    if not recording.inputs:
+        raise Exception("No events or button clicks in " + args.capture)
+    args.assistant = args.assistant or recording.assistant
+
+    state = ReplayState(recording)
+    stub_url = "http://127.0.0.1:" + str(args.stub_port)
+    runner = web.AppRunner(create_app(state, stub_url))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.stub_port).start()
+
+    process = None
+    bot_url = args.url
+    if bot_url is None:
+        process = start_bot(args, args.stub_port)
+        bot_url = "http://127.0.0.1:" + str(args.bot_port)
+
+    try:
+        await wait_for_bot(bot_url, process, args.startup_timeout)
+        rss_start = get_rss_kb(process.pid) if process is not None else None
+
+        results = await replay(recording, state, bot_url, stub_url, args)
+
+        rss_end = get_rss_kb(process.pid) if process is not None else None
+        return get_report(recording, state, args, *results, rss_start=rss_start, rss_end=rss_end)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+        await runner.cleanup()
+
+
+def print_report(result):
+    print("Replayed %d events and %d button clicks at %sx in %.1fs, recorded over %.1fs" % (
+        result["events"], result["actions"], result["speed"] or "max", result["send_seconds"], result["recorded_seconds"]))
+    print("Answered %d, missing %d, throughput %s replies/s" % (result["answered"], result["missing"],
+                                                                 result["throughput_per_second"]))
+    print("Ack latency ms    p50 %(p50)s  p95 %(p95)s  p99 %(p99)s  max %(max)s" % result["ack_ms"])
+    print("Reply latency ms  p50 %(p50)s  p95 %(p95)s  p99 %(p99)s  max %(max)s" % result["reply_ms"])
+    print("Ack status " + json.dumps(result["ack_status"]))
+    print("Retried events answered again %d" % result["duplicated"])
+    print("Bot RSS KB start %(start)s end %(end)s growth %(growth)s" % result["rss_kb"])
+    print("Stub calls " + json.dumps(result["stub_calls"]) + " answered from the recording " +
+          json.dumps(result["stub_calls_from_recording"]) + " failed " + json.dumps(result["stub_failures"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay captured slack traffic against the bot with upstreams "
+                                                 "stubbed from the capture")
+    parser.add_argument("capture", help="file written with [CAPTURE] ENABLED=TRUE")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 replays at the recorded pace, 10 ten times "
+                                                                 "faster, 0 as fast as possible")
+    parser.add_argument("--count", type=int, help="only replay the first count events and clicks")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="gunicorn", help="how the bot is served")
+    parser.add_argument("--assistant", choices=["proxy", "watson"], help="defaults to the one in the capture")
+    parser.add_argument("--url", help="replay against a bot that is already running here instead of starting one")
+    parser.add_argument("--workers", type=int, help="gunicorn worker processes, WEB_CONCURRENCY")
+    parser.add_argument("--drain", type=float, default=30, help="seconds to wait for the last replies")
+    parser.add_argument("--connections", type=int, default=200, help="connections open to the bot at once")
+    parser.add_argument("--stub-port", type=int, default=9000)
+    parser.add_argument("--bot-port", type=int, default=8090)
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--log-level", default="ERROR")
+    parser.add_argument("--json", help="also write the results to this file, to compare builds")
+    arguments = parser.parse_args()
+
+    report = asyncio.get_event_loop().run_until_complete(main(arguments))
+    print_report(report)
+    if arguments.json:
+        with open(arguments.json, "w") as results_file:
+            json.dump(report, results_file, indent=2)
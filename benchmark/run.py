@@ -0,0 +1,405 @@
+"""
+Load test driver, starts the stub servers and the bot, sends synthetic app mentions, direct messages, thread replies
+and button clicks to /slack and /slack/handle_action at a target rate, then reports throughput, ack and reply latency
+percentiles, the bot's memory growth and how many retried events were answered twice.
+
+    python -m benchmark.run --rate 50 --duration 60 --engine gunicorn
+    python -m benchmark.run --rate 20 --duration 30 --assistant watson --failures proxy=0.02 --json results.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from benchmark import stubs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENGINES = {
+    "gunicorn": "server.py",
+    "async": "async_app.py",
+    "flask": "app.py"
+}
+
+# Default share of each kind of event
+DEFAULT_MIX = {"mention": 4, "dm": 3, "thread": 2, "button": 1}
+
+
+def percentile(values, share):
+    """Returns the value below which share percent of values fall, None when there are none"""
+
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(share / 100.0 * len(ordered))) - 1)]
+
+
+def get_rss_kb(pid):
+    """Returns the resident memory of a process and its children in KB, None where /proc isn't available"""
+
+    def read_rss(each_pid):
+        try:
+            with open("/proc/" + str(each_pid) + "/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1])
+        except (IOError, ValueError):
+            pass
+        return 0
+
+    if not os.path.isdir("/proc"):
+        return None
+
+    total = read_rss(pid)
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/" + entry + "/stat") as stat:
+                # the parent pid is the 2nd field after the parenthesized command name
+                if int(stat.read().rsplit(")", 1)[1].split()[1]) == pid:
+                    total += read_rss(int(entry))
+        except (IOError, ValueError, IndexError):
+            pass
+    return total
+
+
+class LoadDriver(object):
+    """Builds synthetic slack payloads, sends them at a fixed rate and keeps what it needs for the report"""
+
+    def __init__(self, bot_url, state, stub_url, args):
+        self.bot_url = bot_url
+        self.state = state
+        self.stub_url = stub_url
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.mix = stubs.parse_pairs(args.mix, float) or DEFAULT_MIX
+        self.run_id = "%x" % int(time.time())
+        self.sent_at = {}
+        self.expected = {}
+        self.kinds = {}
+        self.retried = set()
+        self.ack_latency = []
+        self.ack_status = {}
+        # threads the bot replied in, (channel, thread ts, user), that thread replies can follow up on
+        self.threads = []
+        self.thread_starts = {}
+        self.started = None
+
+    def pick_kind(self):
+        kinds = list(self.mix.keys())
+        return self.random.choices(kinds, weights=[self.mix[kind] for kind in kinds])[0]
+
+    def get_text(self, number):
+        text = "<@" + stubs.BOT_ID + "> bench-" + str(number) + " what is my room"
+        if self.random.random() < self.args.fulfillment_rate:
+            text += " " + stubs.FULFILL
+        return text
+
+    def get_event(self, number, kind):
+        """Returns the /slack body for one synthetic event, and the number of replies it should get"""
+
+        user = "U%05d" % self.random.randrange(self.args.users)
+        channel = "C%04d" % self.random.randrange(self.args.channels)
+        ts = "%d.%06d" % (int(time.time()), number % 1000000)
+        text = self.get_text(number)
+
+        if kind == "thread" and self.threads:
+            channel, thread_ts, user = self.threads[self.random.randrange(len(self.threads))]
+            event = {"type": "message", "channel": channel, "user": user, "ts": ts, "thread_ts": thread_ts,
+                     "text": text.replace("<@" + stubs.BOT_ID + "> ", "")}
+        elif kind == "dm":
+            event = {"type": "message", "channel_type": "im", "channel": "D" + user[1:], "user": user, "ts": ts,
+                     "text": text}
+        elif kind in ("mention", "thread", "button"):
+            # a mention in a channel starts a thread the bot answers in, later thread replies follow up on it
+            kind = "mention"
+            event = {"type": "message", "channel_type": "channel", "channel": channel, "user": user, "ts": ts,
+                     "text": text}
+            self.thread_starts[number] = (channel, ts, user)
+        else:
+            event = {"type": "app_mention", "channel": channel, "user": user, "ts": ts, "text": text}
+
+        self.kinds[number] = kind
+        body = {"token": "bench-secret", "team_id": "TBENCH", "event_id": "Ev" + self.run_id + str(number),
+                "event_time": int(time.time()), "type": "event_callback", "event": event}
+        return body, (2 if stubs.FULFILL in text else 1)
+
+    def get_button(self, number):
+        """Returns the /slack/handle_action form for a click on a button the bot posted in a thread it answered,
+        so the user already has a session"""
+
+        channel, _, user = self.threads[self.random.randrange(len(self.threads))]
+        value = "bench-" + str(number) + ":" + "%d.%06d" % (int(time.time()), number % 1000000) + ":EventType.APP_MENTION"
+        payload = {
+            "type": "block_actions",
+            "token": "bench-secret",
+            "trigger_id": "Tr" + self.run_id + str(number),
+            "user": {"id": user},
+            "channel": {"id": channel},
+            "response_url": self.stub_url + "/response/" + str(number),
+            "message": {"blocks": [
+                {"type": "section", "text": {"type": "mrkdwn", "text": "Pick one"}},
+                {"type": "actions", "elements": [{"type": "button", "value": value}]}
+            ]},
+            "actions": [{"type": "button", "value": value}]
+        }
+        self.kinds[number] = "button"
+        return {"payload": json.dumps(payload)}
+
+    async def send(self, session, number):
+        """Sends one event or click, and again later as a slack retry for a share of them"""
+
+        kind = self.pick_kind()
+        headers = {}
+        if kind == "button" and self.threads:
+            url, data, body = self.bot_url + "/slack/handle_action", self.get_button(number), None
+            self.expected[number] = 1
+        else:
+            body, self.expected[number] = self.get_event(number, kind)
+            url, data = self.bot_url + "/slack", None
+
+        self.sent_at[number] = time.monotonic()
+        await self.post(session, url, data, body, headers)
+
+        if body is not None and self.random.random() < self.args.retry_rate:
+            # slack resends events it didn't see acknowledged in time
+            self.retried.add(number)
+            await asyncio.sleep(self.args.retry_delay)
+            await self.post(session, url, None, body, {"X-Slack-Retry-Num": "1", "X-Slack-Retry-Reason": "http_timeout"})
+
+    async def post(self, session, url, data, body, headers):
+        started = time.monotonic()
+        try:
+            if body is not None:
+                response = await session.post(url, json=body, headers=headers)
+            else:
+                response = await session.post(url, data=data, headers=headers)
+            await response.read()
+            status = str(response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            status = type(ex).__name__
+        self.ack_latency.append(time.monotonic() - started)
+        self.ack_status[status] = self.ack_status.get(status, 0) + 1
+
+    def open_threads(self):
+        """Makes the threads the bot already answered in available to thread replies"""
+
+        for number, thread in list(self.thread_starts.items()):
+            if number in self.state.posts:
+                self.threads.append(thread)
+                del self.thread_starts[number]
+
+    async def run(self):
+        """Sends rate events per second for duration seconds, then waits for the replies to drain"""
+
+        total = int(self.args.rate * self.args.duration)
+        connector = aiohttp.TCPConnector(limit=self.args.connections)
+        timeout = aiohttp.ClientTimeout(total=30)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            started = self.started = time.monotonic()
+            tasks = []
+            for number in range(total):
+                wait = started + number / self.args.rate - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                if number % 10 == 0:
+                    self.open_threads()
+                tasks.append(asyncio.ensure_future(self.send(session, number)))
+            await asyncio.gather(*tasks)
+            sending = time.monotonic() - started
+
+            deadline = time.monotonic() + self.args.drain
+            while time.monotonic() < deadline and self.missing():
+                await asyncio.sleep(0.1)
+            return sending, time.monotonic() - started
+
+    def missing(self):
+        return [number for number in self.sent_at if len(self.get_replies(number)) < self.expected[number]]
+
+    def get_replies(self, number):
+        """Returns the arrival times of the bot's answers to an event or click, the response_url echo of a click
+        isn't an answer"""
+
+        return self.state.posts.get(number, [])
+
+    def report(self, sending, elapsed, rss_start, rss_end):
+        reply_latency = []
+        # until the last reply an event should get, ex: the answer to a fulfillment's webhook result
+        final_latency = []
+        duplicated = 0
+        for number, sent_at in self.sent_at.items():
+            replies = self.get_replies(number)
+            if replies:
+                reply_latency.append(replies[0] - sent_at)
+            if len(replies) >= self.expected[number]:
+                final_latency.append(replies[self.expected[number] - 1] - sent_at)
+            if len(replies) > self.expected[number]:
+                duplicated += 1
+
+        answered = sum(1 for number in self.sent_at if len(self.get_replies(number)) >= self.expected[number])
+        # replies over the time from the first event to the last reply, the drain timeout waiting on lost replies
+        # doesn't count
+        last_reply = max([replies[-1] for replies in self.state.posts.values()] or [self.started])
+        retried_twice = sum(1 for number in self.retried if len(self.get_replies(number)) > self.expected[number])
+
+        def ms(value):
+            return None if value is None else round(value * 1000, 1)
+
+        kinds = {}
+        for kind in self.kinds.values():
+            kinds[kind] = kinds.get(kind, 0) + 1
+
+        return {
+            "engine": self.args.engine,
+            "assistant": self.args.assistant,
+            "target_rate": self.args.rate,
+            "sent": len(self.sent_at),
+            "kinds": kinds,
+            "send_seconds": round(sending, 2),
+            "elapsed_seconds": round(elapsed, 2),
+            "throughput_per_second": round(answered / (last_reply - self.started), 2) if last_reply > self.started else None,
+            "ack_status": self.ack_status,
+            "ack_ms": {"p50": ms(percentile(self.ack_latency, 50)), "p95": ms(percentile(self.ack_latency, 95)),
+                       "p99": ms(percentile(self.ack_latency, 99)), "max": ms(max(self.ack_latency or [0]))},
+            "reply_ms": {"p50": ms(percentile(reply_latency, 50)), "p95": ms(percentile(reply_latency, 95)),
+                         "p99": ms(percentile(reply_latency, 99)), "max": ms(max(reply_latency or [0]))},
+            "final_reply_ms": {"p50": ms(percentile(final_latency, 50)), "p95": ms(percentile(final_latency, 95)),
+                               "p99": ms(percentile(final_latency, 99)), "max": ms(max(final_latency or [0]))},
+            "answered": answered,
+            "missing": len(self.sent_at) - answered,
+            "duplicated": duplicated,
+            "retried": len(self.retried),
+            "duplicate_retry_rate": round(retried_twice / len(self.retried), 4) if self.retried else 0.0,
+            "rss_kb": {"start": rss_start, "end": rss_end,
+                       "growth": rss_end - rss_start if rss_start is not None and rss_end is not None else None},
+            "stub_calls": self.state.calls,
+            "stub_failures": self.state.injected_failures
+        }
+
+
+def start_bot(args, stub_port):
+    """Starts the bot pointed at the stubs, returns the process"""
+
+    # the bot id is looked up again from the stubs on every run, a replay's differs from the benchmark's
+    bot_id_file = os.path.join(tempfile.gettempdir(), "bench_bot_id.json")
+    if os.path.exists(bot_id_file):
+        os.remove(bot_id_file)
+
+    env = dict(os.environ)
+    env.update(stubs.get_bot_env(stub_port, args.assistant))
+    env.update({
+        "PORT": str(args.bot_port),
+        "API_KEY": "bench",
+        "LOGGING_LEVEL": args.log_level,
+        "BOT_ID_CACHE_FILE": bot_id_file
+    })
+    if args.workers:
+        env["WEB_CONCURRENCY"] = str(args.workers)
+
+    return subprocess.Popen([sys.executable, ENGINES[args.engine]], cwd=ROOT, env=env)
+
+
+async def wait_for_bot(url, process, seconds):
+    """Waits for the bot's health check to answer"""
+
+    deadline = time.monotonic() + seconds
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process is not None and process.poll() is not None:
+                raise Exception("The bot exited with " + str(process.returncode) + " before it was ready")
+            try:
+                async with session.get(url + "/") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise Exception("The bot didn't answer " + url + "/ within " + str(seconds) + "s")
+
+
+async def main(args):
+    state = stubs.StubState(stubs.parse_pairs(args.latency), stubs.parse_pairs(args.failures))
+    runner = await stubs.start(state, args.stub_port)
+    stub_url = "http://127.0.0.1:" + str(args.stub_port)
+
+    process = None
+    bot_url = args.url
+    if bot_url is None:
+        process = start_bot(args, args.stub_port)
+        bot_url = "http://127.0.0.1:" + str(args.bot_port)
+
+    try:
+        await wait_for_bot(bot_url, process, args.startup_timeout)
+        rss_start = get_rss_kb(process.pid) if process is not None else None
+
+        driver = LoadDriver(bot_url, state, stub_url, args)
+        sending, elapsed = await driver.run()
+
+        rss_end = get_rss_kb(process.pid) if process is not None else None
+        return driver.report(sending, elapsed, rss_start, rss_end)
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        await runner.cleanup()
+
+
+def print_report(result):
+    print("Sent %d events at %s/s in %.1fs %s" % (result["sent"], result["target_rate"], result["send_seconds"],
+                                                   json.dumps(result["kinds"])))
+    print("Answered %d, missing %d, throughput %s replies/s" % (result["answered"], result["missing"],
+                                                                 result["throughput_per_second"]))
+    print("Ack latency ms    p50 %(p50)s  p95 %(p95)s  p99 %(p99)s  max %(max)s" % result["ack_ms"])
+    print("Reply latency ms  p50 %(p50)s  p95 %(p95)s  p99 %(p99)s  max %(max)s" % result["reply_ms"])
+    print("Final reply ms    p50 %(p50)s  p95 %(p95)s  p99 %(p99)s  max %(max)s" % result["final_reply_ms"])
+    print("Ack status " + json.dumps(result["ack_status"]))
+    print("Duplicated replies %d, retried events %d, duplicate retry rate %.2f%%" % (
+        result["duplicated"], result["retried"], result["duplicate_retry_rate"] * 100))
+    print("Bot RSS KB start %(start)s end %(end)s growth %(growth)s" % result["rss_kb"])
+    print("Stub calls " + json.dumps(result["stub_calls"]) + " injected failures " + json.dumps(result["stub_failures"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the bot against local stand-ins for slack and the assistant")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="gunicorn", help="how the bot is served")
+    parser.add_argument("--assistant", choices=["proxy", "watson"], default="proxy")
+    parser.add_argument("--url", help="benchmark a bot that is already running here instead of starting one")
+    parser.add_argument("--workers", type=int, help="gunicorn worker processes, WEB_CONCURRENCY")
+    parser.add_argument("--rate", type=float, default=20, help="events sent per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to send for")
+    parser.add_argument("--drain", type=float, default=30, help="seconds to wait for the last replies")
+    parser.add_argument("--mix", help="share of each kind of event, ex: mention=4,dm=3,thread=2,button=1")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--fulfillment-rate", type=float, default=0.1, help="share of messages that call the webhook")
+    parser.add_argument("--retry-rate", type=float, default=0.05, help="share of events slack sends again")
+    parser.add_argument("--retry-delay", type=float, default=1.0, help="seconds before an event is sent again")
+    parser.add_argument("--latency", help="mean stub latency in ms, ex: slack=30,proxy=150,watson=150,webhook=200")
+    parser.add_argument("--failures", help="share of stub calls failing, ex: proxy=0.01,slack=0.02")
+    parser.add_argument("--connections", type=int, default=200, help="connections open to the bot at once")
+    parser.add_argument("--stub-port", type=int, default=9000)
+    parser.add_argument("--bot-port", type=int, default=8090)
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--log-level", default="ERROR")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file, to compare runs")
+    arguments = parser.parse_args()
+
+    results = asyncio.get_event_loop().run_until_complete(main(arguments))
+    print_report(results)
+    if arguments.json:
+        with open(arguments.json, "w") as results_file:
+            json.dump(results, results_file, indent=2)
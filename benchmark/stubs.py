@@ -0,0 +1,225 @@
+"""
+Local stand-ins for the slack Web API, the TRIRIGA Assistant proxy, the Watson Assistant v2 API and a fulfillment
+webhook, each with configurable latency and failure injection. They answer every message with an echo of its text,
+so the load driver can match replies to the events it sent.
+
+Run on their own to point a deployed bot at them:
+    python -m benchmark.stubs --port 9000 --latency proxy=150,webhook=200 --failures proxy=0.01
+"""
+
+import argparse
+import asyncio
+import random
+import re
+import time
+import uuid
+
+from aiohttp import web
+
+BOT_ID = "UBENCHBOT"
+# People users.list answers with, U00000 to U00999, the load driver picks its users among them
+LIST_USERS = 1000
+# Events sent by the load driver carry this marker, ex: bench-42
+MARKER = re.compile(r"bench-(\d+)")
+# Messages containing this ask the assistant for a client action, which makes the bot call the webhook
+FULFILL = "fulfill"
+
+# Mean latency in milliseconds of each stub, jittered by +-50%
+DEFAULT_LATENCY = {"slack": 30, "proxy": 150, "watson": 150, "webhook": 200}
+
+
+class StubState(object):
+    """Latency and failure settings of the stubs and what they received, shared with the load driver"""
+
+    def __init__(self, latency=None, failures=None):
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.failures = dict(failures or {})
+        self.calls = {}
+        self.injected_failures = {}
+        # marker -> times chat.postMessage or a response_url received a message with it
+        self.posts = {}
+        self.responses = {}
+
+    async def delay(self, name):
+        """Counts a call to the named stub, waits its latency and returns True if it should fail"""
+
+        self.calls[name] = self.calls.get(name, 0) + 1
+        mean = self.latency.get(name, 0) / 1000.0
+        if mean > 0:
+            await asyncio.sleep(random.uniform(mean * 0.5, mean * 1.5))
+        if random.random() < self.failures.get(name, 0):
+            self.injected_failures[name] = self.injected_failures.get(name, 0) + 1
+            return True
+        return False
+
+    def record(self, received, body):
+        """Records the arrival time of every marker in a message posted back to slack"""
+
+        now = time.monotonic()
+        for marker in set(MARKER.findall(body)):
+            received.setdefault(int(marker), []).append(now)
+
+
+def get_skill_response(text, context, webhook_url):
+    """Returns a Watson v2 message response echoing text, with a client action when text asks for fulfillment"""
+
+    result = None
+    if context:
+        result = context.get("skills", {}).get("main skill", {}).get("user_defined", {}).get("tririgaResult")
+
+    if result is not None:
+        output = {"generic": [{"response_type": "text", "text": "Done " + str(result.get("marker", ""))}]}
+        return {"output": output, "context": {}}
+
+    response = {"output": {"generic": [{"response_type": "text", "text": "You said: " + text}]}, "context": {}}
+
+    if FULFILL in text:
+        marker = MARKER.search(text)
+        response["output"]["actions"] = [{
+            "type": "client",
+            "parameters": {"cloudFunction": {"marker": marker.group(0) if marker else ""}}
+        }]
+        response["context"] = {
+            "skills": {"main skill": {"user_defined": {"private": {"cloudfunctions": {"webhook": webhook_url}}}}}
+        }
+
+    return response
+
+
+def create_app(state, base_url):
+    """Returns the aiohttp application serving every stub under base_url"""
+
+    webhook_url = base_url + "/webhook"
+
+    async def auth_test(request):
+        await state.delay("slack")
+        return web.json_response({"ok": True, "user_id": BOT_ID})
+
+    async def users_info(request):
+        if await state.delay("slack"):
+            return web.json_response({"ok": False, "error": "internal_error"}, status=500)
+        user = request.query.get("user", "U0")
+        return web.json_response({"ok": True, "user": {
+            "tz": "America/New_York",
+            "profile": {"real_name": "Bench " + user, "email": user.lower() + "@example.com"}
+        }})
+
+    async def users_list(request):
+        if await state.delay("slack"):
+            return web.json_response({"ok": False, "error": "internal_error"}, status=500)
+        start = int(request.query.get("cursor") or 0)
+        end = min(start + int(request.query.get("limit", 200)), LIST_USERS)
+        members = [{"id": "U%05d" % number, "tz": "America/New_York",
+                    "profile": {"real_name": "Bench U%05d" % number, "email": "u%05d@example.com" % number}}
+                   for number in range(start, end)]
+        return web.json_response({"ok": True, "members": members,
+                                  "response_metadata": {"next_cursor": str(end) if end < LIST_USERS else ""}})
+
+    async def post_message(request):
+        body = await request.text()
+        if await state.delay("slack"):
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        state.record(state.posts, body)
+        return web.json_response({"ok": True, "ts": "%.6f" % time.time()})
+
+    async def response_url(request):
+        body = await request.text()
+        if await state.delay("slack"):
+            return web.Response(status=500)
+        state.record(state.responses, body)
+        return web.Response(text="ok")
+
+    async def proxy(request):
+        payload = await request.json()
+        if await state.delay("proxy"):
+            return web.json_response({"message": "Injected failure"}, status=500)
+        wa_payload = payload.get("wa_payload", {})
+        response = get_skill_response(wa_payload.get("input", {}).get("text", ""), wa_payload.get("context"), webhook_url)
+        return web.json_response({"result": {"sessionId": payload.get("sessionId") or uuid.uuid4().hex, "result": response}})
+
+    async def iam_token(request):
+        return web.json_response({"access_token": "bench", "refresh_token": "bench", "token_type": "Bearer",
+                                  "expires_in": 3600, "expiration": int(time.time()) + 3600})
+
+    async def watson_session(request):
+        if await state.delay("watson"):
+            return web.json_response({"error": "Injected failure", "code": 500}, status=500)
+        return web.json_response({"session_id": uuid.uuid4().hex}, status=201)
+
+    async def watson_message(request):
+        payload = await request.json()
+        if await state.delay("watson"):
+            return web.json_response({"error": "Injected failure", "code": 500}, status=500)
+        return web.json_response(get_skill_response(payload.get("input", {}).get("text", ""), payload.get("context"),
+                                                    webhook_url))
+
+    async def webhook(request):
+        payload = await request.json()
+        if await state.delay("webhook"):
+            return web.json_response({"error": "Injected failure"}, status=500)
+        return web.json_response({"marker": payload.get("cloudFunction", {}).get("marker", "")})
+
+    application = web.Application()
+    application.router.add_post("/api/auth.test", auth_test)
+    application.router.add_get("/api/users.info", users_info)
+    application.router.add_get("/api/users.list", users_list)
+    application.router.add_post("/api/chat.postMessage", post_message)
+    application.router.add_post("/response/{id}", response_url)
+    application.router.add_post("/proxy", proxy)
+    application.router.add_post("/identity/token", iam_token)
+    application.router.add_post("/v2/assistants/{assistant_id}/sessions", watson_session)
+    application.router.add_post("/v2/assistants/{assistant_id}/sessions/{session_id}/message", watson_message)
+    application.router.add_post("/webhook", webhook)
+    return application
+
+
+async def start(state, port, host="127.0.0.1"):
+    """Starts the stubs in the running event loop, returns the runner to clean them up with"""
+
+    runner = web.AppRunner(create_app(state, "http://" + host + ":" + str(port)))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def get_bot_env(port, assistant="proxy", host="127.0.0.1"):
+    """Returns the env vars that point the bot at the stubs"""
+
+    base_url = "http://" + host + ":" + str(port)
+    env = {
+        "SLACK_API_URL": base_url + "/api",
+        "SLACK_WEBHOOK_SECRET": "bench-secret",
+        "SLACK_BOT_USER_TOKEN": "xoxb-bench",
+        "BOT_NAME": "bench"
+    }
+    if assistant == "watson":
+        env.update(WA_IAM_KEY="bench", WA_ASSISTANT_ID="bench", WA_URL=base_url, WA_IAM_URL=base_url + "/identity/token")
+    else:
+        env.update(TA_INTEGRATION_ID="bench", TA_PROXY=base_url + "/proxy")
+    return env
+
+
+def parse_pairs(text, cast=float):
+    """Parses comma separated name=value pairs, ex: proxy=150,webhook=200"""
+
+    pairs = {}
+    for pair in (text or "").split(","):
+        if pair.strip():
+            name, value = pair.split("=", 1)
+            pairs[name.strip()] = cast(value)
+    return pairs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stub slack, proxy, Watson and webhook servers for benchmarking")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--latency", help="mean latency in ms per stub, ex: slack=30,proxy=150,watson=150,webhook=200")
+    parser.add_argument("--failures", help="share of calls failing per stub, ex: proxy=0.01")
+    args = parser.parse_args()
+
+    stub_state = StubState(parse_pairs(args.latency), parse_pairs(args.failures))
+    print("Point the bot at the stubs with:")
+    for name, value in sorted(get_bot_env(args.port, host=args.host).items()):
+        print("  " + name + "=" + value)
+    web.run_app(create_app(stub_state, "http://" + args.host + ":" + str(args.port)), host=args.host, port=args.port)
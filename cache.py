@@ -1,8 +1,299 @@
+"""
+Thread safe LRU caches with per entry time to live, sharded so request threads don't contend on a single lock,
+or kept in the shared store when the cache TYPE is REDIS
+"""
+
+import os
+import threading
+import time
 from collections import OrderedDict
+from contextlib import nullcontext
+
+import settings
+from classes import Session
+
+LOGGER = settings.get_logger("cache")
+
+_MISSING = object()
+
+
+class _Shard(object):
+    """One lock striped slice of a cache, entries are kept in LRU order as key -> (value, expires_at)"""
+
+    __slots__ = ("lock", "entries", "max_size", "hits", "misses", "evictions", "expirations")
+
+    def __init__(self, max_size):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+
+class Cache(object):
+    """LRU cache with optional per entry TTL, split into shards each guarded by its own lock"""
+
+    def __init__(self, name, max_size, ttl=None, shards=None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+
+        shard_count = max(1, min(shards or settings.CACHE_SHARDS, max_size))
+        per_shard = -(-max_size // shard_count)
+        self._shards = [_Shard(per_shard) for _ in range(shard_count)]
+
+        register(self)
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _expires_at(self, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        return time.monotonic() + ttl if ttl else None
+
+    def get(self, key, default=None):
+        """Returns the cached value and marks it most recently used, or default if missing or expired"""
+
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key, _MISSING)
+            if entry is _MISSING:
+                shard.misses += 1
+                return default
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                del shard.entries[key]
+                shard.expirations += 1
+                shard.misses += 1
+                return default
+            shard.entries.move_to_end(key)
+            shard.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """Caches value, ttl in seconds overrides the cache's default time to live"""
+
+        _ensure_sweeper()
+        shard = self._shard(key)
+        with shard.lock:
+            shard.entries[key] = (value, self._expires_at(ttl))
+            shard.entries.move_to_end(key)
+            self._evict(shard)
+
+    def add(self, key, value, ttl=None):
+        """Caches value only if key isn't already cached, returns True if it was added"""
+
+        _ensure_sweeper()
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                if entry[1] is None or entry[1] > time.monotonic():
+                    shard.hits += 1
+                    return False
+                shard.expirations += 1
+            shard.misses += 1
+            shard.entries[key] = (value, self._expires_at(ttl))
+            shard.entries.move_to_end(key)
+            self._evict(shard)
+            return True
+
+    def pop(self, key, default=None):
+        """Removes key and returns its value, or default if it wasn't cached"""
+
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.pop(key, _MISSING)
+        if entry is _MISSING or (entry[1] is not None and entry[1] <= time.monotonic()):
+            return default
+        return entry[0]
+
+    def _evict(self, shard):
+        """Drops least recently used entries until the shard fits, caller holds the shard lock"""
+
+        while len(shard.entries) > shard.max_size:
+            shard.entries.popitem(last=False)
+            shard.evictions += 1
+
+    def expire(self):
+        """Removes every expired entry, returns how many were removed"""
+
+        removed = 0
+        for shard in self._shards:
+            now = time.monotonic()
+            with shard.lock:
+                expired = [key for key, entry in shard.entries.items() if entry[1] is not None and entry[1] <= now]
+                for key in expired:
+                    del shard.entries[key]
+                shard.expirations += len(expired)
+            removed += len(expired)
+        return removed
+
+    def clear(self):
+        for shard in self._shards:
+            with shard.lock:
+                shard.entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if self.pop(key, _MISSING) is _MISSING:
+            raise KeyError(key)
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self._shards)
+
+    def stats(self):
+        """Returns hit/miss/eviction counters and the current size"""
+
+        return {
+            "size": len(self),
+            "max_size": self.max_size,
+            "hits": sum(shard.hits for shard in self._shards),
+            "misses": sum(shard.misses for shard in self._shards),
+            "evictions": sum(shard.evictions for shard in self._shards),
+            "expirations": sum(shard.expirations for shard in self._shards)
+        }
+
+
+class SetCache(Cache):
+    """LRU cache of sets, ex: the users the bot talks to in each thread, a set's time to live restarts whenever a
+    member is added so it expires after that long without activity"""
+
+    def add_member(self, key, member, ttl=None):
+        """Adds member to the set at key, creating it if needed"""
+
+        _ensure_sweeper()
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key, _MISSING)
+            if entry is _MISSING or (entry[1] is not None and entry[1] <= time.monotonic()):
+                members = set()
+            else:
+                members = entry[0]
+            members.add(member)
+            shard.entries[key] = (members, self._expires_at(ttl))
+            shard.entries.move_to_end(key)
+            self._evict(shard)
+
+    def has_member(self, key, member):
+        """Returns None when there is no set at key, otherwise whether member is in it"""
+
+        members = self.get(key)
+        return None if members is None else member in members
+
+
+_CACHES = []
+_SWEEPER_LOCK = threading.Lock()
+_SWEEPER_PID = None
+
+
+def register(new_cache):
+    """Tracks a cache so the sweeper expires its entries, starts the sweeper if needed"""
+
+    _CACHES.append(new_cache)
+    _ensure_sweeper()
+
+
+def _ensure_sweeper():
+    """Starts the background expiry thread once per process"""
+
+    global _SWEEPER_PID
+
+    if _SWEEPER_PID == os.getpid():
+        return
+
+    with _SWEEPER_LOCK:
+        if _SWEEPER_PID == os.getpid():
+            return
+        thread = threading.Thread(target=_sweep, name="cache-sweeper", daemon=True)
+        thread.start()
+        _SWEEPER_PID = os.getpid()
+
+
+def _sweep():
+    """Periodically removes expired entries from every cache"""
+
+    while True:
+        time.sleep(settings.CACHE_SWEEP_INTERVAL)
+        for each_cache in list(_CACHES):
+            try:
+                removed = each_cache.expire()
+                if removed:
+                    LOGGER.debug("Expired %s entries from %s cache", removed, each_cache.name)
+            except Exception:
+                LOGGER.exception("Failed to sweep " + each_cache.name + " cache")
+
+
+def stats():
+    """Returns the stats of every cache keyed by name"""
+
+    _ensure_sweeper()
+    return {each_cache.name: each_cache.stats() for each_cache in _CACHES}
+
+
+def new_cache(name, max_size, ttl=None, encode=None, decode=None):
+    """Creates a cache in process memory or in the shared store depending on the configured cache TYPE"""
+
+    if settings.TYPE == 'REDIS':
+        import store
+        shared_cache = store.RedisCache(name, ttl=ttl, encode=encode, decode=decode)
+        _CACHES.append(shared_cache)
+        return shared_cache
+
+    return Cache(name, max_size, ttl=ttl)
+
+
+def new_set_cache(name, max_size, ttl=None):
+    """Creates a cache of sets in process memory or in the shared store depending on the configured cache TYPE"""
+
+    if settings.TYPE == 'REDIS':
+        import store
+        shared_cache = store.RedisSetCache(name, max_size, ttl=ttl)
+        _CACHES.append(shared_cache)
+        return shared_cache
+
+    return SetCache(name, max_size, ttl=ttl)
+
+
+def batch():
+    """Groups the cache reads and writes of a turn so the shared store is called as few times as possible"""
+
+    if settings.TYPE == 'REDIS':
+        import store
+        return store.batch()
+
+    return nullcontext()
+
+
+def get_many(pairs):
+    """Returns the values for a list of (cache, key) pairs, fetched from the shared store in one round trip"""
+
+    if settings.TYPE == 'REDIS':
+        import store
+        return store.get_many(pairs)
+
+    return [each_cache.get(key) for each_cache, key in pairs]
+
 
-event_cache = OrderedDict()
+session_cache = new_cache("session", settings.MAX_SESSION_CACHE, ttl=settings.SESSION_TIMEOUT_MS / 1000,
+                          encode=Session.to_dict, decode=Session.from_dict)
 
-session_cache = OrderedDict()
+user_cache = new_cache("user", settings.MAX_USER_CACHE)
 
-user_cache = OrderedDict()
+# when the user cache was last warmed up, kept apart from it so filling it doesn't evict the marker
+warm_cache = new_cache("warm", 1)
 
+# users talking to the bot in each thread it replied in, keyed by the thread's ts
+thread_cache = new_set_cache("threads", settings.MAX_THREAD_CACHE, ttl=settings.THREAD_TIMEOUT_MS / 1000)
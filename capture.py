@@ -0,0 +1,218 @@
+"""
+Opt-in traffic capture for replaying real traffic shapes with benchmark/replay.py. Records every event and button
+click slack sends, how long each upstream call took and what the proxy, Watson and webhooks answered, with user text
+masked and slack ids replaced by stable pseudonyms, appended as one compact JSON line per record by a background thread
+"""
+
+import contextvars
+import hashlib
+import hmac
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import settings
+
+LOGGER = settings.get_logger("capture")
+
+# Upstreams whose answers are recorded so replay can stub them, only timings are kept for the others
+BODIES = ("proxy", "watson", "webhook")
+
+# Values kept as they are, they shape the traffic but say nothing about the user
+KEEP_KEYS = frozenset(["type", "subtype", "response_type", "message_type", "channel_type", "event_id", "event_time",
+                       "ts", "thread_ts", "event_ts", "action_ts", "trigger_id", "sessionId", "session_id", "ok",
+                       "error", "code", "is_bot", "return_context", "time"])
+# Slack ids, replaced by a pseudonym that is the same every time the id is seen
+ID_KEYS = frozenset(["user", "channel", "team", "team_id", "user_id", "channel_id", "bot_id", "id", "app_id",
+                     "api_app_id", "enterprise_id", "authed_users", "parent_user_id"])
+# Dropped, secrets and urls only slack can call back
+DROP_KEYS = frozenset(["token", "response_url", "authorizations", "api_key"])
+
+_MASKED = re.compile(r"<@(\w+)>|[^\W\d_]|\d")
+
+# Id of the event or button click whose upstream calls are being recorded
+_TURN = contextvars.ContextVar("capture_turn", default=None)
+
+_LOCK = threading.Lock()
+_PID = None
+_LISTENER = None
+_WRITER = logging.getLogger("slackbot.capture")
+_WRITER.propagate = False
+_WRITER.setLevel(logging.INFO)
+
+
+class _CappedFileHandler(logging.FileHandler):
+    """Appends records until the file reaches max_bytes, then drops them"""
+
+    def __init__(self, filename, max_bytes):
+        super(_CappedFileHandler, self).__init__(filename, mode="a", encoding="utf-8")
+        self.max_bytes = max_bytes
+        self.full = False
+
+    def emit(self, record):
+        if self.full:
+            return
+        if self.max_bytes and self.stream.tell() >= self.max_bytes:
+            self.full = True
+            LOGGER.warning("Capture file " + self.baseFilename + " reached " + str(self.max_bytes) + " bytes, capture stopped")
+            return
+        super(_CappedFileHandler, self).emit(record)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Drops records when the writer falls behind instead of slowing the turn down"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def _ensure_started():
+    """Starts the file writer thread on first use, and again in a forked child, each process marks its start
+    with the bot's pseudonym so replay can answer auth.test with it"""
+
+    global _PID, _LISTENER
+
+    if _PID == os.getpid():
+        return
+
+    with _LOCK:
+        if _PID == os.getpid():
+            return
+
+        records = queue.Queue(settings.CAPTURE_MAX_QUEUE)
+        _WRITER.handlers.clear()
+        _WRITER.addHandler(_DroppingQueueHandler(records))
+
+        file_handler = _CappedFileHandler(settings.CAPTURE_FILE, settings.CAPTURE_MAX_BYTES)
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+        _LISTENER = logging.handlers.QueueListener(records, file_handler)
+        _LISTENER.start()
+        _PID = os.getpid()
+
+    _write({"k": "start", "t": time.time(), "pid": os.getpid(), "bot": pseudonym(settings.get_bot_id())})
+
+
+def _write(record):
+    _WRITER.info(json.dumps(record, separators=(",", ":")))
+
+
+def pseudonym(slack_id):
+    """Returns a stable stand-in for a slack id keeping its first letter, ex: U012AB3CD -> U5F1C0E9A2B"""
+
+    if not slack_id:
+        return slack_id
+    digest = hmac.new(settings.CAPTURE_KEY.encode("utf-8"), str(slack_id).encode("utf-8"), hashlib.sha256).hexdigest()
+    return str(slack_id)[0] + digest[:10].upper()
+
+
+def mask(text):
+    """Returns text with every letter replaced by x and digit by 0, keeping its length, spacing and punctuation,
+    mentions keep pointing at the pseudonym of who they mention"""
+
+    def replace(match):
+        if match.group(1) is not None:
+            return "<@" + pseudonym(match.group(1)) + ">"
+        return "0" if match.group(0).isdigit() else "x"
+
+    return _MASKED.sub(replace, text)
+
+
+def sanitize(value, key=None):
+    """Returns a copy of a slack payload or upstream answer that is safe to keep, see KEEP_KEYS, ID_KEYS and DROP_KEYS"""
+
+    if isinstance(value, dict):
+        return {each_key: sanitize(each_value, each_key) for each_key, each_value in value.items()
+                if each_key not in DROP_KEYS}
+    if isinstance(value, list):
+        return [sanitize(each_value, key) for each_value in value]
+    if not isinstance(value, str) or key in KEEP_KEYS:
+        return value
+    if key in ID_KEYS:
+        return pseudonym(value)
+    if key == "value" and ":" in value:
+        # a button's value is the text sent to the assistant followed by the ts and event type of the message it was on
+        head, tail = value.split(":", 1)
+        return mask(head) + ":" + tail
+    if value.startswith("http://") or value.startswith("https://"):
+        return "captured"
+    return mask(value)
+
+
+def event(body, retry_num=None):
+    """Records an event sent to /slack, retry_num is the X-Slack-Retry-Num header"""
+
+    if not settings.CAPTURE or "event_id" not in body:
+        return
+    _ensure_started()
+    record = {"k": "event", "t": time.time(), "body": sanitize(body)}
+    if retry_num:
+        record["retry"] = int(retry_num)
+    _write(record)
+
+
+def action(payload):
+    """Records a button click sent to /slack/handle_action"""
+
+    if not settings.CAPTURE:
+        return
+    _ensure_started()
+    _write({"k": "action", "t": time.time(), "payload": sanitize(payload)})
+
+
+@contextmanager
+def turn(turn_id):
+    """Attributes the upstream calls made in the block to the event_id or trigger_id of the turn"""
+
+    if not settings.CAPTURE:
+        yield
+        return
+
+    token = _TURN.set(turn_id)
+    try:
+        yield
+    finally:
+        _TURN.reset(token)
+
+
+def call(name, seconds, status=None, content=None, data=None):
+    """Records a call to an upstream that took seconds, status is None when it didn't answer. For BODIES the answer
+    in content and the masked text sent in data, a proxy payload or Watson input, are kept too"""
+
+    if not settings.CAPTURE:
+        return
+    _ensure_started()
+
+    record = {"k": "call", "t": time.time(), "turn": _TURN.get(), "up": name, "status": status,
+              "ms": round(seconds * 1000, 1)}
+    if name in BODIES and status is not None:
+        record["in"] = _get_input_text(data)
+        record["body"] = sanitize(_parse(content))
+    _write(record)
+
+
+def _parse(content):
+    if isinstance(content, (str, bytes)):
+        try:
+            return json.loads(content)
+        except ValueError:
+            return None
+    return content
+
+
+def _get_input_text(data):
+    """Returns the masked text of a proxy payload or Watson input, None for a webhook call"""
+
+    payload = _parse(data)
+    if not isinstance(payload, dict):
+        return None
+    text = payload.get("wa_payload", payload).get("input", {}).get("text")
+    return mask(text) if isinstance(text, str) else None
@@ -1 +1,2 @@
-from .event import SlackEvent, EventType
\ No newline at end of file
+from .event import SlackEvent, EventType
+from .session import Session, InvalidSessionError, USER, ASSISTANT
@@ -2,8 +2,11 @@ from enum import Enum, unique
 
 
 class SlackEvent(object):
+    # One per message or button click, slots keep it small and quick to create
+    __slots__ = ("channel", "event_type", "time_stamp", "user", "text", "event_id")
+
     # Initialization of object, user and text optional parameters as not all events will have them
-    def __init__(self, event_type, time_stamp, channel=None, user=None, text=None):
+    def __init__(self, event_type, time_stamp, channel=None, user=None, text=None, event_id=None):
         self.channel = str(channel) if channel is not None else "None"
         self.event_type = event_type
         self.time_stamp = time_stamp
@@ -13,6 +16,8 @@ class SlackEvent(object):
             raise TypeError("Time stamp passed to Slack Event object was type \'" + str(type(self.time_stamp)) + "\'. Expecting string. Event type was \'" + str(self.event_type) + "\'.")
         self.user = user
         self.text = text
+        # Slack's event_id, used as the trace id
+        self.event_id = event_id
 
     # Defining how to print the object
     def __str__(self):
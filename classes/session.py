@@ -0,0 +1,54 @@
+import time
+from collections import deque
+
+USER = "user"
+ASSISTANT = "assistant"
+
+
+class InvalidSessionError(Exception):
+    # Raised when the assistant or proxy no longer knows a session, ex: it timed out
+    pass
+
+
+class Session(object):
+    # Compact record of a user's WA session, keeps only the last max_turns turns of the conversation
+    __slots__ = ("session_id", "timestamp", "turns", "context")
+
+    def __init__(self, session_id, max_turns, timestamp=None):
+        self.session_id = session_id
+        # Last time the session was used, in seconds since the epoch
+        self.timestamp = time.time() if timestamp is None else timestamp
+        # Ring buffer of (speaker, text) tuples, the oldest turn drops off once full
+        self.turns = deque(maxlen=max_turns)
+        self.context = None
+
+    def add_turn(self, speaker, text):
+        self.turns.append((speaker, text))
+
+    def last_user_text(self):
+        for speaker, text in reversed(self.turns):
+            if speaker == USER:
+                return text
+        return None
+
+    def idle_seconds(self):
+        return time.time() - self.timestamp
+
+    def to_dict(self):
+        return {
+            "id": self.session_id,
+            "ts": self.timestamp,
+            "max": self.turns.maxlen,
+            "turns": list(self.turns),
+            "context": self.context
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        session = cls(data["id"], data["max"], timestamp=data["ts"])
+        session.turns.extend(tuple(turn) for turn in data["turns"])
+        session.context = data.get("context")
+        return session
+
+    def __str__(self):
+        return "Session {\'" + str(self.session_id) + "\'} last used at {\'" + str(self.timestamp) + "\'} with " + str(len(self.turns)) + " turns"
@@ -0,0 +1,161 @@
+"""
+JSON decoding of the events, button clicks and upstream answers the bot receives, and encoding of the payloads it
+sends. DECODER and ENCODER in [JSON] pick the library, AUTO uses orjson or ujson when one is installed and the
+standard json module otherwise. Payloads are encoded straight to UTF-8 bytes, and the parts of them that never
+change are encoded once with Template
+"""
+
+import json
+
+import settings
+
+LOGGER = settings.get_logger("codec")
+
+# Tried in order by AUTO
+DECODERS = ("ORJSON", "UJSON", "JSON")
+ENCODERS = ("ORJSON", "UJSON", "JSON")
+
+_DECODER_NAME = None
+_LOADS = json.loads
+_ENCODER_NAME = None
+_DUMPS = None
+
+
+def get_decoder(name):
+    """Returns the loads function of a decoder, None when its library isn't installed"""
+
+    try:
+        if name == "ORJSON":
+            import orjson
+            return orjson.loads
+        if name == "UJSON":
+            import ujson
+            return ujson.loads
+    except ImportError:
+        return None
+    if name == "JSON":
+        return json.loads
+    raise ValueError("Unknown JSON decoder '" + name + "', expecting AUTO, " + ", ".join(DECODERS))
+
+
+def set_decoder(name):
+    """Decodes with ORJSON, UJSON or JSON from now on, AUTO the first of them that is installed"""
+
+    global _DECODER_NAME, _LOADS
+
+    for each_name in (DECODERS if name == "AUTO" else (name,)):
+        decoder = get_decoder(each_name)
+        if decoder is not None:
+            _DECODER_NAME, _LOADS = each_name, decoder
+            return each_name
+
+    LOGGER.warning("JSON decoder " + name + " isn't installed, using json")
+    _DECODER_NAME, _LOADS = "JSON", json.loads
+    return _DECODER_NAME
+
+
+def get_decoder_name():
+    return _DECODER_NAME
+
+
+def loads(data):
+    """Decodes a JSON document from str or bytes, raises ValueError when it isn't valid JSON"""
+
+    return _LOADS(data)
+
+
+# made once, json.dumps makes a new encoder on every call with these options
+_JSON_ENCODER = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+
+def _json_dumps(value):
+    return _JSON_ENCODER.encode(value).encode("utf-8")
+
+
+def get_encoder(name):
+    """Returns a function encoding a value as compact UTF-8 JSON bytes, None when its library isn't installed"""
+
+    try:
+        if name == "ORJSON":
+            import orjson
+            return orjson.dumps
+        if name == "UJSON":
+            import ujson
+            return lambda value: ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False).encode("utf-8")
+    except ImportError:
+        return None
+    if name == "JSON":
+        return _json_dumps
+    raise ValueError("Unknown JSON encoder '" + name + "', expecting AUTO, " + ", ".join(ENCODERS))
+
+
+def set_encoder(name):
+    """Encodes with ORJSON, UJSON or JSON from now on, AUTO the first of them that is installed"""
+
+    global _ENCODER_NAME, _DUMPS
+
+    for each_name in (ENCODERS if name == "AUTO" else (name,)):
+        encoder = get_encoder(each_name)
+        if encoder is not None:
+            _ENCODER_NAME, _DUMPS = each_name, encoder
+            return each_name
+
+    LOGGER.warning("JSON encoder " + name + " isn't installed, using json")
+    _ENCODER_NAME, _DUMPS = "JSON", _json_dumps
+    return _ENCODER_NAME
+
+
+def get_encoder_name():
+    return _ENCODER_NAME
+
+
+def dumps(value):
+    """Encodes value as compact UTF-8 JSON bytes, an Encoded dict from its template"""
+
+    if type(value) is Encoded:
+        return value.encode()
+    try:
+        return _DUMPS(value)
+    except TypeError:
+        # orjson only takes str keys and 64 bit ints, json takes the rest
+        return _json_dumps(value)
+
+
+class Template(object):
+    """JSON encoded once with a value filled in at each %s every time it is used, ex:
+    Template('{"metadata":{"deployment":"slackbot"},"text":%s}').render("hi")"""
+
+    __slots__ = ("parts",)
+
+    def __init__(self, text):
+        self.parts = text.encode("utf-8").split(b"%s")
+        # fails now rather than on the first message if the template isn't JSON
+        json.loads(b"null".join(self.parts))
+
+    def render(self, *values):
+        """Returns the JSON bytes with each value encoded in place of its %s"""
+
+        chunks = [self.parts[0]]
+        for value, part in zip(values, self.parts[1:]):
+            chunks.append(dumps(value))
+            chunks.append(part)
+        return b"".join(chunks)
+
+
+class Encoded(dict):
+    """A dict also described by a Template and the values filled into it, dumps renders the template instead of
+    encoding the dict. It must not be changed once made"""
+
+    __slots__ = ("template", "values")
+
+    def __init__(self, value, template, *values):
+        super(Encoded, self).__init__(value)
+        self.template = template
+        self.values = values
+
+    def encode(self):
+        return self.template.render(*self.values)
+
+
+set_decoder(settings.JSON_DECODER)
+set_encoder(settings.JSON_ENCODER)
@@ -0,0 +1,163 @@
+"""
+De-duplication of the events slack sends. Slack retries an event that wasn't acknowledged within 3 seconds up to three
+times, right away, after a minute and after five minutes, so every event_id is remembered for EVENT_TIMEOUT_MS by an
+8 byte hash. With the cache TYPE LOCAL the hashes are kept in a fixed size table in memory shared by every worker
+forked from the process that imported this module, with REDIS in the shared store
+"""
+
+import hashlib
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
+
+import cache
+import metrics
+import settings
+import upstream
+
+LOGGER = settings.get_logger("dedup")
+
+# A slot is an event's hash and when it expires, a hash of 0 marks an empty slot
+_SLOT = struct.Struct("<Qd")
+# Slots looked at for an event before the one expiring first is reused
+_PROBES = 16
+
+_LOCK = threading.Lock()
+_EVENTS = 0
+_RETRIES = 0
+_DUPLICATES = 0
+_HANDLED_RETRIES = 0
+
+
+class SharedTable(object):
+    """Open addressing hash table of event hashes with an expiry each, in an anonymous shared memory map so workers
+    forked after it was made see each other's events. When every probed slot is in use the one expiring first is
+    reused, so it never grows past 2 slots per max_size event"""
+
+    def __init__(self, max_size, ttl):
+        self.ttl = ttl
+        self.slots = 1 << max(4, (max_size * 2 - 1).bit_length())
+        self.mask = self.slots - 1
+        self.memory = mmap.mmap(-1, self.slots * _SLOT.size)
+        self.lock = multiprocessing.Lock()
+        self.evictions = 0
+
+    def _find(self, key):
+        """Returns the slot holding key, or the slot to store it in and False"""
+
+        now = time.time()
+        free = None
+        oldest = None
+        oldest_expires = None
+        for probe in range(_PROBES):
+            slot = (key + probe) & self.mask
+            slot_key, expires = _SLOT.unpack_from(self.memory, slot * _SLOT.size)
+            if slot_key == key and expires > now:
+                return slot, True
+            if slot_key == 0 or expires <= now:
+                if free is None:
+                    free = slot
+            elif oldest is None or expires < oldest_expires:
+                oldest, oldest_expires = slot, expires
+        return (oldest if free is None else free), False
+
+    def add(self, key, value=None, ttl=None):
+        """Stores key, returns False if it was already stored and hasn't expired"""
+
+        # 0 marks an empty slot
+        key = key or 1
+        with self.lock:
+            slot, found = self._find(key)
+            if found:
+                return False
+            old_key, old_expires = _SLOT.unpack_from(self.memory, slot * _SLOT.size)
+            if old_key and old_expires > time.time():
+                self.evictions += 1
+            _SLOT.pack_into(self.memory, slot * _SLOT.size, key, time.time() + (self.ttl if ttl is None else ttl))
+            return True
+
+    def pop(self, key, default=None):
+        """Forgets key"""
+
+        key = key or 1
+        with self.lock:
+            slot, found = self._find(key)
+            if found:
+                _SLOT.pack_into(self.memory, slot * _SLOT.size, 0, 0.0)
+        return default
+
+    def stats(self):
+        """Returns how many slots hold an event that hasn't expired, out of how many"""
+
+        now = time.time()
+        size = sum(1 for slot_key, expires in _SLOT.iter_unpack(self.memory) if slot_key and expires > now)
+        return {"size": size, "slots": self.slots, "evictions": self.evictions}
+
+
+if settings.TYPE == 'REDIS':
+    SEEN = cache.new_cache("event", settings.MAX_EVENT_CACHE, ttl=settings.EVENT_TIMEOUT_MS / 1000)
+else:
+    SEEN = SharedTable(settings.MAX_EVENT_CACHE, settings.EVENT_TIMEOUT_MS / 1000)
+
+
+def get_key(event_id):
+    """Returns the fixed size key an event_id is remembered by, the first 8 bytes of its hash as an int"""
+
+    return int.from_bytes(hashlib.blake2b(event_id.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def seen(event_id, event_type, retry_num=None, retry_reason=None):
+    """Remembers event_id, returns True if it was already seen and shouldn't be handled again. retry_num and
+    retry_reason are the X-Slack-Retry-Num and X-Slack-Retry-Reason headers, or Socket Mode's retry_attempt and
+    retry_reason"""
+
+    global _EVENTS, _RETRIES, _DUPLICATES, _HANDLED_RETRIES
+
+    try:
+        repeated = not SEEN.add(get_key(event_id), 1)
+    except upstream.UpstreamUnavailableError as ex:
+        # the shared store is down, answering an event twice beats not answering it
+        LOGGER.warning("Can't check if event " + event_id + " was seen: " + str(ex))
+        repeated = False
+
+    with _LOCK:
+        _EVENTS += 1
+        if retry_num:
+            _RETRIES += 1
+            # a retry of an event that was forgotten, or that never reached this bot, is handled
+            if not repeated:
+                _HANDLED_RETRIES += 1
+        if repeated:
+            _DUPLICATES += 1
+
+    if retry_num:
+        metrics.EVENT_RETRIES.inc(reason=retry_reason or "unknown")
+    if repeated:
+        metrics.EVENTS_DEDUPED.inc(event_type=metrics.get_event_type(event_type))
+    return repeated
+
+
+def forget(event_id):
+    """Forgets event_id so slack's retry of it is handled, for events that couldn't be queued"""
+
+    try:
+        SEEN.pop(get_key(event_id), None)
+    except upstream.UpstreamUnavailableError as ex:
+        LOGGER.warning("Can't forget event " + event_id + ": " + str(ex))
+
+
+def stats():
+    """Returns this process's counts of events seen, retries, duplicates dropped and retries that were handled,
+    and the size of the table or shared store cache"""
+
+    return {
+        "events": _EVENTS,
+        "retries": _RETRIES,
+        "duplicates": _DUPLICATES,
+        "handled_retries": _HANDLED_RETRIES,
+        "retry_rate": round(_RETRIES / _EVENTS, 4) if _EVENTS else 0.0,
+        "duplicate_rate": round(_DUPLICATES / _EVENTS, 4) if _EVENTS else 0.0,
+        "seen": SEEN.stats()
+    }
@@ -0,0 +1,370 @@
+"""
+Outbound delivery queue for messages to Slack, rate limited per channel and per method with token buckets.
+Direct messages go before channel threads, messages to the same channel keep their order and 429s are retried
+after the Retry-After slack asks for
+"""
+
+import os
+import threading
+import time
+import traceback
+
+import settings
+import capture
+import codec
+import http_client
+import logs
+import metrics
+import tracing
+
+LOGGER = settings.get_logger("delivery")
+
+# Lower goes first
+PRIORITY_DIRECT = 0
+PRIORITY_CHANNEL = 1
+
+# Stage each method's sends are timed as in /metrics
+STAGES = {
+    "chat.postMessage": "post_to_slack",
+    "response_url": "send_message"
+}
+
+# Methods slack rate limits per channel, a 429 holds back only the channel it was for
+CHANNEL_LIMITED_METHODS = ("chat.postMessage",)
+
+# How often buckets of channels that went quiet are dropped, a new one starts full just like them
+PRUNE_SECONDS = 60
+
+
+class TokenBucket(object):
+    """Allows rate sends per second with bursts of up to capacity, can be paused when slack asks to back off"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def ready_at(self, now):
+        """Returns when a send is allowed, now or later"""
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return max(now, self.paused_until)
+        return max(now + (1 - self.tokens) / self.rate, self.paused_until)
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, until):
+        self.paused_until = max(self.paused_until, until)
+
+    def is_idle(self, now):
+        """Returns True when the bucket is full and not paused, so it can be dropped and made again when needed"""
+
+        return self.ready_at(now) <= now and self.tokens >= self.capacity
+
+
+class Delivery(object):
+    """One message waiting to be sent"""
+
+    __slots__ = ("url", "payload", "headers", "key", "method", "priority", "seq", "attempts", "not_before", "queued_at",
+                 "trace")
+
+    def __init__(self, url, payload, headers, key, method, priority, seq):
+        self.url = url
+        self.payload = payload
+        self.headers = headers
+        self.key = key
+        self.method = method
+        self.priority = priority
+        self.seq = seq
+        self.attempts = 0
+        self.not_before = 0.0
+        self.queued_at = time.perf_counter()
+        # the span that sent it, the post is recorded in the same trace
+        self.trace = tracing.current()
+
+
+class DeliveryQueue(object):
+    """Sends queued messages on a few worker threads, one message in flight per channel so they arrive in order"""
+
+    def __init__(self, workers, max_queue, channel_rate, channel_burst, method_rates, default_method_rate,
+                 max_retries, retry_seconds):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.method_rates = method_rates
+        self.default_method_rate = default_method_rate
+        self.max_retries = max_retries
+        self.retry_seconds = retry_seconds
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._pid = None
+        self._threads = []
+        self._stopping = False
+        # channel -> deliveries waiting, in the order they were sent
+        self._channels = {}
+        self._busy = set()
+        self._channel_buckets = {}
+        self._method_buckets = {}
+        self._prune_at = 0.0
+        self._size = 0
+        self._seq = 0
+        self._queued = 0
+        self._delivered = 0
+        self._retries = 0
+        self._rate_limited = 0
+        self._failed = 0
+        self._dropped = 0
+
+    def _ensure_started(self):
+        """Starts the workers on first use, and again in a forked child where the threads don't survive"""
+
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._channels = {}
+            self._busy = set()
+            self._size = 0
+            self._stopping = False
+            self._threads = []
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._work, name="delivery-" + str(number), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def send(self, url, payload, headers, key, method, priority=PRIORITY_CHANNEL):
+        """Queues a POST of payload to url, key is the channel it goes to, returns False if the queue is full"""
+
+        self._ensure_started()
+
+        with self._lock:
+            if self._size >= self.max_queue:
+                self._dropped += 1
+                LOGGER.warning("Delivery queue is full, dropping message to " + str(key))
+                return False
+            self._seq += 1
+            delivery = Delivery(url, payload, headers, key, method, priority, self._seq)
+            self._channels.setdefault(key, []).append(delivery)
+            self._size += 1
+            self._queued += 1
+            self._ready.notify()
+        return True
+
+    def _bucket(self, buckets, name, rate, burst):
+        bucket = buckets.get(name)
+        if bucket is None:
+            bucket = buckets[name] = TokenBucket(rate, burst)
+        return bucket
+
+    def _prune(self, now):
+        """Drops the buckets of channels with nothing waiting or sending that are full again, caller holds the lock"""
+
+        self._prune_at = now + PRUNE_SECONDS
+        for key in [key for key, bucket in self._channel_buckets.items()
+                    if key not in self._channels and key not in self._busy and bucket.is_idle(now)]:
+            del self._channel_buckets[key]
+
+    def _next(self):
+        """Waits for the most urgent delivery slack's limits allow now, caller holds the lock, None when stopping"""
+
+        while True:
+            now = time.monotonic()
+            if now >= self._prune_at:
+                self._prune(now)
+            best = None
+            wake_at = None
+
+            for key, waiting in self._channels.items():
+                if key in self._busy:
+                    continue
+                head = waiting[0]
+                channel_bucket = self._bucket(self._channel_buckets, key, self.channel_rate, self.channel_burst)
+                method_rate = self.method_rates.get(head.method, self.default_method_rate)
+                method_bucket = self._bucket(self._method_buckets, head.method, method_rate, max(1, method_rate))
+                ready_at = max(head.not_before, channel_bucket.ready_at(now), method_bucket.ready_at(now))
+                if ready_at > now:
+                    wake_at = ready_at if wake_at is None else min(wake_at, ready_at)
+                elif best is None or (head.priority, head.seq) < (best[0].priority, best[0].seq):
+                    best = (head, channel_bucket, method_bucket)
+
+            if best is not None:
+                head, channel_bucket, method_bucket = best
+                channel_bucket.take()
+                method_bucket.take()
+                waiting = self._channels[head.key]
+                waiting.pop(0)
+                if not waiting:
+                    del self._channels[head.key]
+                self._size -= 1
+                self._busy.add(head.key)
+                return head
+
+            if self._stopping and not self._channels:
+                return None
+
+            self._ready.wait(None if wake_at is None else wake_at - now)
+
+    def _work(self):
+        """Worker loop, sends deliveries until the queue is stopped and empty"""
+
+        while True:
+            with self._lock:
+                delivery = self._next()
+            if delivery is None:
+                return
+
+            retry_after = None
+            try:
+                retry_after = self._post(delivery)
+            except Exception:
+                LOGGER.error(traceback.format_exc())
+                with self._lock:
+                    self._failed += 1
+            finally:
+                with self._lock:
+                    # freed whatever happened, the channel's later messages wait while it is busy
+                    self._busy.discard(delivery.key)
+                    if retry_after is not None:
+                        delivery.attempts += 1
+                        if delivery.attempts > self.max_retries:
+                            self._dropped += 1
+                            LOGGER.error("Giving up on message to " + str(delivery.key) + " after " + str(delivery.attempts) + " attempts")
+                        else:
+                            self._retries += 1
+                            delivery.not_before = time.monotonic() + retry_after
+                            # back at the head of its channel so later messages stay behind it
+                            self._channels.setdefault(delivery.key, []).insert(0, delivery)
+                            self._size += 1
+                    self._ready.notify_all()
+
+    def _post(self, delivery):
+        """Sends a delivery, returns seconds to wait before retrying it, or None when it's done"""
+
+        if delivery.attempts == 0:
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - delivery.queued_at, stage="delivery_queue")
+
+        started = time.perf_counter()
+        try:
+            with metrics.timed(STAGES.get(delivery.method, delivery.method), delivery.trace):
+                response = http_client.request("POST", delivery.url, data=delivery.payload, headers=delivery.headers,
+                                               timeout=(settings.HTTP_CONNECT_TIMEOUT, settings.UPSTREAM_TIMEOUTS['slack']))
+        except Exception:
+            LOGGER.error(traceback.format_exc())
+            capture.call(delivery.method, time.perf_counter() - started)
+            return self.retry_seconds * (2 ** delivery.attempts)
+
+        capture.call(delivery.method, time.perf_counter() - started, response.status_code)
+
+        if response.status_code == 429:
+            retry_after = float(response.headers.get("Retry-After", self.retry_seconds))
+            with self._lock:
+                self._rate_limited += 1
+                # hold back every message the limit slack hit applies to, the channel's or the method's
+                if delivery.method in CHANNEL_LIMITED_METHODS:
+                    bucket = self._bucket(self._channel_buckets, delivery.key, self.channel_rate, self.channel_burst)
+                else:
+                    bucket = self._bucket(self._method_buckets, delivery.method, self.default_method_rate, 1)
+                bucket.pause(time.monotonic() + retry_after)
+            LOGGER.warning("Slack rate limited " + delivery.method + " to " + str(delivery.key) + ", retrying in " +
+                           str(retry_after) + "s")
+            return retry_after
+
+        if response.status_code >= 500:
+            return self.retry_seconds * (2 ** delivery.attempts)
+
+        LOGGER.debug("Slack Response: %s", logs.Lazy(getattr, response, "text"))
+
+        delivered = response.ok
+        if delivered and delivery.method == "chat.postMessage":
+            # a proxy in the way can answer 200 with an error page
+            try:
+                delivered = bool(codec.loads(response.content).get("ok"))
+            except (ValueError, AttributeError):
+                delivered = False
+
+        with self._lock:
+            if delivered:
+                self._delivered += 1
+            else:
+                self._failed += 1
+                LOGGER.error("Slack refused message to " + str(delivery.key) + ": " + response.text)
+        return None
+
+    def shutdown(self, timeout=None):
+        """Stops taking messages and waits up to timeout seconds for the queued ones to be sent"""
+
+        if self._pid != os.getpid():
+            return True
+
+        with self._lock:
+            self._stopping = True
+            self._ready.notify_all()
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            thread.join(remaining)
+
+        drained = not any(thread.is_alive() for thread in self._threads)
+        self._pid = None
+        return drained
+
+    def stats(self):
+        """Returns queue size and delivery, retry and drop counters"""
+
+        with self._lock:
+            return {
+                "queue_size": self._size,
+                "channels_waiting": len(self._channels),
+                "channel_buckets": len(self._channel_buckets),
+                "queued": self._queued,
+                "delivered": self._delivered,
+                "retries": self._retries,
+                "rate_limited": self._rate_limited,
+                "failed": self._failed,
+                "dropped": self._dropped
+            }
+
+
+QUEUE = DeliveryQueue(settings.DELIVERY_WORKERS, settings.DELIVERY_MAX_QUEUE, settings.DELIVERY_CHANNEL_RATE,
+                      settings.DELIVERY_CHANNEL_BURST, settings.DELIVERY_METHOD_RATES, settings.DELIVERY_DEFAULT_METHOD_RATE,
+                      settings.DELIVERY_MAX_RETRIES, settings.DELIVERY_RETRY_SECONDS)
+
+
+def get_priority(channel):
+    """Direct message channel ids start with D, they go before channels"""
+
+    return PRIORITY_DIRECT if str(channel).startswith("D") else PRIORITY_CHANNEL
+
+
+def send(url, payload, headers, key, method, priority=PRIORITY_CHANNEL):
+    """Queues a message on the shared delivery queue, or sends it right away when the queue is disabled"""
+
+    if not settings.DELIVERY_ENABLED:
+        with metrics.timed(STAGES.get(method, method)):
+            response = http_client.request("POST", url, data=payload, headers=headers)
+        LOGGER.debug("Slack Response: %s", logs.Lazy(getattr, response, "text"))
+        return True
+
+    return QUEUE.send(url, payload, headers, key, method, priority)
+
+
+def shutdown(timeout=None):
+    """Sends what is queued, waiting up to timeout seconds"""
+    return QUEUE.shutdown(timeout)
+
+
+def stats():
+    """Returns the shared delivery queue stats"""
+    return QUEUE.stats()
@@ -0,0 +1,216 @@
+"""
+Bounded in-process job queue and worker pool, lets the endpoints acknowledge slack before the conversation is handled.
+Jobs submitted with a lane, ex: a slack user, run one at a time in order while different lanes run in parallel
+"""
+
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+import settings
+
+LOGGER = settings.get_logger("dispatcher")
+
+# What submit did with a job, only REJECTED is false so callers can test the result as a bool
+REJECTED = 0
+QUEUED = 1
+# merged into a job with the same coalesce_key already waiting, it will never run
+COALESCED = 2
+
+
+class Dispatcher(object):
+    """Runs submitted jobs on a fixed pool of daemon threads fed from a bounded queue"""
+
+    def __init__(self, pool_size, max_queue, lane_max_queue=10):
+        self.pool_size = pool_size
+        self.max_queue = max_queue
+        self.lane_max_queue = lane_max_queue
+        self._lock = threading.Lock()
+        # lanes with a job queued or running -> jobs waiting behind it
+        self._lanes = {}
+        self._queue = None
+        self._threads = []
+        self._pid = None
+        self._in_flight = 0
+        self._submitted = 0
+        self._rejected = 0
+        self._completed = 0
+        self._failed = 0
+        self._coalesced = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _ensure_started(self):
+        """Starts the workers on first use, and again in a forked child where the threads don't survive"""
+
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._lanes = {}
+            self._threads = []
+            self._in_flight = 0
+            for number in range(self.pool_size):
+                thread = threading.Thread(target=self._work, name="dispatcher-" + str(number), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def submit(self, func, *args, lane=None, coalesce_key=None):
+        """Queues func(*args) for a worker, returns QUEUED, or REJECTED when the queue or the job's lane is full.
+        Jobs in the same lane run in the order submitted, a job whose coalesce_key matches one still waiting in its
+        lane is dropped as a duplicate and COALESCED returned"""
+
+        self._ensure_started()
+
+        job = (time.monotonic(), func, args, lane, coalesce_key)
+
+        if lane is not None:
+            with self._lock:
+                waiting = self._lanes.get(lane)
+                if waiting is not None:
+                    # the lane is busy, wait behind its running job
+                    if coalesce_key is not None and any(each_job[4] == coalesce_key for each_job in waiting):
+                        self._coalesced += 1
+                        LOGGER.debug("Coalesced duplicate job in lane %s", lane)
+                        return COALESCED
+                    if len(waiting) >= self.lane_max_queue:
+                        self._rejected += 1
+                        LOGGER.warning("Dispatcher lane " + str(lane) + " is full, rejecting job " + getattr(func, "__name__", str(func)))
+                        return REJECTED
+                    waiting.append(job)
+                    self._submitted += 1
+                    return QUEUED
+                # queued while holding the lock, so no job can wait behind the lane before it is known to be queued
+                if not self._put(job):
+                    return REJECTED
+                self._lanes[lane] = deque()
+                self._submitted += 1
+                return QUEUED
+
+        with self._lock:
+            if not self._put(job):
+                return REJECTED
+            self._submitted += 1
+            return QUEUED
+
+    def _put(self, job):
+        """Queues a job for a worker without waiting, returns False when the queue is full, caller holds the lock"""
+
+        try:
+            self._queue.put_nowait(job)
+            return True
+        except queue.Full:
+            self._rejected += 1
+            LOGGER.warning("Dispatcher queue is full, rejecting job " + getattr(job[1], "__name__", str(job[1])))
+            return False
+
+    def _work(self):
+        """Worker loop, runs jobs until a None sentinel is received"""
+
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+
+            # keep running the lane's waiting jobs on this worker so they stay in order
+            while job is not None:
+                self._run(job)
+                job = self._next_in_lane(job[3])
+
+            self._queue.task_done()
+
+    def _run(self, job):
+        """Runs one job, keeping the wait time and job counters"""
+
+        queued_at, func, args, lane, coalesce_key = job
+        waited = time.monotonic() - queued_at
+
+        with self._lock:
+            self._in_flight += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+        try:
+            func(*args)
+            failed = False
+        except Exception:
+            LOGGER.error(traceback.format_exc())
+            failed = True
+
+        with self._lock:
+            self._in_flight -= 1
+            self._completed += 1
+            if failed:
+                self._failed += 1
+
+    def _next_in_lane(self, lane):
+        """Returns the next job waiting in lane, or None after releasing the lane when nothing is waiting"""
+
+        if lane is None:
+            return None
+
+        with self._lock:
+            waiting = self._lanes.get(lane)
+            if waiting:
+                return waiting.popleft()
+            self._lanes.pop(lane, None)
+            return None
+
+    def shutdown(self, timeout=None):
+        """Stops taking jobs and waits up to timeout seconds for queued and running jobs to finish"""
+
+        if self._pid != os.getpid():
+            return True
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for _ in self._threads:
+            # blocks while the queue is full so every worker gets its sentinel after the queued jobs
+            self._queue.put(None)
+        for thread in self._threads:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            thread.join(remaining)
+
+        drained = not any(thread.is_alive() for thread in self._threads)
+        self._pid = None
+        return drained
+
+    def stats(self):
+        """Returns queue depth, wait times and job counters"""
+
+        with self._lock:
+            started = self._completed + self._in_flight
+            return {
+                "pool_size": self.pool_size,
+                "max_queue": self.max_queue,
+                "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+                "in_flight": self._in_flight,
+                "submitted": self._submitted,
+                "rejected": self._rejected,
+                "completed": self._completed,
+                "failed": self._failed,
+                "lanes": len(self._lanes),
+                "lane_depth_max": max((len(waiting) for waiting in self._lanes.values()), default=0),
+                "coalesced": self._coalesced,
+                "wait_avg_ms": round(self._wait_total / started * 1000, 3) if started else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3)
+            }
+
+
+DISPATCHER = Dispatcher(settings.WORKER_POOL_SIZE, settings.WORKER_MAX_QUEUE, settings.WORKER_LANE_MAX_QUEUE)
+
+
+def submit(func, *args, lane=None, coalesce_key=None):
+    """Queues a job on the shared dispatcher, returns QUEUED, COALESCED or REJECTED"""
+    return DISPATCHER.submit(func, *args, lane=lane, coalesce_key=coalesce_key)
+
+
+def stats():
+    """Returns the shared dispatcher stats"""
+    return DISPATCHER.stats()
@@ -0,0 +1,108 @@
+"""
+Shared keep-alive HTTP clients, one connection pool per upstream host, used for every outbound call
+"""
+
+import os
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import settings
+
+LOGGER = settings.get_logger("http_client")
+
+_LOCK = threading.Lock()
+_SESSIONS = {}
+_PID = None
+_POOL_HITS = 0
+_POOL_MISSES = 0
+
+
+def _host_limit(host):
+    """Returns the max number of kept-alive connections for a host"""
+
+    return settings.HTTP_HOST_MAXSIZE.get(host, settings.HTTP_POOL_MAXSIZE)
+
+
+def _new_session(host):
+    """Creates a requests session with a connection pool sized for the host"""
+
+    maxsize = _host_limit(host)
+    adapter = HTTPAdapter(
+        pool_connections=settings.HTTP_POOL_CONNECTIONS,
+        pool_maxsize=maxsize,
+        pool_block=settings.HTTP_POOL_BLOCK
+    )
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    LOGGER.debug("Created connection pool for " + host + " with " + str(maxsize) + " connections")
+
+    return session
+
+
+def get_session(url):
+    """Returns the shared session for the url's host, creating it on first use"""
+
+    global _PID, _POOL_HITS, _POOL_MISSES
+
+    parts = urlsplit(url)
+    key = parts.scheme + "://" + parts.netloc
+
+    with _LOCK:
+        # connections opened before a fork can't be shared with the child, start over
+        if _PID != os.getpid():
+            _SESSIONS.clear()
+            _PID = os.getpid()
+
+        session = _SESSIONS.get(key)
+        if session is None:
+            _POOL_MISSES += 1
+            session = _new_session(parts.hostname or "")
+            _SESSIONS[key] = session
+        else:
+            _POOL_HITS += 1
+
+    return session
+
+
+def request(method, url, **kwargs):
+    """Drop in replacement for requests.request that goes through the pooled session for the host, with a timeout
+    unless one is given"""
+
+    kwargs.setdefault("timeout", (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_TIMEOUT))
+    return get_session(url).request(method, url, **kwargs)
+
+
+def stats():
+    """Returns pool hit/miss counters and per host connection reuse"""
+
+    with _LOCK:
+        sessions = dict(_SESSIONS) if _PID == os.getpid() else {}
+        result = {
+            "pool_hits": _POOL_HITS,
+            "pool_misses": _POOL_MISSES,
+            "hosts": {}
+        }
+
+    for key, session in sessions.items():
+        connections = 0
+        requests_sent = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in list(pools.keys()):
+                pool = pools.get(pool_key)
+                if pool is not None:
+                    connections += pool.num_connections
+                    requests_sent += pool.num_requests
+        result["hosts"][key] = {
+            "connections_opened": connections,
+            "requests": requests_sent,
+            "connections_reused": max(0, requests_sent - connections)
+        }
+
+    return result
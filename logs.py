@@ -0,0 +1,183 @@
+"""
+Non-blocking logging, every logger from settings.get_logger puts its records on one queue per process and a
+background thread writes them to stderr as JSON lines, so a turn never waits on stderr. Messages are only built
+for records that pass the level and the logger's sample rate, Lazy arguments and serializing happen on the writer
+thread
+"""
+
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+
+# Attributes every LogRecord has, anything else was passed with extra= and is written as a field of its own
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None)).keys()) | {"message", "asctime"}
+
+_LOCK = threading.Lock()
+_PID = None
+_QUEUE = None
+_LISTENER = None
+_DROPPED = 0
+_SAMPLED_OUT = 0
+
+
+def _parse_rates(text):
+    """Parses comma separated logger=rate pairs, ex: main=0.1,delivery=0.01"""
+
+    rates = {}
+    for pair in (text or "").split(","):
+        if "=" in pair:
+            name, rate = pair.split("=", 1)
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object with its time, level, logger, message, exception and extra fields"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "pid": record.process,
+            "thread": record.threadName
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+def _get_formatter():
+    """LOGGING_FORMAT json writes one JSON object per line, text the plain "time level: message" lines"""
+
+    if os.getenv("LOGGING_FORMAT", "json").lower() == "text":
+        return logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
+    return JsonFormatter()
+
+
+def _ensure_started():
+    """Starts the writer thread on first use, and again in a forked child since threads don't survive a fork"""
+
+    global _PID, _QUEUE, _LISTENER
+
+    if _PID == os.getpid():
+        return
+
+    with _LOCK:
+        if _PID == os.getpid():
+            return
+
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(_get_formatter())
+
+        # records waiting to be written, more are dropped rather than slowing turns down
+        _QUEUE = queue.Queue(int(os.getenv("LOGGING_MAX_QUEUE", "10000")))
+        _LISTENER = logging.handlers.QueueListener(_QUEUE, handler)
+        _LISTENER.start()
+        # write out what is still queued when the process exits
+        atexit.register(_LISTENER.stop)
+        _PID = os.getpid()
+
+
+# Log arguments that can't change once the caller returns, they are kept as they are until the record is written
+_IMMUTABLE = (str, bytes, int, float, bool, type(None))
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Puts records on the writer's queue without waiting, dropping them when it is full. Unlike the stdlib handler
+    it only fills in the message here, the formatting happens on the writer thread"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+
+    def prepare(self, record):
+        # the args may be changed by the caller once it returns, so the message is built now, unless some are Lazy,
+        # then only the others that could change are turned into strings and the message is built when written
+        if isinstance(record.args, tuple) and any(isinstance(arg, Lazy) for arg in record.args):
+            record.args = tuple(arg if isinstance(arg, (Lazy,) + _IMMUTABLE) else str(arg) for arg in record.args)
+        elif record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        global _DROPPED
+
+        _ensure_started()
+        try:
+            _QUEUE.put_nowait(record)
+        except queue.Full:
+            _DROPPED += 1
+
+
+class _SamplingFilter(logging.Filter):
+    """Keeps rate of a logger's debug records, every record at INFO and above"""
+
+    def __init__(self, rate):
+        super(_SamplingFilter, self).__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        global _SAMPLED_OUT
+
+        if record.levelno > logging.DEBUG or random.random() < self.rate:
+            return True
+        _SAMPLED_OUT += 1
+        return False
+
+
+_HANDLER = _QueueHandler()
+
+
+def configure(logger):
+    """Points a logger at the writer's queue, at LOGGING_LEVEL and with its LOGGING_SAMPLE rate, ex: main=0.1 keeps
+    one in ten of main's debug records. Read when the logger is made so .env files loaded before count"""
+
+    logger.handlers.clear()
+    logger.filters.clear()
+    logger.setLevel(os.getenv("LOGGING_LEVEL", "ERROR").upper())
+    logger.propagate = False
+    logger.addHandler(_HANDLER)
+
+    rates = _parse_rates(os.getenv("LOGGING_SAMPLE"))
+    if logger.name in rates:
+        logger.addFilter(_SamplingFilter(rates[logger.name]))
+    return logger
+
+
+def stats():
+    """Returns how many records are waiting, were dropped on a full queue and were sampled out"""
+
+    return {
+        "queued": _QUEUE.qsize() if _QUEUE is not None and _PID == os.getpid() else 0,
+        "dropped": _DROPPED,
+        "sampled_out": _SAMPLED_OUT
+    }
+
+
+class Lazy(object):
+    """Stands in for a log argument that is costly to build, ex: LOGGER.debug("Response: %s", Lazy(json.dumps, body)),
+    func(*args) is only called on the writer thread when the record is written, so args mustn't be changed after
+    logging"""
+
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
@@ -0,0 +1,133 @@
+"""
+Latency histograms and counters for each stage of a turn, served by /metrics in the Prometheus text format.
+Metrics are kept per process, with several server workers each one reports its own
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from enum import Enum
+
+import tracing
+
+# Upper bounds in seconds, from a cache hit to a slow webhook
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names, values, extra=None):
+    pairs = [name + "=\"" + _escape(value) + "\"" for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(object):
+    """A count that only goes up, one per combination of label values"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.documentation, "# TYPE " + self.name + " counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(self.name + _labels(self.labelnames, key) + " " + repr(float(value)))
+        return lines
+
+
+class Histogram(object):
+    """Observed values counted into cumulative buckets, one set per combination of label values"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label values -> [count per bucket, sum, count]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.documentation, "# TYPE " + self.name + " histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(self.name + "_bucket" + _labels(self.labelnames, key, "le=\"" + repr(bound) + "\"") +
+                                 " " + repr(float(cumulative)))
+                lines.append(self.name + "_bucket" + _labels(self.labelnames, key, "le=\"+Inf\"") + " " + repr(float(count)))
+                lines.append(self.name + "_sum" + _labels(self.labelnames, key) + " " + repr(total))
+                lines.append(self.name + "_count" + _labels(self.labelnames, key) + " " + repr(float(count)))
+        return lines
+
+
+STAGE_SECONDS = Histogram("slackbot_stage_seconds", "Time spent in each stage of handling an event", ["stage"])
+USER_CONTEXT_LOOKUPS = Counter("slackbot_user_context_lookups_total", "User context lookups by cache result", ["result"])
+EVENTS_DEDUPED = Counter("slackbot_events_deduped_total", "Events slack sent again that were not handled twice", ["event_type"])
+EVENT_RETRIES = Counter("slackbot_event_retries_total", "Events slack sent again by retry reason", ["reason"])
+SESSIONS_EXPIRED = Counter("slackbot_sessions_expired_total", "Assistant sessions found expired and renewed", ["event_type"])
+ERRORS = Counter("slackbot_errors_total", "Errors handling events", ["event_type", "stage"])
+
+METRICS = [STAGE_SECONDS, USER_CONTEXT_LOOKUPS, EVENTS_DEDUPED, EVENT_RETRIES, SESSIONS_EXPIRED, ERRORS]
+
+
+@contextmanager
+def timed(stage, parent=None):
+    """Observes how long the block takes as stage, whether it succeeds or raises, and records it as a span of the
+    current trace, or of parent from tracing.current()"""
+
+    started = time.perf_counter()
+    try:
+        with tracing.span(stage, parent):
+            yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+
+def get_event_type(event_type):
+    """Returns the label for an EventType, ex: APP_MENTION"""
+
+    return event_type.name if isinstance(event_type, Enum) else str(event_type)
+
+
+def count_error(event_type, stage):
+    ERRORS.inc(event_type=get_event_type(event_type), stage=stage)
+
+
+def render():
+    """Returns every metric in the Prometheus text format"""
+
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
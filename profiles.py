@@ -0,0 +1,282 @@
+"""
+Slack profiles behind the userContext sent to the skill. A profile is cached for USER_TTL, then still used for up to
+USER_MAX_STALE while it is refreshed in the background. A lookup slack can't answer is cached for USER_NEGATIVE_TTL
+instead of being retried on every message, and the cache can be filled from users.list at startup and periodically
+"""
+
+import concurrent.futures
+import os
+import threading
+import time
+import traceback
+import urllib.parse
+
+import cache
+import codec
+import metrics
+import settings
+import upstream
+
+LOGGER = settings.get_logger("profiles")
+
+SLACK_FORM_HEADERS = {
+    'Content-Type': 'application/x-www-form-urlencoded'
+}
+
+# Marks the last warm up in cache.warm_cache, with a shared store only one worker warms it at a time
+WARM_KEY = "__warm__"
+
+_LOCK = threading.Lock()
+_PID = None
+_REFRESHER = None
+_REFRESHING = set()
+_REFRESHED = 0
+_REFRESH_FAILED = 0
+_WARMED = 0
+_WARM_RUNS = 0
+
+
+def get_slack_user_profile_url(slack_user):
+    """Returns the users.info url for a slack user"""
+
+    url = settings.SLACK_API_URL + "/users.info"
+    url += "?token=" + settings.SLACK_BOT_USER_TOKEN
+    url += "&user=" + slack_user
+
+    return url
+
+
+def get_slack_user_profile(slack_user):
+    """Returns a dictionary with the real name and email for the slack user after getting info from slack API"""
+
+    with metrics.timed("users_info"):
+        response = upstream.request("slack", "GET", get_slack_user_profile_url(slack_user),
+                                    retries=settings.UPSTREAM_RETRIES, headers=SLACK_FORM_HEADERS)
+
+    return read_users_info_response(response)
+
+
+def read_users_info_response(response):
+    """Returns the profile in a users.info response, {} when it has none or isn't JSON, ex: an error page"""
+
+    try:
+        response_json = codec.loads(response.content)
+    except ValueError:
+        response_json = {}
+    return read_slack_user_profile(response_json, response.text)
+
+
+def read_slack_user_profile(response_json, response_text):
+    """Returns the real name, email and timezone from a users.info response, or {} if they are missing"""
+
+    try:
+        user = {}
+        user["name"] = response_json["user"]["profile"]["real_name"]
+        user["email"] = response_json["user"]["profile"]["email"]
+        user["timezone"] = response_json["user"]["tz"]
+        return user
+    except:
+        LOGGER.error(response_text)
+        return {}
+
+
+def get_user_context_from_profile(user_profile):
+    """Returns the userContext for a profile returned by get_slack_user_profile, an empty one with the default
+    timezone for {}"""
+
+    if not user_profile:
+        return {"name": {"first": "", "last": ""}, "email": "", "timezone": settings.USER_DEFAULT_TIMEZONE}
+
+    # a single word name has no last name
+    first_name, _, last_name = user_profile["name"].partition(" ")
+
+    user_context = {}
+    user_context["name"] = {}
+    user_context["name"]["first"] = first_name
+    user_context["name"]["last"] = last_name
+    user_context["email"] = user_profile["email"]
+    user_context["timezone"] = user_profile["timezone"]
+
+    return user_context
+
+
+def get_cached(slack_user):
+    """Returns the cached userContext, or None when it has to be looked up. One past its time to live is still
+    returned and refreshed in the background"""
+
+    entry = cache.user_cache.get(slack_user)
+
+    # entries cached before profiles had a time to live are looked up again
+    if not isinstance(entry, dict) or "context" not in entry:
+        metrics.USER_CONTEXT_LOOKUPS.inc(result="miss")
+        return None
+
+    if entry["expires"] <= time.time():
+        metrics.USER_CONTEXT_LOOKUPS.inc(result="stale")
+        refresh_later(slack_user)
+    elif entry["ok"]:
+        metrics.USER_CONTEXT_LOOKUPS.inc(result="hit")
+    else:
+        metrics.USER_CONTEXT_LOOKUPS.inc(result="negative")
+
+    return entry["context"]
+
+
+def store(slack_user, user_profile):
+    """Caches the userContext of a profile from read_slack_user_profile and returns it, {} is cached as an
+    empty userContext for USER_NEGATIVE_TTL"""
+
+    ttl = settings.USER_TTL if user_profile else settings.USER_NEGATIVE_TTL
+    user_context = get_user_context_from_profile(user_profile)
+    entry = {"context": user_context, "ok": bool(user_profile), "expires": time.time() + ttl}
+    cache.user_cache.set(slack_user, entry, ttl=ttl + settings.USER_MAX_STALE)
+    return user_context
+
+
+def get_user_context(slack_user):
+    """Returns the userContext of a slack user from the cache, looking it up in slack on a miss"""
+
+    user_context = get_cached(slack_user)
+    if user_context is None:
+        user_context = store(slack_user, get_slack_user_profile(slack_user))
+    return user_context
+
+
+def _get_refresher():
+    """Returns this process's refresh threads, made again in a forked child since threads don't survive a fork"""
+
+    global _PID, _REFRESHER
+
+    if _PID != os.getpid():
+        with _LOCK:
+            if _PID != os.getpid():
+                _REFRESHER = concurrent.futures.ThreadPoolExecutor(settings.USER_REFRESH_THREADS,
+                                                                   thread_name_prefix="profile-refresh")
+                _REFRESHING.clear()
+                _PID = os.getpid()
+    return _REFRESHER
+
+
+def refresh_later(slack_user):
+    """Looks up a stale profile again in the background, once at a time per user"""
+
+    with _LOCK:
+        if slack_user in _REFRESHING:
+            return
+        _REFRESHING.add(slack_user)
+
+    _get_refresher().submit(_refresh, slack_user)
+
+
+def _refresh(slack_user):
+    """Caches a fresh profile, a failed lookup keeps the stale one until it is too old to use"""
+
+    global _REFRESHED, _REFRESH_FAILED
+
+    try:
+        user_profile = get_slack_user_profile(slack_user)
+        if user_profile:
+            store(slack_user, user_profile)
+            _REFRESHED += 1
+        else:
+            _REFRESH_FAILED += 1
+    except Exception:
+        _REFRESH_FAILED += 1
+        LOGGER.warning("Refreshing the profile of " + slack_user + " failed: " + traceback.format_exc())
+    finally:
+        with _LOCK:
+            _REFRESHING.discard(slack_user)
+
+
+def get_users_list_url(cursor=None):
+    """Returns the url of a users.list page, the first without cursor"""
+
+    url = settings.SLACK_API_URL + "/users.list"
+    url += "?token=" + settings.SLACK_BOT_USER_TOKEN
+    url += "&limit=" + str(settings.USER_WARM_PAGE_SIZE)
+    if cursor:
+        url += "&cursor=" + urllib.parse.quote(cursor)
+
+    return url
+
+
+def warm():
+    """Caches the profile of every active person in the workspace from users.list, up to MAX_USER_CACHE of them,
+    returns how many were cached. Skipped when another worker sharing the store warmed it recently"""
+
+    global _WARMED, _WARM_RUNS
+
+    interval = settings.USER_WARM_INTERVAL
+    if not cache.warm_cache.add(WARM_KEY, time.time(), ttl=interval / 2 if interval else settings.USER_TTL):
+        return 0
+
+    warmed = 0
+    cursor = None
+    while warmed < settings.MAX_USER_CACHE:
+        with metrics.timed("users_list"):
+            response = upstream.request("slack", "GET", get_users_list_url(cursor), retries=settings.UPSTREAM_RETRIES,
+                                        headers=SLACK_FORM_HEADERS)
+        if response.status_code == 429:
+            # users.list is rate limited to a few pages a minute, wait as long as slack asks
+            time.sleep(int(response.headers.get("Retry-After", "30")))
+            continue
+
+        try:
+            response_json = codec.loads(response.content)
+        except ValueError:
+            response_json = {}
+        if not isinstance(response_json, dict) or not response_json.get("ok"):
+            LOGGER.error("Warming the user cache failed: " + response.text)
+            break
+
+        for member in response_json.get("members", []):
+            profile = member.get("profile", {})
+            # bots, deactivated users and people without an email are looked up when they write instead
+            if member.get("deleted") or member.get("is_bot") or not profile.get("email"):
+                continue
+            store(member["id"], read_slack_user_profile({"user": member}, None))
+            warmed += 1
+
+        cursor = response_json.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            break
+
+    _WARMED += warmed
+    _WARM_RUNS += 1
+    LOGGER.info("Warmed the user cache with " + str(warmed) + " profiles")
+    return warmed
+
+
+def _warm_periodically():
+    """Warms the user cache at startup when USER_WARM_ON_START is set, then every USER_WARM_INTERVAL seconds if set"""
+
+    warm_now = settings.USER_WARM_ON_START
+    while True:
+        if warm_now:
+            try:
+                warm()
+            except Exception:
+                LOGGER.error("Warming the user cache failed: " + traceback.format_exc())
+        if settings.USER_WARM_INTERVAL <= 0:
+            return
+        warm_now = True
+        time.sleep(settings.USER_WARM_INTERVAL)
+
+
+def start():
+    """Starts warming the user cache in the background if a warm up is configured, call it in every process"""
+
+    if settings.USER_WARM_ON_START or settings.USER_WARM_INTERVAL > 0:
+        threading.Thread(target=_warm_periodically, name="profile-warm", daemon=True).start()
+
+
+def stats():
+    """Returns refresh and warm up counters"""
+
+    return {
+        "refreshing": len(_REFRESHING),
+        "refreshed": _REFRESHED,
+        "refresh_failed": _REFRESH_FAILED,
+        "warm_runs": _WARM_RUNS,
+        "warmed": _WARMED
+    }
@@ -0,0 +1,82 @@
+"""
+Production entry point, serves the app with gunicorn using several worker processes with several threads each.
+The app is loaded once before forking so settings, caches and config are initialized a single time
+"""
+
+import startup
+
+with startup.timed("gunicorn"):
+    import gunicorn.app.base
+
+with startup.timed("settings"):
+    import settings
+
+LOGGER = settings.get_logger("server")
+
+
+def post_fork(server, worker):
+    """Starts the per process background work in each worker, threads don't survive the fork"""
+
+    import profiles
+    import session_pool
+    import socket_mode
+
+    session_pool.start()
+    profiles.start()
+    socket_mode.start()
+
+
+def worker_exit(server, worker):
+    """Lets the turns already acknowledged to slack finish, and their replies go out, before the worker goes away"""
+
+    import delivery
+    import dispatcher
+
+    LOGGER.info("Worker " + str(worker.pid) + " draining in-flight turns")
+    if not dispatcher.DISPATCHER.shutdown(timeout=settings.SERVER_DRAIN_TIMEOUT):
+        LOGGER.warning("Worker " + str(worker.pid) + " exited before every turn was handled")
+    if not delivery.shutdown(timeout=settings.SERVER_DRAIN_TIMEOUT):
+        LOGGER.warning("Worker " + str(worker.pid) + " exited before every queued message was sent to slack")
+
+
+class Server(gunicorn.app.base.BaseApplication):
+    """Runs the flask app under gunicorn with options from config/server-settings.ini"""
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        import app
+
+        return app.APP
+
+
+def get_options():
+    """Returns the gunicorn options built from the server settings"""
+
+    return {
+        "bind": "0.0.0.0:" + str(settings.PORT),
+        "workers": settings.SERVER_WORKERS,
+        "threads": settings.SERVER_THREADS,
+        "worker_class": "gthread",
+        "preload_app": True,
+        "timeout": settings.SERVER_TIMEOUT,
+        "keepalive": settings.SERVER_KEEPALIVE,
+        # time to finish open requests plus drain the worker queue before being killed
+        "graceful_timeout": settings.SERVER_DRAIN_TIMEOUT + settings.SERVER_TIMEOUT,
+        "post_fork": post_fork,
+        "worker_exit": worker_exit
+    }
+
+
+if __name__ == '__main__':
+    if settings.SERVER_WORKERS > 1 and settings.TYPE == 'LOCAL':
+        LOGGER.warning("Running " + str(settings.SERVER_WORKERS) + " workers with cache TYPE=LOCAL, threads aren't shared "
+                       "between workers, set TYPE=REDIS in config/cache-settings.ini")
+
+    Server(get_options()).run()
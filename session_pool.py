@@ -0,0 +1,147 @@
+"""
+Pool of pre-warmed WA sessions, created and greeted in the background so a user's first message needs one round trip
+"""
+
+import os
+import threading
+import time
+import traceback
+from collections import deque
+
+import settings
+
+LOGGER = settings.get_logger("session_pool")
+
+
+class SessionPool(object):
+    """Keeps up to size greeted sessions ready, refilled by a daemon thread and dropped before they get too old"""
+
+    def __init__(self, size, max_age, retry_seconds):
+        self.size = size
+        self.max_age = max_age
+        self.retry_seconds = retry_seconds
+        self._factory = None
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._sessions = deque()
+        self._pid = None
+        self._created = 0
+        self._taken = 0
+        self._empty = 0
+        self._dropped = 0
+        self._failed = 0
+
+    def register(self, factory):
+        """Sets how pooled sessions are made, factory creates a session and sends the greeting"""
+
+        self._factory = factory
+
+    def start(self):
+        """Starts refilling the pool, it also starts on first use"""
+
+        self._ensure_started()
+
+    def _ensure_started(self):
+        """Starts the refill thread once per process, sessions created before a fork are dropped with it"""
+
+        if self.size <= 0 or self._factory is None or self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._sessions = deque()
+            thread = threading.Thread(target=self._refill, name="session-pool", daemon=True)
+            thread.start()
+            self._pid = os.getpid()
+
+    def take(self):
+        """Returns a fresh greeted session, or None when the pool is empty"""
+
+        self._ensure_started()
+
+        with self._lock:
+            self._drop_stale()
+            if not self._sessions:
+                self._empty += 1
+                self._wake.notify()
+                return None
+            session = self._sessions.popleft()
+            self._taken += 1
+            self._wake.notify()
+
+        LOGGER.debug("Took pooled %s", session)
+        return session
+
+    def _drop_stale(self):
+        """Removes sessions close to the upstream timeout, caller holds the lock"""
+
+        while self._sessions and self._sessions[0].idle_seconds() >= self.max_age:
+            self._sessions.popleft()
+            self._dropped += 1
+
+    def _refill(self):
+        """Refill loop, creates sessions while the pool is short and sleeps until one is taken or gets stale"""
+
+        while True:
+            with self._lock:
+                self._drop_stale()
+                missing = self.size - len(self._sessions)
+                if missing <= 0:
+                    # wake up again when the oldest session needs replacing
+                    self._wake.wait(max(1.0, self.max_age - self._sessions[0].idle_seconds()))
+                    continue
+
+            try:
+                session = self._factory()
+            # don't let an unreachable assistant end the refill thread
+            except Exception:
+                LOGGER.error(traceback.format_exc())
+                session = None
+
+            if session is None:
+                with self._lock:
+                    self._failed += 1
+                time.sleep(self.retry_seconds)
+                continue
+
+            with self._lock:
+                self._sessions.append(session)
+                self._created += 1
+
+    def stats(self):
+        """Returns the number of ready sessions and pool counters"""
+
+        with self._lock:
+            return {
+                "size": self.size,
+                "ready": len(self._sessions),
+                "created": self._created,
+                "taken": self._taken,
+                "empty": self._empty,
+                "dropped": self._dropped,
+                "failed": self._failed
+            }
+
+
+POOL = SessionPool(settings.SESSION_POOL_SIZE, settings.SESSION_POOL_MAX_AGE, settings.SESSION_POOL_RETRY_SECONDS)
+
+
+def register(factory):
+    """Sets how the shared session pool makes sessions"""
+    POOL.register(factory)
+
+
+def start():
+    """Starts filling the shared session pool"""
+    POOL.start()
+
+
+def take():
+    """Takes a session from the shared pool, None when empty"""
+    return POOL.take()
+
+
+def stats():
+    """Returns the shared session pool stats"""
+    return POOL.stats()
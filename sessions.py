@@ -2,51 +2,81 @@
 Tracks, stores and maintains WA sessions and the local session cache
 """
 
-import datetime
+import time
 import traceback
 import settings
-import sys
+import cache
+import capture
+import metrics
+import upstream
+from classes import Session, USER
 
 LOGGER = settings.get_logger("sessions")
 
-SESSIONS = {}
+# Sessions keyed by slack user, entries idle longer than SESSION_TIMEOUT_IN_SECONDS are evicted
+SESSIONS = cache.session_cache
+
+
+def _save(slack_user, session):
+    """Stores the session for the user, restarting its idle timeout"""
+
+    SESSIONS.set(slack_user, session, ttl=settings.SESSION_TIMEOUT)
+
 
 def check_expired(session):
-    """Checks to see if a session time is passed the allotted timeout"""
+    """Checks to see if a session time is passed the allotted timeout, or close enough that it should be renewed"""
 
-    elapsed_time = datetime.datetime.now() - session[1]
-    LOGGER.debug("Session Expired == " + str(elapsed_time.seconds >= settings.SESSION_TIMEOUT))
-    return elapsed_time.seconds >= settings.SESSION_TIMEOUT
+    expired = session.idle_seconds() >= settings.SESSION_TIMEOUT - settings.SESSION_RENEW_MARGIN
+    LOGGER.debug("Session Expired == %s", expired)
+    return expired
 
 
 def new_session_for_user(slack_user, watson_assistant):
     """Creates a new WA session for a user"""
-    SESSIONS[slack_user] = create_wa_session(watson_assistant)
-    return SESSIONS[slack_user]
+    session = create_wa_session(watson_assistant)
+    _save(slack_user, session)
+    return session
+
+
+def assign_session_to_user(slack_user, session):
+    """Gives a session created ahead of time, ex: by the session pool, to a user"""
+    _save(slack_user, session)
+    return session
+
+
+def keep_history(slack_user, old_session):
+    """Carries the conversation history of a replaced session over to the user's current session"""
+
+    session = SESSIONS.get(slack_user)
+    if session is None or old_session is None or session.session_id == old_session.session_id:
+        return session
+
+    turns = list(old_session.turns) + list(session.turns)
+    session.turns.clear()
+    session.turns.extend(turns)
+    _save(slack_user, session)
+    return session
 
 
 def get_wa_session(slack_user, watson_assistant, create_if_needed=True):
     """Gets a session for a user or creates one if nonexistent"""
 
+    session = SESSIONS.get(slack_user)
+
     if not create_if_needed:
-        try:
-            return SESSIONS[slack_user]
-        except KeyError:
-            return None
+        return session
 
-    if slack_user in SESSIONS:
-        session = SESSIONS[slack_user]
-        LOGGER.debug("Session for " + str(slack_user) + " is " + str(SESSIONS[slack_user][1]))
+    if session is not None:
+        LOGGER.debug("Session for %s is %s", slack_user, session)
     else:
         session = create_wa_session(watson_assistant)
-        session_id = session[0]
 
-        if session_id is None:
+        if session.session_id is None:
             return None
 
-    SESSIONS[slack_user] = session
+    _save(slack_user, session)
 
-    LOGGER.debug("Session for " + str(slack_user) + ": " + str(SESSIONS[slack_user]))
+    LOGGER.debug("Session for %s: %s", slack_user, session)
 
     return session
 
@@ -54,44 +84,78 @@ def get_wa_session(slack_user, watson_assistant, create_if_needed=True):
 def refresh_wa_session(user):
     """Updates the last used time for a session to the current time"""
 
-    SESSIONS[user] = SESSIONS[user][0], datetime.datetime.now(), SESSIONS[user][2], SESSIONS[user][3]
+    session = SESSIONS.get(user)
+    if session is not None:
+        session.timestamp = time.time()
+        _save(user, session)
 
 
 def create_wa_session(watson_assistant):
     """Creates a new WA session"""
 
-    timestamp = datetime.datetime.now()
-
     if not settings.CALL_PROXY:
 
+        breaker = upstream.check("watson")
+        started = time.perf_counter()
         try:
-            response = watson_assistant.create_session(
-                assistant_id=settings.WA_ASSISTANT_ID
-            ).get_result()
+            with metrics.timed("create_wa_session"):
+                response = upstream.call_blocking(
+                    "watson",
+                    watson_assistant.create_session,
+                    assistant_id=settings.WA_ASSISTANT_ID
+                ).get_result()
+            capture.call("watson_session", time.perf_counter() - started, 201)
 
             session_id = response.get("session_id")
-            LOGGER.debug("Session Created JSON:" + str(session_id))
+            LOGGER.debug("Session Created JSON: %s", session_id)
             # LOGGER.debug(json.dumps(response, indent=2))
 
         except Exception as ex:
+            capture.call("watson_session", time.perf_counter() - started, getattr(ex, "code", None))
+            breaker.failure()
             LOGGER.error(traceback.format_exc())
-            LOGGER.error("Create session method failed with status code " + str(ex.code) + ": " + ex.message + "\n")
+            LOGGER.error("Create session method failed with status code " + str(getattr(ex, "code", None)) + ": " + str(ex) + "\n")
             LOGGER.error("Check that WA_IAM_KEY in .env is correct. Should match an apikey value in your Watson Assistant service credentials.\n")
             LOGGER.error("Check that WA_ASSISTANT_ID in .env is correct. Should match Assistant ID located in Assistant Settings in Watson Assistant.\n")
-            sys.exit(1)
+            raise upstream.UpstreamUnavailableError("Unable to create a Watson Assistant session") from ex
+
+        breaker.success()
 
     else:
         session_id = ""
 
-    return session_id, timestamp, [], []
+    return Session(session_id, settings.MAX_SESSION_TURNS)
 
 
-def add_to_session_conversation(user, text, context):
-    SESSIONS[user][2].append(text)
-    SESSIONS[user][3].clear()
-    SESSIONS[user][3].append(context)
+def trim_context(response):
+    """Keeps only the skill context of a WA response, or nothing when STORE_CONTEXT is off"""
 
+    if not settings.STORE_SESSION_CONTEXT or not isinstance(response, dict):
+        return None
 
-def replace_session_id_for_user(user, session_id):
-    SESSIONS[user] = session_id, datetime.datetime.now(), SESSIONS[user][2], SESSIONS[user][3]
+    return response.get("context")
 
+
+def add_to_session_conversation(user, text, context=None, speaker=USER):
+    """Adds a turn to the user's bounded conversation history, and the trimmed context if given"""
+
+    session = SESSIONS.get(user)
+    if session is None:
+        return
+
+    session.add_turn(speaker, text)
+    if context is not None:
+        session.context = trim_context(context)
+    # the shared store hands out copies, so the change has to be written back
+    _save(user, session)
+
+
+def replace_session_id_for_user(user, session_id):
+    """Swaps in the session id the proxy answered with, keeping the conversation history"""
+
+    session = SESSIONS.get(user)
+    if session is None:
+        session = Session(session_id, settings.MAX_SESSION_TURNS)
+    session.session_id = session_id
+    session.timestamp = time.time()
+    _save(user, session)
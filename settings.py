@@ -3,12 +3,17 @@
 
 import os
 from pathlib import Path
+import hashlib
+import json
 import logging
-import datetime
-import requests
+import re
+import threading
 from configparser import ConfigParser
 from dotenv import load_dotenv
 
+import logs
+import startup
+
 load_dotenv()
 
 loggers = {}
@@ -19,24 +24,14 @@ config = ConfigParser()
 
 
 def get_logger(name):
-    """Initializes, configures and keeps logger singleton"""
+    """Initializes, configures and keeps logger singleton, records are written by a background thread, see logs.py"""
 
     global loggers
 
     if loggers.get(name):
         return loggers.get(name)
     else:
-        new_logger = logging.getLogger(name)
-        try:
-            new_logger.handlers.clear()
-        except IndexError:
-            print("Attempted to pop non existent logger")
-        new_logger.setLevel(os.getenv("LOGGING_LEVEL", "ERROR").upper())
-        now = datetime.datetime.now()
-        handler = logging.StreamHandler()
-        formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
-        handler.setFormatter(formatter)
-        new_logger.addHandler(handler)
+        new_logger = logs.configure(logging.getLogger(name))
         loggers[name] = new_logger
 
         return new_logger
@@ -45,9 +40,11 @@ def get_logger(name):
 def get_slack_bot_id(slack_bot_user_token):
     """Gets the bots user id, mainly used so it won't talk to itself"""
 
-    url = "https://slack.com/api/auth.test"
+    import http_client
+
+    url = SLACK_API_URL + "/auth.test"
     headers = {'Authorization': 'Bearer ' + slack_bot_user_token}
-    response = requests.request("POST", url, headers=headers)
+    response = http_client.request("POST", url, headers=headers)
 
     data = response.json()
 
@@ -89,6 +86,12 @@ if SLACK_BOT_USER_TOKEN == None or SLACK_BOT_USER_TOKEN == "":
 if BOT_NAME == None or BOT_NAME == "":
     raise Exception("Missing BOT_NAME env var.  Check .env file or manifest.yml.")
 
+# App level token, only needed for Socket Mode
+SLACK_APP_TOKEN = os.environ.get('SLACK_APP_TOKEN')
+
+# Base url of the slack Web API, only changed to point the bot at stand-ins, ex: the benchmark's stub servers
+SLACK_API_URL = os.environ.get('SLACK_API_URL', 'https://slack.com/api').rstrip('/')
+
 # ToDo: Delete
 logger.debug(SLACK_WEBHOOK_SECRET)
 
@@ -96,15 +99,23 @@ logger.debug(SLACK_WEBHOOK_SECRET)
 WA_IAM_KEY = os.getenv("WA_IAM_KEY")
 WA_ASSISTANT_ID = os.getenv("WA_ASSISTANT_ID")
 TA_INTEGRATION_ID = os.getenv("TA_INTEGRATION_ID")
+# Watson service and IAM token urls, the SDK's defaults are used when unset
+WA_URL = os.getenv("WA_URL")
+WA_IAM_URL = os.getenv("WA_IAM_URL")
 
 # Load assistant config file settings
 file_to_open = CONFIG_FOLDER / "assistant.ini"
 config.read(file_to_open)
 SESSION_TIMEOUT = int(config['DEFAULT']['SESSION_TIMEOUT_IN_SECONDS'])
+SESSION_RENEW_MARGIN = config.getint('DEFAULT', 'SESSION_RENEW_MARGIN_IN_SECONDS', fallback=30)
+RECOVER_SESSIONS = config.getboolean('DEFAULT', 'RECOVER_SESSIONS', fallback=True)
 WA_ENDPOINT = config['WATSON_ASSISTANT']['WA_ENDPOINT']
 WA_VERSION = config['WATSON_ASSISTANT']['WA_VERSION']
 WA_OPT_OUT = config['WATSON_ASSISTANT']['WA_OPT_OUT']
 TA_PROXY = os.getenv("TA_PROXY", config['TRIRIGA_ASSISTANT']['TA_PROXY'])
+SESSION_POOL_SIZE = config.getint('SESSION_POOL', 'SIZE', fallback=4)
+SESSION_POOL_MAX_AGE = config.getint('SESSION_POOL', 'MAX_AGE_SECONDS', fallback=max(1, SESSION_TIMEOUT - 60))
+SESSION_POOL_RETRY_SECONDS = config.getint('SESSION_POOL', 'RETRY_SECONDS', fallback=5)
 
 CALL_PROXY = False
 
@@ -119,9 +130,199 @@ else:
     print("Will talk through proxy at: " + TA_PROXY)
     CALL_PROXY = True
 
-# Set a few variables based on loaded settings
-BOT_ID = get_slack_bot_id(SLACK_BOT_USER_TOKEN)
-AT_BOT = '<@' + BOT_ID + '>'
+# Server settings
+file_to_open = CONFIG_FOLDER / "server-settings.ini"
+config.read(file_to_open)
+
+ACK_FIRST = config.getboolean('WORKERS', 'ACK_FIRST', fallback=True)
+WORKER_POOL_SIZE = config.getint('WORKERS', 'POOL_SIZE', fallback=8)
+WORKER_MAX_QUEUE = config.getint('WORKERS', 'MAX_QUEUE', fallback=500)
+# Turns in the same lane run one at a time in order, either per slack USER or per THREAD
+WORKER_LANE = config.get('WORKERS', 'LANE', fallback='USER').upper()
+WORKER_LANE_MAX_QUEUE = config.getint('WORKERS', 'LANE_MAX_QUEUE', fallback=10)
+WORKER_COALESCE = config.getboolean('WORKERS', 'COALESCE', fallback=True)
+
+# Socket Mode, events and button clicks read over a websocket, see socket_mode.py
+SOCKET_MODE = config.getboolean('SOCKET_MODE', 'ENABLED', fallback=False)
+SOCKET_MODE_OPEN_URL = config.get('SOCKET_MODE', 'OPEN_URL', fallback=SLACK_API_URL + '/apps.connections.open')
+SOCKET_MODE_MAX_IN_FLIGHT = config.getint('SOCKET_MODE', 'MAX_IN_FLIGHT', fallback=100)
+SOCKET_MODE_RECONNECT_MAX_SECONDS = config.getint('SOCKET_MODE', 'RECONNECT_MAX_SECONDS', fallback=30)
+SOCKET_MODE_READ_TIMEOUT = config.getint('SOCKET_MODE', 'READ_TIMEOUT_SECONDS', fallback=30)
+
+if SOCKET_MODE and (SLACK_APP_TOKEN == None or SLACK_APP_TOKEN == ""):
+    raise Exception("Missing SLACK_APP_TOKEN env var, needed when Socket Mode is enabled.  Check .env file or manifest.yml.")
+
+# Production server, see server.py, WEB_CONCURRENCY is the usual env var for the number of worker processes
+SERVER_WORKERS = int(os.getenv("WEB_CONCURRENCY", config.getint('SERVER', 'WORKERS', fallback=1)))
+SERVER_THREADS = config.getint('SERVER', 'THREADS', fallback=8)
+SERVER_TIMEOUT = config.getint('SERVER', 'TIMEOUT_SECONDS', fallback=30)
+SERVER_KEEPALIVE = config.getint('SERVER', 'KEEPALIVE_SECONDS', fallback=5)
+SERVER_DRAIN_TIMEOUT = config.getint('SERVER', 'DRAIN_TIMEOUT_SECONDS', fallback=30)
+
+# Libraries decoding the JSON the bot receives and encoding what it sends, see codec.py
+JSON_DECODER = config.get('JSON', 'DECODER', fallback='AUTO').upper()
+JSON_ENCODER = config.get('JSON', 'ENCODER', fallback='AUTO').upper()
+
+# Asyncio serving engine, see async_app.py
+ASYNC_MAX_IN_FLIGHT = config.getint('ASYNC', 'MAX_IN_FLIGHT', fallback=5000)
+ASYNC_CONNECTIONS_PER_HOST = config.getint('ASYNC', 'CONNECTIONS_PER_HOST', fallback=100)
+ASYNC_KEEPALIVE = config.getint('ASYNC', 'KEEPALIVE_SECONDS', fallback=15)
+ASYNC_TIMEOUT = config.getint('ASYNC', 'TIMEOUT_SECONDS', fallback=30)
+
+HTTP_POOL_CONNECTIONS = config.getint('HTTP', 'POOL_CONNECTIONS', fallback=4)
+HTTP_POOL_MAXSIZE = config.getint('HTTP', 'POOL_MAXSIZE', fallback=10)
+HTTP_POOL_BLOCK = config.getboolean('HTTP', 'POOL_BLOCK', fallback=False)
+HTTP_CONNECT_TIMEOUT = config.getfloat('HTTP', 'CONNECT_TIMEOUT_SECONDS', fallback=3.0)
+HTTP_TIMEOUT = config.getfloat('HTTP', 'TIMEOUT_SECONDS', fallback=10.0)
+# Comma separated host:connections pairs, ex: slack.com:20
+HTTP_HOST_MAXSIZE = {}
+for host_limit in config.get('HTTP', 'HOST_MAXSIZE', fallback='').split(','):
+    if host_limit.strip():
+        host, limit = host_limit.strip().rsplit(':', 1)
+        HTTP_HOST_MAXSIZE[host.strip()] = int(limit)
+
+# Outbound delivery queue, see delivery.py, rates are messages per second
+DELIVERY_ENABLED = config.getboolean('DELIVERY', 'ENABLED', fallback=True)
+DELIVERY_WORKERS = config.getint('DELIVERY', 'WORKERS', fallback=4)
+DELIVERY_MAX_QUEUE = config.getint('DELIVERY', 'MAX_QUEUE', fallback=1000)
+DELIVERY_CHANNEL_RATE = config.getfloat('DELIVERY', 'CHANNEL_RATE', fallback=1.0)
+DELIVERY_CHANNEL_BURST = config.getint('DELIVERY', 'CHANNEL_BURST', fallback=3)
+DELIVERY_DEFAULT_METHOD_RATE = config.getfloat('DELIVERY', 'DEFAULT_METHOD_RATE', fallback=10.0)
+DELIVERY_MAX_RETRIES = config.getint('DELIVERY', 'MAX_RETRIES', fallback=3)
+DELIVERY_RETRY_SECONDS = config.getfloat('DELIVERY', 'RETRY_SECONDS', fallback=1.0)
+# Comma separated method:rate pairs, ex: chat.postMessage:20
+DELIVERY_METHOD_RATES = {}
+for method_rate in config.get('DELIVERY', 'METHOD_RATES', fallback='').split(','):
+    if method_rate.strip():
+        method, rate = method_rate.strip().rsplit(':', 1)
+        DELIVERY_METHOD_RATES[method.strip()] = float(rate)
+
+# Upstream timeouts and circuit breakers, see upstream.py
+UPSTREAM_TIMEOUTS = {
+    'slack': config.getfloat('UPSTREAM', 'SLACK_TIMEOUT_SECONDS', fallback=5.0),
+    'proxy': config.getfloat('UPSTREAM', 'PROXY_TIMEOUT_SECONDS', fallback=10.0),
+    'watson': config.getfloat('UPSTREAM', 'WATSON_TIMEOUT_SECONDS', fallback=10.0),
+    'webhook': config.getfloat('UPSTREAM', 'WEBHOOK_TIMEOUT_SECONDS', fallback=15.0)
+}
+# How long a turn may take, SLACK_DEADLINE applies when ACK_FIRST is off and slack is waiting on the answer
+UPSTREAM_TURN_DEADLINE = config.getfloat('UPSTREAM', 'TURN_DEADLINE_SECONDS', fallback=30.0)
+UPSTREAM_SLACK_DEADLINE = config.getfloat('UPSTREAM', 'SLACK_DEADLINE_SECONDS', fallback=2.5)
+UPSTREAM_RETRIES = config.getint('UPSTREAM', 'RETRIES', fallback=2)
+UPSTREAM_RETRY_BACKOFF = config.getfloat('UPSTREAM', 'RETRY_BACKOFF_SECONDS', fallback=0.2)
+UPSTREAM_BREAKER_FAILURES = config.getint('UPSTREAM', 'BREAKER_FAILURES', fallback=5)
+UPSTREAM_BREAKER_RESET_SECONDS = config.getfloat('UPSTREAM', 'BREAKER_RESET_SECONDS', fallback=30.0)
+UPSTREAM_DEGRADED_MESSAGE = config.get('UPSTREAM', 'DEGRADED_MESSAGE', fallback="Sorry, I can't reach TRIRIGA right now. Please try again in a few minutes.")
+
+# Per event tracing, see tracing.py
+TRACING = config.getboolean('TRACING', 'ENABLED', fallback=False)
+TRACING_FILE = os.getenv("TRACING_FILE", config.get('TRACING', 'FILE', fallback='traces.jsonl'))
+TRACING_MAX_BYTES = config.getint('TRACING', 'MAX_BYTES', fallback=10485760)
+TRACING_BACKUP_COUNT = config.getint('TRACING', 'BACKUP_COUNT', fallback=3)
+TRACING_SAMPLE_RATE = config.getfloat('TRACING', 'SAMPLE_RATE', fallback=1.0)
+TRACING_MAX_QUEUE = config.getint('TRACING', 'MAX_QUEUE', fallback=10000)
+
+# Traffic capture for benchmark/replay.py, see capture.py, the CAPTURE_FILE env var overrides FILE
+CAPTURE = config.getboolean('CAPTURE', 'ENABLED', fallback=False)
+CAPTURE_FILE = os.getenv("CAPTURE_FILE", config.get('CAPTURE', 'FILE', fallback='capture.jsonl'))
+CAPTURE_MAX_BYTES = config.getint('CAPTURE', 'MAX_BYTES', fallback=104857600)
+CAPTURE_MAX_QUEUE = config.getint('CAPTURE', 'MAX_QUEUE', fallback=10000)
+# Key the slack id pseudonyms are derived from, the same key gives the same pseudonyms across captures
+CAPTURE_KEY = os.getenv("CAPTURE_KEY") or SLACK_WEBHOOK_SECRET
+
+# Where the resolved bot id is kept between starts, so a worker can boot while slack.com is slow
+BOT_ID_CACHE_FILE = Path(os.getenv("BOT_ID_CACHE_FILE", config.get('STARTUP', 'BOT_ID_CACHE_FILE', fallback='.bot_id.json')))
+
+# The bot's slack id, its mention and a pattern matching it, resolved on first use, see get_bot_id
+BOT_ID = None
+AT_BOT = None
+AT_BOT_PATTERN = None
+_BOT_ID_LOCK = threading.Lock()
+
+
+def _token_hash():
+    return hashlib.sha256(SLACK_BOT_USER_TOKEN.encode("utf-8")).hexdigest()[:16]
+
+
+def _read_cached_bot_id():
+    """Returns the bot id saved for the current token, or None"""
+
+    try:
+        with open(BOT_ID_CACHE_FILE) as cache_file:
+            data = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+    if data.get("token") != _token_hash():
+        return None
+    return data.get("bot_id")
+
+
+def _write_cached_bot_id(bot_id):
+    try:
+        BOT_ID_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(BOT_ID_CACHE_FILE, "w") as cache_file:
+            json.dump({"token": _token_hash(), "bot_id": bot_id}, cache_file)
+    except OSError:
+        logger.warning("Unable to save bot id to " + str(BOT_ID_CACHE_FILE))
+
+
+def _set_bot_id(bot_id):
+    global BOT_ID, AT_BOT, AT_BOT_PATTERN
+
+    BOT_ID = bot_id
+    AT_BOT = '<@' + bot_id + '>'
+    # the mention and the space before it, or after it when it starts the text
+    AT_BOT_PATTERN = re.compile(' ' + re.escape(AT_BOT) + '|' + re.escape(AT_BOT) + ' ?')
+
+
+def _refresh_bot_id():
+    """Asks slack for the bot id again in the background, in case the saved one is out of date"""
+
+    try:
+        bot_id = get_slack_bot_id(SLACK_BOT_USER_TOKEN)
+    except Exception as ex:
+        logger.warning("Unable to refresh bot id, keeping the saved one: " + str(ex))
+        return
+
+    if bot_id != BOT_ID:
+        _set_bot_id(bot_id)
+    _write_cached_bot_id(bot_id)
+
+
+def resolve_bot_id():
+    """Returns the bot id, from the saved copy when there is one, otherwise from slack"""
+
+    with _BOT_ID_LOCK:
+        if BOT_ID is not None:
+            return BOT_ID
+
+        with startup.timed("bot id"):
+            bot_id = _read_cached_bot_id()
+            if bot_id is not None:
+                threading.Thread(target=_refresh_bot_id, name="bot-id-refresh", daemon=True).start()
+            else:
+                bot_id = get_slack_bot_id(SLACK_BOT_USER_TOKEN)
+                _write_cached_bot_id(bot_id)
+
+        _set_bot_id(bot_id)
+        return bot_id
+
+
+def get_bot_id():
+    """Returns the bot id, resolving it the first time it is needed instead of on import"""
+
+    if BOT_ID is not None:
+        return BOT_ID
+    return resolve_bot_id()
+
+
+def get_at_bot_pattern():
+    """Returns the pattern matching a mention of the bot and the space next to it"""
+
+    if AT_BOT_PATTERN is None:
+        resolve_bot_id()
+    return AT_BOT_PATTERN
+
 
 # App settings
 file_to_open = CONFIG_FOLDER / "cache-settings.ini"
@@ -132,16 +333,40 @@ TYPE = config.get('DEFAULT', 'TYPE')
 # ToDo: Make it so there are fallback values for config options, do less if else
 if 'DEFAULT' in config:
     CACHING_ENABLED = config['DEFAULT']['ENABLED']
-    # Supported Types [ 'LOCAL' ]
+    # Supported Types [ 'LOCAL', 'REDIS' ]
     TYPE = config['DEFAULT']['TYPE']
     SESSION_TIMEOUT_MS = int(config['DEFAULT']['SESSION_TIMEOUT_MS'])
     # ToDo: Add another conditional if the cache is disabled
-    if TYPE == 'LOCAL' and 'LOCAL' in config:
+    if TYPE in ('LOCAL', 'REDIS') and 'LOCAL' in config:
         MAX_SESSION_CACHE = int(config['LOCAL']['MAX_SESSION_CACHE'])
         MAX_EVENT_CACHE = int(config['LOCAL']['MAX_EVENT_CACHE'])
+        EVENT_TIMEOUT_MS = config.getint('LOCAL', 'EVENT_TIMEOUT_MS', fallback=600000)
         MAX_SESSION_TURNS = int(config['LOCAL']['MAX_SESSION_TURNS'])
-    # ToDo: If other types of caching are enabled need an elif here
+        MAX_USER_CACHE = config.getint('LOCAL', 'MAX_USER_CACHE', fallback=10000)
+        CACHE_SHARDS = config.getint('LOCAL', 'SHARDS', fallback=16)
+        CACHE_SWEEP_INTERVAL = config.getint('LOCAL', 'SWEEP_INTERVAL_MS', fallback=30000) / 1000
+        MAX_THREAD_CACHE = config.getint('LOCAL', 'MAX_THREAD_CACHE', fallback=10000)
+        THREAD_TIMEOUT_MS = config.getint('LOCAL', 'THREAD_TIMEOUT_MS', fallback=604800000)
+        STORE_SESSION_CONTEXT = config.getboolean('LOCAL', 'STORE_CONTEXT', fallback=False)
     else:
-        raise Exception("Malformed 'config/cache-settings.ini' file for cache type 'LOCAL'.")
+        raise Exception("Malformed 'config/cache-settings.ini' file for cache type '" + TYPE + "'.")
+
+    # Shared store settings, sessions, events, users and threads are kept there so several workers/replicas can run
+    if TYPE == 'REDIS':
+        REDIS_URL = os.getenv("REDIS_URL", config.get('REDIS', 'URL', fallback='redis://localhost:6379/0'))
+        REDIS_PREFIX = config.get('REDIS', 'PREFIX', fallback='tririga-bot:')
+        REDIS_POOL_SIZE = config.getint('REDIS', 'POOL_SIZE', fallback=10)
+        REDIS_TIMEOUT = config.getint('REDIS', 'TIMEOUT_MS', fallback=2000) / 1000
 else:
     raise Exception("Malformed 'config/cache-settings.ini' file.")
+
+
+# Slack profiles behind the userContext, cached for TTL_SECONDS then used while they are refreshed in the background
+USER_TTL = config.getint('USERS', 'TTL_SECONDS', fallback=3600)
+USER_MAX_STALE = config.getint('USERS', 'MAX_STALE_SECONDS', fallback=86400)
+USER_NEGATIVE_TTL = config.getint('USERS', 'NEGATIVE_TTL_SECONDS', fallback=300)
+USER_DEFAULT_TIMEZONE = config.get('USERS', 'DEFAULT_TIMEZONE', fallback='UTC')
+USER_REFRESH_THREADS = config.getint('USERS', 'REFRESH_THREADS', fallback=2)
+USER_WARM_ON_START = config.getboolean('USERS', 'WARM_ON_START', fallback=False)
+USER_WARM_INTERVAL = config.getint('USERS', 'WARM_INTERVAL_SECONDS', fallback=0)
+USER_WARM_PAGE_SIZE = config.getint('USERS', 'WARM_PAGE_SIZE', fallback=200)
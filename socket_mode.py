@@ -0,0 +1,234 @@
+"""
+Slack Socket Mode ingestion, reads events and button clicks over a websocket instead of the /slack HTTP endpoints.
+Every envelope is acknowledged right away and handed to the same pipeline and dispatcher as the HTTP endpoints
+"""
+
+import json
+import random
+import threading
+import time
+import traceback
+
+import websocket
+
+import settings
+import codec
+import http_client
+
+LOGGER = settings.get_logger("socket_mode")
+
+
+class SocketModeClient(object):
+    """Keeps a Socket Mode connection open, reconnecting when it drops, with at most max_in_flight envelopes handled
+    at once, reading pauses while that many are in flight and slack holds the rest"""
+
+    def __init__(self, app_token, max_in_flight, reconnect_max_seconds, read_timeout):
+        self.app_token = app_token
+        self.max_in_flight = max_in_flight
+        self.reconnect_max_seconds = reconnect_max_seconds
+        self.read_timeout = read_timeout
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._connections = 0
+        self._envelopes = 0
+        self._acked = 0
+        self._rejected = 0
+        self._coalesced = 0
+        self._in_flight = 0
+
+    def start(self):
+        """Starts reading on a daemon thread"""
+
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self.run_forever, name="socket-mode", daemon=True)
+            self._thread.start()
+
+    def open_url(self):
+        """Asks slack for a websocket url, each one can only be used once"""
+
+        response = http_client.request("POST", settings.SOCKET_MODE_OPEN_URL,
+                                       headers={'Authorization': 'Bearer ' + self.app_token})
+        data = response.json()
+        if not data.get("ok"):
+            raise Exception("Unable to open a Socket Mode connection: " + str(data.get("error")) +
+                            ". Check SLACK_APP_TOKEN is an app level token with the connections:write scope.")
+        return data["url"]
+
+    def run_forever(self):
+        """Connects and reads envelopes, reconnecting with jittered backoff when the connection drops"""
+
+        backoff = 1.0
+        while True:
+            try:
+                connection = websocket.create_connection(self.open_url(), timeout=self.read_timeout)
+            except Exception:
+                LOGGER.error(traceback.format_exc())
+                time.sleep(random.uniform(0, backoff))
+                backoff = min(backoff * 2, self.reconnect_max_seconds)
+                continue
+
+            with self._lock:
+                self._connections += 1
+            backoff = 1.0
+
+            try:
+                self._read(connection)
+            except Exception:
+                LOGGER.warning("Socket Mode connection dropped, reconnecting\n" + traceback.format_exc())
+            finally:
+                connection.close()
+
+    def _read(self, connection):
+        """Reads envelopes until slack asks to reconnect or the connection fails"""
+
+        while True:
+            # wait for room before reading more, unread envelopes stay with slack
+            self._slots.acquire()
+            # set once a queued job owns the slot, it frees it when done, otherwise it is freed here
+            queued = False
+            try:
+                try:
+                    message = connection.recv()
+                except websocket.WebSocketTimeoutException:
+                    connection.ping()
+                    continue
+
+                if not message:
+                    raise websocket.WebSocketConnectionClosedException("Socket Mode connection closed")
+
+                envelope = codec.loads(message)
+                envelope_type = envelope.get("type")
+
+                if "envelope_id" in envelope:
+                    connection.send(json.dumps({"envelope_id": envelope["envelope_id"]}))
+                    with self._lock:
+                        self._envelopes += 1
+                        self._acked += 1
+
+                if envelope_type == "disconnect":
+                    LOGGER.debug("Slack asked to reconnect: %s", envelope.get("reason"))
+                    return
+
+                try:
+                    queued = self._handle(envelope_type, envelope.get("payload"), envelope.get("retry_attempt"),
+                                          envelope.get("retry_reason"))
+                except Exception:
+                    # a malformed envelope is dropped, the connection is fine
+                    LOGGER.error("Unable to handle a Socket Mode " + str(envelope_type) + " envelope\n" +
+                                 traceback.format_exc())
+            finally:
+                if not queued:
+                    self._slots.release()
+
+    def _handle(self, envelope_type, payload, retry_attempt=None, retry_reason=None):
+        """Routes an envelope's payload to the pipeline, returns True if a job was queued that will free its slot"""
+
+        import app
+        import action_handler
+        import capture
+        import dedup
+        import dispatcher
+
+        if envelope_type == "events_api":
+            capture.event(payload)
+            text, status, slack_event = app.check_event(payload, retry_attempt, retry_reason)
+            if slack_event is None:
+                return False
+            func, argument = app.handle_message, slack_event
+            lane = app.get_lane(slack_event.user, slack_event.time_stamp)
+            coalesce_key = app.get_coalesce_key(slack_event)
+        elif envelope_type == "interactive":
+            if payload.get("token") != settings.SLACK_WEBHOOK_SECRET or payload.get("type") != "block_actions":
+                return False
+            capture.action(payload)
+            func, argument = action_handler.handle_action, payload
+            lane, coalesce_key = action_handler.get_lane(payload)
+        else:
+            return False
+
+        # counted before it is queued since the job can finish before submit returns
+        with self._lock:
+            self._in_flight += 1
+
+        result = dispatcher.submit(self._run, func, argument, lane=lane, coalesce_key=coalesce_key)
+        if result == dispatcher.QUEUED:
+            return True
+
+        with self._lock:
+            self._in_flight -= 1
+            if result == dispatcher.COALESCED:
+                self._coalesced += 1
+            else:
+                self._rejected += 1
+
+        if result == dispatcher.REJECTED:
+            if envelope_type == "events_api":
+                # already acknowledged, slack won't send it again
+                dedup.forget(payload["event_id"])
+            LOGGER.warning("Dispatcher is full, dropped a Socket Mode " + envelope_type + " envelope")
+        return False
+
+    def _run(self, func, *args):
+        """Runs a job and frees its envelope slot"""
+
+        try:
+            func(*args)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self._in_flight,
+                "connections": self._connections,
+                "envelopes": self._envelopes,
+                "acked": self._acked,
+                "rejected": self._rejected,
+                "coalesced": self._coalesced
+            }
+
+
+CLIENT = None
+
+
+def get_client():
+    """Returns the shared Socket Mode client"""
+
+    global CLIENT
+
+    if CLIENT is None:
+        CLIENT = SocketModeClient(settings.SLACK_APP_TOKEN, settings.SOCKET_MODE_MAX_IN_FLIGHT,
+                                  settings.SOCKET_MODE_RECONNECT_MAX_SECONDS, settings.SOCKET_MODE_READ_TIMEOUT)
+    return CLIENT
+
+
+def start():
+    """Starts reading envelopes in the background when Socket Mode is enabled"""
+
+    if settings.SOCKET_MODE:
+        get_client().start()
+
+
+def stats():
+    """Returns the Socket Mode client stats, empty when it isn't running"""
+    return CLIENT.stats() if CLIENT is not None else {}
+
+
+if __name__ == '__main__':
+    # Socket Mode only, without the HTTP endpoints
+    import app
+    import session_pool
+    import socket_mode
+
+    if settings.SLACK_APP_TOKEN is None or settings.SLACK_APP_TOKEN == "":
+        raise Exception("Missing SLACK_APP_TOKEN env var.  Check .env file or manifest.yml.")
+
+    session_pool.start()
+    # through the imported module so app's /stats sees the same client
+    socket_mode.get_client().run_forever()
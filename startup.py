@@ -0,0 +1,35 @@
+"""
+Records how long importing and initializing each part of the bot takes, reported from /stats and logged at start up
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+_STARTED = time.perf_counter()
+_LOCK = threading.Lock()
+_TIMINGS = {}
+
+
+@contextmanager
+def timed(stage):
+    """Times the block as stage, only the first time a stage is timed counts, later ones hit warm imports"""
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        with _LOCK:
+            _TIMINGS.setdefault(stage, elapsed)
+
+
+def report():
+    """Returns the time spent in each stage and since the process started importing, in milliseconds"""
+
+    with _LOCK:
+        stages = {stage: round(elapsed * 1000, 3) for stage, elapsed in _TIMINGS.items()}
+    return {
+        "since_start_ms": round((time.perf_counter() - _STARTED) * 1000, 3),
+        "stages": stages
+    }
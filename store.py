@@ -0,0 +1,461 @@
+"""
+Shared store backend, keeps the caches in a Redis protocol server so several workers and replicas see the same
+sessions, events, users and threads
+"""
+
+import os
+import queue
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit, unquote
+
+import codec
+import settings
+import upstream
+
+LOGGER = settings.get_logger("store")
+
+_MISSING = object()
+
+
+class StoreUnavailableError(upstream.UpstreamUnavailableError):
+    """Raised when the store can't be reached or doesn't answer in time, a turn answers it like a failing upstream"""
+
+
+class RedisError(StoreUnavailableError):
+    """Error reply sent back by the store"""
+
+
+class RedisClient(object):
+    """Minimal Redis protocol client with a small pool of connections and pipelining"""
+
+    def __init__(self, url, pool_size=10, timeout=2.0):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.strip("/") or 0)
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        # connections opened before a fork can't be shared with the child, start over
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pool = queue.LifoQueue(maxsize=self.pool_size)
+                    self._pid = os.getpid()
+        return self._pool
+
+    def _connect(self):
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except OSError as ex:
+            raise StoreUnavailableError("Can't connect to the store at " + self.host + ":" + str(self.port) + ": " +
+                                        str(ex)) from ex
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = (sock, sock.makefile("rb"))
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            try:
+                replies = self._send(connection, setup)
+            except Exception:
+                sock.close()
+                raise
+            for reply in replies:
+                if isinstance(reply, RedisError):
+                    sock.close()
+                    raise reply
+        return connection
+
+    @staticmethod
+    def _encode(commands):
+        chunks = []
+        for command in commands:
+            chunks.append(b"*%d\r\n" % len(command))
+            for arg in command:
+                if isinstance(arg, bytes):
+                    data = arg
+                elif isinstance(arg, str):
+                    data = arg.encode("utf-8")
+                else:
+                    data = str(arg).encode("utf-8")
+                chunks.append(b"$%d\r\n" % len(data))
+                chunks.append(data)
+                chunks.append(b"\r\n")
+        return b"".join(chunks)
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("Store closed the connection")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            return RedisError(rest.decode("utf-8"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read_reply(reader) for _ in range(length)]
+        raise ConnectionError("Unexpected reply from store: " + repr(line))
+
+    def _send(self, connection, commands):
+        sock, reader = connection
+        try:
+            sock.sendall(self._encode(commands))
+            return [self._read_reply(reader) for _ in commands]
+        except OSError as ex:
+            # timeouts and dropped connections
+            raise StoreUnavailableError("Store call failed: " + (str(ex) or type(ex).__name__)) from ex
+
+    def pipeline(self, commands):
+        """Sends every command in one round trip and returns their replies, error replies are returned not raised.
+        Raises StoreUnavailableError when the store can't be reached or times out"""
+
+        if not commands:
+            return []
+
+        pool = self._get_pool()
+        try:
+            connection = pool.get_nowait()
+        except queue.Empty:
+            connection = self._connect()
+
+        try:
+            replies = self._send(connection, commands)
+        except Exception:
+            connection[0].close()
+            raise
+
+        try:
+            pool.put_nowait(connection)
+        except queue.Full:
+            connection[0].close()
+
+        return replies
+
+    def execute(self, *command):
+        """Sends a single command and returns its reply"""
+
+        reply = self.pipeline([command])[0]
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_client():
+    """Returns the shared store client"""
+
+    global _CLIENT
+
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = RedisClient(settings.REDIS_URL, settings.REDIS_POOL_SIZE, settings.REDIS_TIMEOUT)
+    return _CLIENT
+
+
+_BATCH = threading.local()
+
+
+class _Batch(object):
+    """Values read and written during a batch, writes are sent in one pipeline when it ends"""
+
+    __slots__ = ("depth", "values", "writes")
+
+    def __init__(self):
+        self.depth = 0
+        self.values = {}
+        self.writes = {}
+
+
+def _current_batch():
+    return getattr(_BATCH, "batch", None)
+
+
+@contextmanager
+def batch():
+    """Remembers reads and holds back writes made by this thread until the outermost batch ends"""
+
+    current = _current_batch()
+    if current is None:
+        current = _BATCH.batch = _Batch()
+    current.depth += 1
+    try:
+        yield current
+    finally:
+        current.depth -= 1
+        if current.depth == 0:
+            _BATCH.batch = None
+            flush(current)
+
+
+def flush(current):
+    """Writes every value set during the batch in a single round trip"""
+
+    commands = []
+    for full_key, (shared_cache, ttl) in current.writes.items():
+        value = current.values.get(full_key, _MISSING)
+        if value is _MISSING:
+            continue
+        commands.append(shared_cache._set_command(full_key, value, ttl))
+
+    if not commands:
+        return
+
+    # it runs as a turn ends, often on the way out of an error, so a failure is logged rather than raised
+    try:
+        replies = get_client().pipeline(commands)
+    except StoreUnavailableError as ex:
+        LOGGER.error("Failed to write " + str(len(commands)) + " values to store, they are lost: " + str(ex))
+        return
+    for reply in replies:
+        if isinstance(reply, RedisError):
+            LOGGER.error("Failed to write to store: " + str(reply))
+
+
+def get_many(pairs):
+    """Fetches (cache, key) pairs in one round trip, returns their values in order, None when missing"""
+
+    current = _current_batch()
+    results = [_MISSING] * len(pairs)
+    commands = []
+    pending = []
+
+    for index, (shared_cache, key) in enumerate(pairs):
+        full_key = shared_cache._key(key)
+        if current is not None and full_key in current.values:
+            results[index] = current.values[full_key]
+        else:
+            commands.append(("GET", full_key))
+            pending.append((index, shared_cache, full_key))
+
+    if commands:
+        replies = get_client().pipeline(commands)
+        for (index, shared_cache, full_key), reply in zip(pending, replies):
+            value = shared_cache._decode_reply(reply)
+            results[index] = value
+            if current is not None:
+                current.values[full_key] = value
+            shared_cache._count(value is not None)
+
+    return [None if value is _MISSING else value for value in results]
+
+
+class RedisCache(object):
+    """Cache kept in the shared store, same interface as cache.Cache"""
+
+    def __init__(self, name, ttl=None, encode=None, decode=None):
+        self.name = name
+        self.ttl = ttl
+        self.prefix = settings.REDIS_PREFIX + name + ":"
+        self.encode = encode
+        self.decode = decode
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _key(self, key):
+        return self.prefix + str(key)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+
+    def _dumps(self, value):
+        if self.encode is not None:
+            value = self.encode(value)
+        return codec.dumps(value)
+
+    def _decode_reply(self, reply):
+        if reply is None or isinstance(reply, RedisError):
+            return None
+        value = codec.loads(reply)
+        if self.decode is not None:
+            value = self.decode(value)
+        return value
+
+    def _set_command(self, full_key, value, ttl, only_if_absent=False):
+        ttl = self.ttl if ttl is None else ttl
+        command = ["SET", full_key, self._dumps(value)]
+        if ttl:
+            command += ["PX", int(ttl * 1000)]
+        if only_if_absent:
+            command.append("NX")
+        return command
+
+    def get(self, key, default=None):
+        value = get_many([(self, key)])[0]
+        return default if value is None else value
+
+    def set(self, key, value, ttl=None):
+        full_key = self._key(key)
+        current = _current_batch()
+        if current is not None:
+            current.values[full_key] = value
+            current.writes[full_key] = (self, ttl)
+            return
+        get_client().execute(*self._set_command(full_key, value, ttl))
+
+    def add(self, key, value, ttl=None):
+        """Sets value only if key isn't already stored, atomic across every worker sharing the store"""
+
+        added = get_client().execute(*self._set_command(self._key(key), value, ttl, only_if_absent=True)) is not None
+        self._count(not added)
+        return added
+
+    def pop(self, key, default=None):
+        full_key = self._key(key)
+        current = _current_batch()
+        if current is not None:
+            current.values.pop(full_key, None)
+            current.writes.pop(full_key, None)
+        replies = get_client().pipeline([("GET", full_key), ("DEL", full_key)])
+        value = self._decode_reply(replies[0])
+        return default if value is None else value
+
+    def expire(self):
+        # the store expires entries itself
+        return 0
+
+    def clear(self):
+        client = get_client()
+        for keys in self._scan():
+            client.execute("DEL", *keys)
+
+    def _scan(self):
+        cursor = b"0"
+        while True:
+            cursor, keys = get_client().execute("SCAN", cursor, "MATCH", self.prefix + "*", "COUNT", 1000)
+            if keys:
+                yield keys
+            if cursor in (b"0", "0"):
+                return
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if self.pop(key, _MISSING) is _MISSING:
+            raise KeyError(key)
+
+    def __len__(self):
+        """Counts the keys under the prefix with a SCAN of the whole store, not for frequent use"""
+        return sum(len(keys) for keys in self._scan())
+
+    def stats(self):
+        """Returns hit/miss counters, without the size since counting it scans the shared store"""
+
+        return {
+            "hits": self._hits,
+            "misses": self._misses
+        }
+
+
+class RedisSetCache(RedisCache):
+    """Cache of sets kept in the shared store, same interface as cache.SetCache. Sets expire after their time to live
+    without a new member, and a sorted set of when each was last added to evicts the least recently used past
+    max_size"""
+
+    def __init__(self, name, max_size, ttl=None):
+        super(RedisSetCache, self).__init__(name, ttl=ttl)
+        self.max_size = max_size
+        self.index = settings.REDIS_PREFIX + name + "-lru"
+        self._evictions = 0
+
+    def add_member(self, key, member, ttl=None):
+        """Adds member to the set at key, creating it if needed, in one round trip unless sets have to be evicted"""
+
+        ttl = self.ttl if ttl is None else ttl
+        full_key = self._key(key)
+        now = time.time()
+        commands = [("SADD", full_key, member), ("ZADD", self.index, now, full_key)]
+        if ttl:
+            commands.append(("PEXPIRE", full_key, int(ttl * 1000)))
+            # the store already expired these sets, forget them
+            commands.append(("ZREMRANGEBYSCORE", self.index, "-inf", now - ttl))
+        commands.append(("ZCARD", self.index))
+
+        replies = get_client().pipeline(commands)
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+
+        excess = replies[-1] - self.max_size
+        if excess > 0:
+            self._evict(excess)
+
+    def _evict(self, count):
+        """Deletes the count least recently added to sets"""
+
+        popped = get_client().execute("ZPOPMIN", self.index, count)
+        # replies alternate member and score
+        keys = popped[::2]
+        if keys:
+            get_client().execute("DEL", *keys)
+            with self._lock:
+                self._evictions += len(keys)
+
+    def has_member(self, key, member):
+        """Returns None when there is no set at key, otherwise whether member is in it"""
+
+        replies = get_client().pipeline([("EXISTS", self._key(key)), ("SISMEMBER", self._key(key), member)])
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+
+        self._count(replies[0] == 1)
+        return None if replies[0] != 1 else replies[1] == 1
+
+    def clear(self):
+        super(RedisSetCache, self).clear()
+        get_client().execute("DEL", self.index)
+
+    def __len__(self):
+        return get_client().execute("ZCARD", self.index)
+
+    def stats(self):
+        values = super(RedisSetCache, self).stats()
+        # the index has a member per set, so this size is one ZCARD
+        try:
+            values["size"] = len(self)
+        except Exception:
+            values["size"] = -1
+        values["max_size"] = self.max_size
+        values["evictions"] = self._evictions
+        return values
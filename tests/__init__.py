@@ -0,0 +1,12 @@
+"""
+Unit tests, run them from the repo root with python -m unittest or python -m pytest. The bot reads its settings on
+import, so placeholder credentials are set here for the modules under test, nothing is called
+"""
+
+import os
+
+os.environ.setdefault("SLACK_WEBHOOK_SECRET", "test-secret")
+os.environ.setdefault("SLACK_BOT_USER_TOKEN", "xoxb-test")
+os.environ.setdefault("BOT_NAME", "test")
+os.environ.setdefault("TA_INTEGRATION_ID", "test")
+os.environ.setdefault("LOGGING_LEVEL", "ERROR")
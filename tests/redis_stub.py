@@ -0,0 +1,222 @@
+"""
+In-process stand-in for a Redis protocol server, just the commands store.py sends, so the REDIS cache TYPE can be
+tested without a store. Keys expire by time.time(), so a test patching it moves the store's clock too
+"""
+
+import fnmatch
+import socket
+import socketserver
+import threading
+import time
+
+
+class _Error(Exception):
+    pass
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.authenticated = self.server.password is None
+        with self.server.lock:
+            self.server.handlers.add(self)
+        while True:
+            try:
+                command = self.read_command()
+            except (OSError, ValueError):
+                return
+            if command is None:
+                return
+            try:
+                reply = self.server.call(self, command)
+            except _Error as ex:
+                reply = ex
+            self.wfile.write(encode(reply))
+
+    def finish(self):
+        with self.server.lock:
+            self.server.handlers.discard(self)
+        try:
+            super(_Handler, self).finish()
+        except OSError:
+            pass
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if line[:1] != b"*":
+            raise ValueError("Expecting an array, got " + repr(line))
+        command = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            command.append(self.rfile.read(length + 2)[:-2])
+        return command
+
+
+def encode(reply):
+    if isinstance(reply, _Error):
+        return b"-" + str(reply).encode("utf-8") + b"\r\n"
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, str):
+        return b"+" + reply.encode("utf-8") + b"\r\n"
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    return b"*%d\r\n" % len(reply) + b"".join(encode(each_reply) for each_reply in reply)
+
+
+class RedisStub(socketserver.ThreadingTCPServer):
+    """Keeps strings as bytes, sets as set and sorted sets as dict of member to score. commands lists every command
+    received, connections counts the connections accepted. stop closes the open connections too, like a store that
+    went away"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password=None):
+        super(RedisStub, self).__init__(("127.0.0.1", 0), _Handler)
+        self.password = password
+        self.data = {}
+        self.expires = {}
+        self.commands = []
+        self.connections = 0
+        self.handlers = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "redis://127.0.0.1:%d/0" % self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            handlers = list(self.handlers)
+        for handler in handlers:
+            try:
+                handler.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        super(RedisStub, self).process_request(request, client_address)
+
+    def names(self):
+        """Returns the name of each command received, in order"""
+
+        return [command[0].decode("utf-8").upper() for command in self.commands]
+
+    def call(self, handler, command):
+        with self.lock:
+            self.commands.append(command)
+            name = command[0].decode("utf-8").upper()
+            if name == "AUTH":
+                if command[1].decode("utf-8") != self.password:
+                    raise _Error("WRONGPASS invalid password")
+                handler.authenticated = True
+                return "OK"
+            if not handler.authenticated:
+                raise _Error("NOAUTH Authentication required.")
+            method = getattr(self, "do_" + name.lower(), None)
+            if method is None:
+                raise _Error("ERR unknown command '" + name + "'")
+            return method(*command[1:])
+
+    def _get(self, key, kind):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        value = self.data.get(key)
+        if value is not None and not isinstance(value, kind):
+            raise _Error("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def do_ping(self):
+        return "PONG"
+
+    def do_select(self, db):
+        return "OK"
+
+    def do_get(self, key):
+        return self._get(key, bytes)
+
+    def do_set(self, key, value, *options):
+        options = [option.upper() for option in options]
+        if b"NX" in options and self._get(key, object) is not None:
+            return None
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if b"PX" in options:
+            self.expires[key] = time.time() + int(options[options.index(b"PX") + 1]) / 1000
+        return "OK"
+
+    def do_del(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self._get(key, object) is not None:
+                del self.data[key]
+                deleted += 1
+            self.expires.pop(key, None)
+        return deleted
+
+    def do_exists(self, *keys):
+        return sum(1 for key in keys if self._get(key, object) is not None)
+
+    def do_pexpire(self, key, milliseconds):
+        if self._get(key, object) is None:
+            return 0
+        self.expires[key] = time.time() + int(milliseconds) / 1000
+        return 1
+
+    def do_scan(self, cursor, *options):
+        pattern = options[options.index(b"MATCH") + 1] if b"MATCH" in options else b"*"
+        keys = [key for key in list(self.data) if self._get(key, object) is not None and fnmatch.fnmatchcase(key, pattern)]
+        return [b"0", keys]
+
+    def do_sadd(self, key, *members):
+        members_set = self._get(key, set)
+        if members_set is None:
+            members_set = self.data[key] = set()
+        added = len(set(members) - members_set)
+        members_set.update(members)
+        return added
+
+    def do_sismember(self, key, member):
+        return int(member in (self._get(key, set) or ()))
+
+    def do_zadd(self, key, score, member):
+        scores = self._get(key, dict)
+        if scores is None:
+            scores = self.data[key] = {}
+        added = int(member not in scores)
+        scores[member] = float(score)
+        return added
+
+    def do_zcard(self, key):
+        return len(self._get(key, dict) or ())
+
+    def do_zremrangebyscore(self, key, low, high):
+        scores = self._get(key, dict) or {}
+        removed = [member for member, score in scores.items() if float(low) <= score <= float(high)]
+        for member in removed:
+            del scores[member]
+        return len(removed)
+
+    def do_zpopmin(self, key, count=b"1"):
+        scores = self._get(key, dict) or {}
+        popped = sorted(scores.items(), key=lambda item: (item[1], item[0]))[:int(count)]
+        reply = []
+        for member, score in popped:
+            del scores[member]
+            reply += [member, repr(score).encode("utf-8")]
+        return reply
@@ -0,0 +1,101 @@
+import time
+import unittest
+from unittest import mock
+
+import cache
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # one shard so the LRU order is the whole cache's
+        self.cache = cache.Cache("test", 3, shards=1)
+
+    def tearDown(self):
+        cache._CACHES.remove(self.cache)
+
+    def test_evicts_least_recently_used(self):
+        self.cache["a"] = 1
+        self.cache["b"] = 2
+        self.cache["c"] = 3
+        # reading a makes b the least recently used
+        self.assertEqual(self.cache.get("a"), 1)
+        self.cache["d"] = 4
+
+        self.assertNotIn("b", self.cache)
+        self.assertEqual([self.cache.get(key) for key in "acd"], [1, 3, 4])
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_evicts_in_insertion_order_without_reads(self):
+        for number, key in enumerate("abcde"):
+            self.cache.set(key, number)
+
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual([key for key in "abcde" if key in self.cache], ["c", "d", "e"])
+
+    def test_entry_expires_after_ttl(self):
+        now = time.monotonic()
+        with mock.patch("time.monotonic", return_value=now):
+            self.cache.set("a", 1, ttl=10)
+            self.cache.set("b", 2)
+        with mock.patch("time.monotonic", return_value=now + 9):
+            self.assertEqual(self.cache.get("a"), 1)
+        with mock.patch("time.monotonic", return_value=now + 10):
+            self.assertIsNone(self.cache.get("a"))
+            # no ttl, it never expires
+            self.assertEqual(self.cache.get("b"), 2)
+        self.assertEqual(self.cache.stats()["expirations"], 1)
+
+    def test_default_ttl(self):
+        expiring = cache.Cache("test-ttl", 3, ttl=5, shards=1)
+        self.addCleanup(cache._CACHES.remove, expiring)
+        now = time.monotonic()
+        with mock.patch("time.monotonic", return_value=now):
+            expiring["a"] = 1
+            expiring.set("b", 2, ttl=60)
+        with mock.patch("time.monotonic", return_value=now + 5):
+            self.assertNotIn("a", expiring)
+            self.assertIn("b", expiring)
+
+    def test_expire_removes_only_expired_entries(self):
+        now = time.monotonic()
+        with mock.patch("time.monotonic", return_value=now):
+            self.cache.set("a", 1, ttl=1)
+            self.cache.set("b", 2, ttl=5)
+            self.cache.set("c", 3)
+        with mock.patch("time.monotonic", return_value=now + 2):
+            self.assertEqual(self.cache.expire(), 1)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_add_only_when_missing_or_expired(self):
+        now = time.monotonic()
+        with mock.patch("time.monotonic", return_value=now):
+            self.assertTrue(self.cache.add("a", 1, ttl=1))
+            self.assertFalse(self.cache.add("a", 2))
+            self.assertEqual(self.cache["a"], 1)
+        with mock.patch("time.monotonic", return_value=now + 1):
+            self.assertTrue(self.cache.add("a", 3))
+            self.assertEqual(self.cache["a"], 3)
+
+    def test_pop_and_delete(self):
+        self.cache["a"] = 1
+        self.assertEqual(self.cache.pop("a"), 1)
+        self.assertIsNone(self.cache.pop("a"))
+        with self.assertRaises(KeyError):
+            del self.cache["a"]
+        with self.assertRaises(KeyError):
+            self.cache["a"]
+
+    def test_shards_split_max_size(self):
+        sharded = cache.Cache("test-shards", 8, shards=4)
+        self.addCleanup(cache._CACHES.remove, sharded)
+        for number in range(100):
+            sharded[number] = number
+
+        self.assertEqual(len(sharded._shards), 4)
+        self.assertLessEqual(len(sharded), 8)
+        self.assertTrue(all(len(shard.entries) <= 2 for shard in sharded._shards))
+
+
+if __name__ == '__main__':
+    unittest.main()
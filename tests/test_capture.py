@@ -0,0 +1,85 @@
+import json
+import unittest
+
+import capture
+
+EVENT = {
+    "token": "verification-token",
+    "team_id": "T0123ABCD",
+    "api_app_id": "A0123ABCD",
+    "authorizations": [{"user_id": "U0BOT", "is_bot": True}],
+    "type": "event_callback",
+    "event_id": "Ev0123ABCD",
+    "event": {
+        "type": "message",
+        "channel_type": "im",
+        "user": "U012AB3CD",
+        "channel": "D012AB3CD",
+        "ts": "1600000000.000100",
+        "text": "<@U0BOT> book room 42 for jane.doe@example.com, token xoxb-1234-abcd"
+    }
+}
+
+
+class SanitizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sanitized = capture.sanitize(EVENT)
+        self.captured = json.dumps(self.sanitized)
+
+    def test_drops_secrets_and_callback_urls(self):
+        payload = {"token": "secret", "response_url": "https://hooks.slack.com/actions/T0/1/abc", "api_key": "key",
+                   "actions": [{"token": "nested-secret", "type": "button"}]}
+
+        self.assertEqual(capture.sanitize(payload), {"actions": [{"type": "button"}]})
+        self.assertNotIn("verification-token", self.captured)
+        self.assertNotIn("authorizations", self.sanitized)
+
+    def test_masks_text_keeping_its_shape(self):
+        text = self.sanitized["event"]["text"]
+
+        self.assertEqual(len(text), len(EVENT["event"]["text"]) - len("U0BOT") + 11)
+        self.assertTrue(text.endswith(" xxxx xxxx 00 xxx xxxx.xxx@xxxxxxx.xxx, xxxxx xxxx-0000-xxxx"))
+        for secret in ("jane", "example.com", "xoxb", "1234", "42"):
+            self.assertNotIn(secret, self.captured)
+
+    def test_masks_emails_and_names_in_profiles(self):
+        profile = capture.sanitize({"user": {"id": "U012AB3CD", "tz": "America/New_York",
+                                             "profile": {"real_name": "Jane Doe", "email": "jane.doe@example.com"}}})
+
+        self.assertEqual(profile["user"]["profile"], {"real_name": "xxxx xxx", "email": "xxxx.xxx@xxxxxxx.xxx"})
+
+    def test_replaces_slack_ids_with_stable_pseudonyms(self):
+        user = self.sanitized["event"]["user"]
+
+        self.assertNotEqual(user, "U012AB3CD")
+        self.assertEqual(user[0], "U")
+        self.assertEqual(user, capture.pseudonym("U012AB3CD"))
+        self.assertNotEqual(user, capture.pseudonym("U012AB3CE"))
+        self.assertEqual(self.sanitized["event"]["channel"][0], "D")
+        # a mention points at the pseudonym of who it mentions
+        self.assertTrue(self.sanitized["event"]["text"].startswith("<@" + capture.pseudonym("U0BOT") + ">"))
+
+    def test_keeps_values_that_shape_the_traffic(self):
+        for key in ("type", "channel_type", "ts"):
+            self.assertEqual(self.sanitized["event"][key], EVENT["event"][key])
+        self.assertEqual(self.sanitized["event_id"], EVENT["event_id"])
+        self.assertEqual(capture.sanitize({"count": 3, "ok": True, "missing": None}),
+                         {"count": 3, "ok": True, "missing": None})
+
+    def test_masks_a_buttons_text_but_keeps_where_it_goes(self):
+        button = capture.sanitize({"value": "Room 42:1600000000.000100:MESSAGE"})
+
+        self.assertEqual(button["value"], "xxxx 00:1600000000.000100:MESSAGE")
+
+    def test_replaces_urls(self):
+        self.assertEqual(capture.sanitize({"image_url": "https://example.com/floor-3.png"}), {"image_url": "captured"})
+
+    def test_leaves_the_original_untouched(self):
+        # setUp sanitized EVENT itself
+        self.assertEqual(EVENT["event"]["user"], "U012AB3CD")
+        self.assertIn("token", EVENT)
+
+
+if __name__ == '__main__':
+    unittest.main()
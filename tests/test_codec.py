@@ -0,0 +1,76 @@
+import json
+import unittest
+
+import codec
+
+TEXT = 'He said "hi" \\ and left: café ☕ </script>\n'
+
+MESSAGE = codec.Template('{"metadata":{"deployment":"slackbot"},"channel":%s,"text":%s,"blocks":%s}')
+
+
+def installed_encoders():
+    return [name for name in codec.ENCODERS if codec.get_encoder(name) is not None]
+
+
+class TemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(codec.set_encoder, codec.get_encoder_name())
+
+    def test_renders_values_escaped_with_every_encoder(self):
+        blocks = [{"type": "section", "text": {"type": "mrkdwn", "text": TEXT}}, None, 1.5, True]
+        for name in installed_encoders():
+            with self.subTest(encoder=name):
+                codec.set_encoder(name)
+                rendered = MESSAGE.render("D1", TEXT, blocks)
+
+                self.assertEqual(json.loads(rendered), {"metadata": {"deployment": "slackbot"}, "channel": "D1",
+                                                        "text": TEXT, "blocks": blocks})
+
+    def test_template_that_is_not_json_fails_when_made(self):
+        with self.assertRaises(ValueError):
+            codec.Template('{"text":%s')
+        with self.assertRaises(ValueError):
+            codec.Template('{"text":"%s"')
+
+    def test_encoded_renders_the_same_json_as_its_dict(self):
+        value = {"metadata": {"deployment": "slackbot"}, "channel": "D1", "text": TEXT, "blocks": []}
+        encoded = codec.Encoded(value, MESSAGE, "D1", TEXT, [])
+        for name in installed_encoders():
+            with self.subTest(encoder=name):
+                codec.set_encoder(name)
+
+                self.assertEqual(json.loads(codec.dumps(encoded)), json.loads(codec.dumps(value)))
+                self.assertEqual(encoded, value)
+
+    def test_keys_that_are_not_str_are_still_encoded(self):
+        for name in installed_encoders():
+            with self.subTest(encoder=name):
+                codec.set_encoder(name)
+
+                self.assertEqual(json.loads(codec.dumps({1: "one", "two": 2 ** 70})), {"1": "one", "two": 2 ** 70})
+
+
+class DecoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(codec.set_decoder, codec.get_decoder_name())
+
+    def test_json_that_is_not_valid_raises_value_error(self):
+        for name in codec.DECODERS:
+            if codec.get_decoder(name) is None:
+                continue
+            with self.subTest(decoder=name):
+                codec.set_decoder(name)
+
+                self.assertEqual(codec.loads(b'{"text":"caf\\u00e9"}'), {"text": "café"})
+                with self.assertRaises(ValueError):
+                    codec.loads(b"<html>Bad gateway</html>")
+
+    def test_unknown_library_is_rejected(self):
+        with self.assertRaises(ValueError):
+            codec.get_encoder("SIMDJSON")
+
+
+if __name__ == '__main__':
+    unittest.main()
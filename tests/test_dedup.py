@@ -0,0 +1,121 @@
+import multiprocessing
+import unittest
+from unittest import mock
+
+import dedup
+import upstream
+
+
+class SharedTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patch = mock.patch("time.time", side_effect=lambda: self.now)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.table = dedup.SharedTable(max_size=8, ttl=60)
+
+    def test_sizes_the_table_to_a_power_of_two_past_twice_max_size(self):
+        self.assertEqual(self.table.slots, 16)
+        self.assertEqual(dedup.SharedTable(max_size=100, ttl=60).slots, 256)
+
+    def test_remembers_a_key_for_the_window(self):
+        self.assertTrue(self.table.add(42))
+        self.assertFalse(self.table.add(42))
+        self.now += 59
+        self.assertFalse(self.table.add(42))
+
+    def test_forgets_a_key_after_the_window(self):
+        self.table.add(42)
+        self.now += 60
+
+        self.assertTrue(self.table.add(42))
+        self.assertEqual(self.table.stats()["size"], 1)
+
+    def test_keys_landing_on_the_same_slot_are_kept_apart(self):
+        colliding = [5 + self.table.slots * number for number in range(4)]
+        for key in colliding:
+            self.assertTrue(self.table.add(key))
+
+        for key in colliding:
+            self.assertFalse(self.table.add(key))
+        self.assertEqual(self.table.stats()["size"], 4)
+
+    def test_key_0_is_not_taken_for_an_empty_slot(self):
+        self.assertTrue(self.table.add(0))
+        self.assertFalse(self.table.add(0))
+
+    def test_full_probe_range_reuses_the_slot_expiring_first(self):
+        # the table has as many slots as probes, so these fill every one
+        for key in range(1, dedup._PROBES + 1):
+            self.now += 1
+            self.assertTrue(self.table.add(key))
+        self.now += 1
+
+        self.assertTrue(self.table.add(dedup._PROBES + 1))
+        self.assertEqual(self.table.stats()["evictions"], 1)
+        # the first key expires first so it was the one dropped
+        self.assertTrue(self.table.add(1))
+        self.assertFalse(self.table.add(dedup._PROBES + 1))
+        self.assertFalse(self.table.add(dedup._PROBES))
+
+    def test_pop_forgets_a_key(self):
+        self.table.add(42)
+        self.table.pop(42)
+
+        self.assertTrue(self.table.add(42))
+
+
+def _add_in_child(table, key, results):
+    results.put(table.add(key))
+
+
+@unittest.skipUnless("fork" in multiprocessing.get_all_start_methods(), "needs fork")
+class SharedAcrossWorkersTest(unittest.TestCase):
+
+    def test_forked_worker_sees_the_same_table(self):
+        table = dedup.SharedTable(max_size=8, ttl=60)
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+
+        table.add(1)
+        child = context.Process(target=_add_in_child, args=(table, 1, results))
+        child.start()
+        child.join(5)
+        self.assertFalse(results.get(timeout=5))
+
+        child = context.Process(target=_add_in_child, args=(table, 2, results))
+        child.start()
+        child.join(5)
+        self.assertTrue(results.get(timeout=5))
+        self.assertFalse(table.add(2))
+
+
+class SeenTest(unittest.TestCase):
+
+    def setUp(self):
+        patch = mock.patch.object(dedup, "SEEN", dedup.SharedTable(max_size=8, ttl=60))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_a_retry_of_a_seen_event_is_a_duplicate(self):
+        self.assertFalse(dedup.seen("Ev1", None))
+        self.assertTrue(dedup.seen("Ev1", None, retry_num="1", retry_reason="http_timeout"))
+        dedup.forget("Ev1")
+        self.assertFalse(dedup.seen("Ev1", None, retry_num="2", retry_reason="http_timeout"))
+
+    def test_event_is_handled_when_the_store_is_down(self):
+        with mock.patch.object(dedup.SEEN, "add", side_effect=upstream.UpstreamUnavailableError("store down")), \
+                mock.patch.object(dedup.SEEN, "pop", side_effect=upstream.UpstreamUnavailableError("store down")):
+            self.assertFalse(dedup.seen("Ev1", None))
+            self.assertFalse(dedup.seen("Ev1", None, retry_num="1", retry_reason="http_timeout"))
+            dedup.forget("Ev1")
+
+    def test_keys_are_stable_8_byte_hashes(self):
+        self.assertEqual(dedup.get_key("Ev1"), dedup.get_key("Ev1"))
+        self.assertNotEqual(dedup.get_key("Ev1"), dedup.get_key("Ev2"))
+        self.assertLess(dedup.get_key("Ev1"), 2 ** 64)
+
+
+if __name__ == '__main__':
+    unittest.main()
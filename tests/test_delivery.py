@@ -0,0 +1,135 @@
+import json
+import unittest
+from unittest import mock
+
+import delivery
+import http_client
+
+URL = "https://slack.test/api/chat.postMessage"
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code=200, body=None, headers=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.content = json.dumps({"ok": True}).encode("utf-8") if body is None else body
+        self.text = self.content.decode("utf-8")
+        self.headers = headers or {}
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bucket = delivery.TokenBucket(rate=2, capacity=3)
+        self.bucket.updated = 100.0
+
+    def test_allows_a_burst_of_capacity_then_the_rate(self):
+        for _ in range(3):
+            self.assertEqual(self.bucket.ready_at(100.0), 100.0)
+            self.bucket.take()
+
+        self.assertEqual(self.bucket.ready_at(100.0), 100.5)
+
+    def test_refills_at_the_rate_up_to_capacity(self):
+        for _ in range(3):
+            self.bucket.take()
+
+        self.assertEqual(self.bucket.ready_at(100.5), 100.5)
+        self.assertAlmostEqual(self.bucket.tokens, 1.0)
+        self.bucket.ready_at(200.0)
+        self.assertEqual(self.bucket.tokens, 3)
+
+    def test_pause_holds_back_sends_until_it_ends(self):
+        self.bucket.pause(130.0)
+        # a shorter pause doesn't shorten it
+        self.bucket.pause(110.0)
+
+        self.assertEqual(self.bucket.ready_at(100.0), 130.0)
+        self.assertEqual(self.bucket.ready_at(131.0), 131.0)
+
+    def test_idle_only_when_full_and_not_paused(self):
+        self.assertTrue(self.bucket.is_idle(100.0))
+        self.bucket.take()
+        self.assertFalse(self.bucket.is_idle(100.0))
+        self.assertTrue(self.bucket.is_idle(101.0))
+        self.bucket.pause(200.0)
+        self.assertFalse(self.bucket.is_idle(150.0))
+
+
+class DeliveryQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = delivery.DeliveryQueue(workers=1, max_queue=100, channel_rate=100, channel_burst=10,
+                                            method_rates={}, default_method_rate=100, max_retries=2,
+                                            retry_seconds=0.01)
+        self.posted = []
+        self.responses = {}
+
+    def request(self, method, url, data=None, headers=None, timeout=None):
+        channel = json.loads(data)["channel"]
+        self.posted.append(channel)
+        answers = self.responses.get(channel)
+        return answers.pop(0) if answers else FakeResponse()
+
+    def send(self, channel):
+        self.assertTrue(self.queue.send(URL, json.dumps({"channel": channel}), {}, channel, "chat.postMessage"))
+
+    def test_delivers_in_order_per_channel(self):
+        with mock.patch.object(http_client, "request", side_effect=self.request):
+            for channel in ["C1", "C2", "C1"]:
+                self.send(channel)
+            self.assertTrue(self.queue.shutdown(5))
+
+        self.assertEqual(self.posted, ["C1", "C2", "C1"])
+        self.assertEqual(self.queue.stats()["delivered"], 3)
+
+    def test_answer_that_is_not_json_counts_as_failed_and_frees_the_channel(self):
+        self.responses["C1"] = [FakeResponse(body=b"<html>Bad gateway</html>"), FakeResponse(body=b"")]
+        with mock.patch.object(http_client, "request", side_effect=self.request):
+            for _ in range(3):
+                self.send("C1")
+            self.assertTrue(self.queue.shutdown(5))
+
+        stats = self.queue.stats()
+        self.assertEqual((stats["failed"], stats["delivered"]), (2, 1))
+        self.assertEqual(self.posted, ["C1", "C1", "C1"])
+
+    def test_worker_survives_a_failing_send(self):
+        with mock.patch.object(self.queue, "_post", side_effect=[RuntimeError("boom"), None]) as post:
+            self.send("C1")
+            self.send("C1")
+            self.assertTrue(self.queue.shutdown(5))
+
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(self.queue.stats()["failed"], 1)
+        self.assertNotIn("C1", self.queue._busy)
+
+    def test_rate_limit_pauses_only_its_channel(self):
+        self.responses["C1"] = [FakeResponse(429, headers={"Retry-After": "0.2"})]
+        with mock.patch.object(http_client, "request", side_effect=self.request):
+            self.send("C1")
+            self.send("C2")
+            self.assertTrue(self.queue.shutdown(5))
+
+        # C2 went out while C1 waited for its Retry-After
+        self.assertEqual(self.posted, ["C1", "C2", "C1"])
+        stats = self.queue.stats()
+        self.assertEqual((stats["rate_limited"], stats["retries"], stats["delivered"]), (1, 1, 2))
+
+    def test_prunes_idle_channel_buckets(self):
+        with mock.patch.object(http_client, "request", side_effect=self.request):
+            for number in range(5):
+                self.send("D" + str(number))
+            self.assertTrue(self.queue.shutdown(5))
+        self.assertEqual(len(self.queue._channel_buckets), 5)
+
+        self.queue._channel_buckets["D0"].pause(float("inf"))
+        self.queue._busy.add("D1")
+        self.queue._prune(self.queue._channel_buckets["D2"].updated + 60)
+
+        self.assertEqual(sorted(self.queue._channel_buckets), ["D0", "D1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import threading
+import unittest
+from unittest import mock
+
+import app
+import dispatcher
+import settings
+from classes import EventType, SlackEvent
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.ran = []
+        self.dispatcher = dispatcher.Dispatcher(pool_size=1, max_queue=1, lane_max_queue=2)
+
+    def tearDown(self):
+        self.release.set()
+        self.dispatcher.shutdown(timeout=5)
+
+    def block(self, name):
+        self.started.set()
+        self.release.wait(5)
+        self.ran.append(name)
+
+    def record(self, name):
+        self.ran.append(name)
+
+    def drain(self):
+        self.release.set()
+        self.assertTrue(self.dispatcher.shutdown(timeout=5))
+
+    def test_lane_runs_in_order(self):
+        self.assertTrue(self.dispatcher.submit(self.block, "first", lane="U1"))
+        self.started.wait(5)
+        self.assertTrue(self.dispatcher.submit(self.record, "second", lane="U1"))
+        self.assertTrue(self.dispatcher.submit(self.record, "third", lane="U1"))
+        self.drain()
+
+        self.assertEqual(self.ran, ["first", "second", "third"])
+
+    def test_lane_holds_lane_max_queue_behind_the_running_job(self):
+        self.dispatcher.submit(self.block, "running", lane="U1")
+        self.started.wait(5)
+
+        self.assertTrue(self.dispatcher.submit(self.record, "1", lane="U1"))
+        self.assertTrue(self.dispatcher.submit(self.record, "2", lane="U1"))
+        self.assertFalse(self.dispatcher.submit(self.record, "3", lane="U1"))
+        self.drain()
+
+        self.assertEqual(self.ran, ["running", "1", "2"])
+        self.assertEqual(self.dispatcher.stats()["rejected"], 1)
+
+    def test_coalesces_duplicate_waiting_job(self):
+        self.dispatcher.submit(self.block, "running", lane="U1", coalesce_key="a")
+        self.started.wait(5)
+
+        self.assertEqual(self.dispatcher.submit(self.record, "a", lane="U1", coalesce_key="a"), dispatcher.QUEUED)
+        self.assertEqual(self.dispatcher.submit(self.record, "a again", lane="U1", coalesce_key="a"),
+                         dispatcher.COALESCED)
+        self.drain()
+
+        self.assertEqual(self.ran, ["running", "a"])
+        self.assertEqual(self.dispatcher.stats()["coalesced"], 1)
+
+    def test_messages_with_the_same_text_are_not_coalesced(self):
+        first = SlackEvent(EventType.MESSAGE, "1600000000.000100", "D1", "U1", "yes", "Ev1")
+        second = SlackEvent(EventType.MESSAGE, "1600000000.000200", "D1", "U1", "yes", "Ev2")
+        self.dispatcher.submit(self.block, "running", lane="U1")
+        self.started.wait(5)
+
+        with mock.patch.object(settings, "WORKER_COALESCE", True):
+            for slack_event in (first, second):
+                self.assertEqual(self.dispatcher.submit(self.record, slack_event.event_id, lane="U1",
+                                                        coalesce_key=app.get_coalesce_key(slack_event)),
+                                 dispatcher.QUEUED)
+            # slack sending the first one again is dropped
+            self.assertEqual(self.dispatcher.submit(self.record, "Ev1 again", lane="U1",
+                                                    coalesce_key=app.get_coalesce_key(first)), dispatcher.COALESCED)
+        self.drain()
+
+        self.assertEqual(self.ran, ["running", "Ev1", "Ev2"])
+
+    def test_full_queue_rejects_a_new_lane_without_dropping_others(self):
+        self.dispatcher.submit(self.block, "running", lane="U1")
+        self.started.wait(5)
+        # fills the queue, its worker is busy
+        self.assertTrue(self.dispatcher.submit(self.record, "queued", lane="U2"))
+        self.assertTrue(self.dispatcher.submit(self.record, "behind queued", lane="U2"))
+
+        self.assertFalse(self.dispatcher.submit(self.record, "rejected", lane="U3"))
+        self.assertFalse(self.dispatcher.submit(self.record, "rejected"))
+        # the rejected lane isn't left reserved
+        self.assertNotIn("U3", self.dispatcher._lanes)
+        self.drain()
+
+        self.assertEqual(self.ran, ["running", "queued", "behind queued"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import logging
+import threading
+import unittest
+
+import logs
+
+
+def make_record(message, *args):
+    return logging.LogRecord("test", logging.DEBUG, __file__, 1, message, args, None)
+
+
+class PrepareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = logs._QueueHandler()
+        self.calls = []
+
+    def build(self, text):
+        self.calls.append(threading.get_ident())
+        return text.upper()
+
+    def test_lazy_arguments_are_built_when_the_record_is_written(self):
+        record = self.handler.prepare(make_record("Response: %s", logs.Lazy(self.build, "ok")))
+        self.assertEqual(self.calls, [])
+
+        writer = threading.Thread(target=lambda: self.assertEqual(record.getMessage(), "Response: OK"))
+        writer.start()
+        writer.join(5)
+        self.assertEqual(len(self.calls), 1)
+        self.assertNotEqual(self.calls[0], threading.get_ident())
+
+    def test_other_arguments_of_a_lazy_record_are_kept_as_they_were(self):
+        users = ["U1"]
+        record = self.handler.prepare(make_record("%s %s %d %s", logs.Lazy(self.build, "a"), users, 3, None))
+        users.append("U2")
+
+        self.assertEqual(record.getMessage(), "A ['U1'] 3 None")
+
+    def test_records_without_lazy_arguments_are_built_now(self):
+        users = ["U1"]
+        record = self.handler.prepare(make_record("users %s", users))
+        users.append("U2")
+
+        self.assertEqual((record.msg, record.args), ("users ['U1']", None))
+        self.assertEqual(self.handler.prepare(make_record("%(user)s", {"user": "U1"})).msg, "U1")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import re
+import unittest
+
+import metrics
+
+# name{label="value",...} value, as a scraper reads a sample line
+SAMPLE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="(\\.|[^"\\])*",?)*\})? \S+$')
+
+
+def get_samples(lines):
+    return {line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1]) for line in lines if not line.startswith("#")}
+
+
+class HistogramTest(unittest.TestCase):
+
+    def setUp(self):
+        self.histogram = metrics.Histogram("test_seconds", "Test latency", ["stage"], buckets=(0.1, 1.0))
+
+    def test_buckets_are_cumulative_and_end_with_inf_sum_and_count(self):
+        for value in (0.05, 0.1, 0.5, 3.0):
+            self.histogram.observe(value, stage="call_proxy")
+
+        lines = self.histogram.render()
+
+        self.assertEqual(lines[:2], ["# HELP test_seconds Test latency", "# TYPE test_seconds histogram"])
+        self.assertEqual(lines[2:], [
+            'test_seconds_bucket{stage="call_proxy",le="0.1"} 2.0',
+            'test_seconds_bucket{stage="call_proxy",le="1.0"} 3.0',
+            'test_seconds_bucket{stage="call_proxy",le="+Inf"} 4.0',
+            'test_seconds_sum{stage="call_proxy"} 3.65',
+            'test_seconds_count{stage="call_proxy"} 4.0'
+        ])
+
+    def test_each_label_value_gets_its_own_series(self):
+        self.histogram.observe(0.5, stage="b")
+        self.histogram.observe(0.5, stage="a")
+
+        samples = get_samples(self.histogram.render())
+
+        self.assertEqual(samples['test_seconds_count{stage="a"}'], 1.0)
+        self.assertEqual(samples['test_seconds_bucket{stage="b",le="0.1"}'], 0.0)
+        self.assertEqual(samples['test_seconds_bucket{stage="b",le="1.0"}'], 1.0)
+
+
+class CounterTest(unittest.TestCase):
+
+    def test_counts_per_label_values(self):
+        counter = metrics.Counter("test_total", "Test count", ["event_type", "stage"])
+        counter.inc(event_type="MESSAGE", stage="upstream")
+        counter.inc(2, event_type="MESSAGE", stage="upstream")
+        counter.inc(event_type="APP_MENTION", stage="upstream")
+
+        self.assertEqual(counter.render()[2:], ['test_total{event_type="APP_MENTION",stage="upstream"} 1.0',
+                                                'test_total{event_type="MESSAGE",stage="upstream"} 3.0'])
+
+    def test_label_values_are_escaped(self):
+        counter = metrics.Counter("test_total", "Test count", ["reason"])
+        counter.inc(reason='say "hi"\\\nbye')
+
+        line = counter.render()[2]
+
+        self.assertEqual(line, 'test_total{reason="say \\"hi\\"\\\\\\nbye"} 1.0')
+        self.assertRegex(line, SAMPLE)
+
+    def test_without_labels(self):
+        counter = metrics.Counter("test_total", "Test count")
+        counter.inc()
+
+        self.assertEqual(counter.render()[2:], ["test_total 1.0"])
+
+
+class RenderTest(unittest.TestCase):
+
+    def test_every_line_is_a_comment_or_a_sample(self):
+        metrics.STAGE_SECONDS.observe(0.2, stage="render_test")
+        metrics.count_error(metrics.get_event_type("MESSAGE"), 'render "test"')
+
+        body = metrics.render()
+
+        self.assertTrue(body.endswith("\n"))
+        for line in body.splitlines():
+            if not line.startswith("# HELP ") and not line.startswith("# TYPE "):
+                self.assertRegex(line, SAMPLE)
+        self.assertIn('slackbot_stage_seconds_bucket{stage="render_test",le="+Inf"} 1.0', body)
+        self.assertIn('slackbot_errors_total{event_type="MESSAGE",stage="render \\"test\\""} 1.0', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import json
+import unittest
+from unittest import mock
+
+import cache
+import profiles
+import settings
+import upstream
+
+
+class FakeResponse(object):
+
+    def __init__(self, body, status_code=200):
+        self.status_code = status_code
+        self.content = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        self.text = self.content.decode("utf-8")
+        self.headers = {}
+
+
+def get_member(number):
+    return {"id": "U" + str(number), "tz": "UTC",
+            "profile": {"real_name": "Person " + str(number), "email": str(number) + "@example.com"}}
+
+
+class ProfilesTest(unittest.TestCase):
+
+    def setUp(self):
+        user_cache = cache.Cache("test-user", 3, shards=1)
+        warm_cache = cache.Cache("test-warm", 1, shards=1)
+        self.addCleanup(cache._CACHES.remove, user_cache)
+        self.addCleanup(cache._CACHES.remove, warm_cache)
+        patches = [
+            mock.patch.object(cache, "user_cache", user_cache),
+            mock.patch.object(cache, "warm_cache", warm_cache),
+            mock.patch.object(settings, "MAX_USER_CACHE", 3)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_profile_that_is_not_json_is_cached_as_negative(self):
+        with mock.patch.object(upstream, "request", return_value=FakeResponse(b"<html>Bad gateway</html>")) as users_info:
+            user_context = profiles.get_user_context("U1")
+            self.assertEqual(profiles.get_user_context("U1"), user_context)
+
+        users_info.assert_called_once()
+        self.assertEqual(user_context["email"], "")
+        self.assertEqual(user_context["timezone"], settings.USER_DEFAULT_TIMEZONE)
+        self.assertFalse(cache.user_cache.get("U1")["ok"])
+
+    def test_profile_is_read_from_users_info(self):
+        with mock.patch.object(upstream, "request", return_value=FakeResponse({"ok": True, "user": get_member(1)})):
+            user_context = profiles.get_user_context("U1")
+
+        self.assertEqual(user_context["name"], {"first": "Person", "last": "1"})
+        self.assertEqual(user_context["email"], "1@example.com")
+
+    def test_filling_the_cache_keeps_the_warm_up_marker(self):
+        page = FakeResponse({"ok": True, "members": [get_member(number) for number in range(5)]})
+        with mock.patch.object(upstream, "request", return_value=page) as users_list:
+            self.assertEqual(profiles.warm(), 5)
+            # warmed recently, the next one is skipped
+            self.assertEqual(profiles.warm(), 0)
+
+        users_list.assert_called_once()
+        self.assertEqual(len(cache.user_cache), 3)
+
+    def test_users_list_that_is_not_json_stops_the_warm_up(self):
+        with mock.patch.object(upstream, "request", return_value=FakeResponse(b"")):
+            self.assertEqual(profiles.warm(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
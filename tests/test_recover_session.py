@@ -0,0 +1,95 @@
+import unittest
+from unittest import mock
+
+import app
+import cache
+import session_pool
+import sessions
+import settings
+from classes import ASSISTANT, EventType, InvalidSessionError, Session, SlackEvent, USER
+
+LOST_CONTEXT = "Sorry, I have lost the context.  Please, let's restart our conversation."
+
+
+class RecoverSessionTest(unittest.TestCase):
+    """A session the proxy no longer knows is replaced and the user's last message replayed on the new one, the
+    proxy is stubbed out"""
+
+    def setUp(self):
+        session_cache = cache.Cache("test-session", 10, shards=1)
+        self.addCleanup(cache._CACHES.remove, session_cache)
+        self.old_session = Session("lost", 7)
+        for speaker, text in ((USER, "book a room"), (ASSISTANT, "Which floor?"), (USER, "the third")):
+            self.old_session.add_turn(speaker, text)
+        session_cache.set("U1", self.old_session)
+        self.slack_event = SlackEvent(EventType.MESSAGE, "1600000000.000100", "D1", "U1", "the third", "Ev1")
+        self.reply = mock.Mock()
+        self.call_assistant = mock.Mock()
+        patches = [
+            mock.patch.object(sessions, "SESSIONS", session_cache),
+            mock.patch.object(session_pool, "take", return_value=None),
+            mock.patch.object(sessions, "create_wa_session", side_effect=lambda _: Session("new", 7)),
+            mock.patch.object(settings, "RECOVER_SESSIONS", True),
+            mock.patch.object(app, "get_user_context", return_value={}),
+            mock.patch.object(app, "get_assistant_context", return_value={}),
+            mock.patch.object(app, "call_proxy"),
+            mock.patch.object(app, "call_assistant", self.call_assistant)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_replays_the_last_message_on_a_new_session_with_the_history(self):
+        app.recover_session(self.slack_event, self.reply)
+
+        text, _, _, session = self.call_assistant.call_args[0]
+        self.assertEqual((text, session.session_id), ("the third", "new"))
+        self.assertEqual(list(session.turns), list(self.old_session.turns))
+        self.assertIs(sessions.SESSIONS.get("U1"), session)
+        self.reply.assert_not_called()
+        self.assertFalse(getattr(app.RECOVERING, "active", False))
+
+    def test_lost_message_during_a_turn_is_replayed(self):
+        self.call_assistant.side_effect = [InvalidSessionError("Invalid Session"), None]
+        # the turn adds the message itself
+        self.old_session.turns.pop()
+
+        app.respond_to_message(self.slack_event)
+
+        first, replay = self.call_assistant.call_args_list
+        self.assertEqual(first[0][3].session_id, "lost")
+        self.assertEqual((replay[0][0], replay[0][3].session_id), ("the third", "new"))
+        # the replay doesn't add the message to the history again
+        self.assertEqual(list(replay[0][3].turns), list(self.old_session.turns))
+        self.assertEqual([text for _, text in replay[0][3].turns], ["book a room", "Which floor?", "the third"])
+
+    def test_new_session_lost_too_isnt_recovered_again(self):
+        self.call_assistant.side_effect = InvalidSessionError("Invalid Session")
+
+        app.recover_session(self.slack_event, self.reply)
+
+        self.call_assistant.assert_called_once()
+        self.reply.assert_called_once_with(LOST_CONTEXT)
+        self.assertFalse(app.RECOVERING.active)
+
+    def test_without_a_message_to_replay_the_user_is_told(self):
+        self.old_session.turns.clear()
+
+        app.recover_session(self.slack_event, self.reply)
+
+        self.call_assistant.assert_not_called()
+        self.reply.assert_called_once_with(LOST_CONTEXT)
+        self.assertEqual(sessions.SESSIONS.get("U1").session_id, "new")
+
+    def test_recovery_turned_off_only_replaces_the_session(self):
+        settings.RECOVER_SESSIONS = False
+
+        app.recover_session(self.slack_event, self.reply)
+
+        self.call_assistant.assert_not_called()
+        self.reply.assert_called_once_with(LOST_CONTEXT)
+        self.assertEqual(sessions.SESSIONS.get("U1").session_id, "new")
+
+
+if __name__ == '__main__':
+    unittest.main()
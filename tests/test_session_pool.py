@@ -0,0 +1,119 @@
+import time
+import unittest
+from unittest import mock
+
+import app
+import cache
+import session_pool
+import sessions
+from classes import EventType, Session, SlackEvent, USER
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.01)
+
+
+class SessionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.made = 0
+        self.pool = session_pool.SessionPool(size=2, max_age=60, retry_seconds=0.01)
+
+    def make_session(self):
+        self.made += 1
+        return Session("pooled-" + str(self.made), 7)
+
+    def test_refills_to_size_and_replaces_taken_sessions(self):
+        self.pool.register(self.make_session)
+        self.pool.start()
+        wait_for(lambda: self.pool.stats()["ready"] == 2)
+
+        self.assertEqual(self.pool.take().session_id, "pooled-1")
+        wait_for(lambda: self.pool.stats()["created"] == 3)
+        self.assertEqual(self.pool.stats()["ready"], 2)
+        self.assertEqual(self.pool.stats()["taken"], 1)
+
+    def test_keeps_refilling_after_the_factory_fails(self):
+        factory = mock.Mock(side_effect=[RuntimeError("proxy down"), None, Session("pooled", 7)])
+        self.pool.size = 1
+        self.pool.register(factory)
+        self.pool.start()
+
+        wait_for(lambda: self.pool.stats()["ready"] == 1)
+        self.assertEqual(self.pool.stats()["failed"], 2)
+
+    def test_drops_sessions_older_than_max_age(self):
+        # without a factory nothing refills, so the queue is the test's
+        now = time.time()
+        self.pool._sessions.extend([Session("old", 7, timestamp=now - 61), Session("older", 7, timestamp=now - 60),
+                                    Session("fresh", 7, timestamp=now - 59)])
+
+        self.assertEqual(self.pool.take().session_id, "fresh")
+        self.assertEqual(self.pool.stats()["dropped"], 2)
+
+    def test_empty_pool_returns_none(self):
+        self.assertIsNone(self.pool.take())
+        self.assertEqual(self.pool.stats()["empty"], 1)
+
+    def test_no_refill_when_size_is_0(self):
+        self.pool.size = 0
+        self.pool.register(self.make_session)
+        self.pool.start()
+
+        self.assertIsNone(self.pool.take())
+        self.assertEqual(self.made, 0)
+
+
+class PooledSessionsTest(unittest.TestCase):
+    """The bot hands out pooled sessions to users starting a conversation, the refill thread isn't started"""
+
+    def setUp(self):
+        session_cache = cache.Cache("test-session", 10, shards=1)
+        self.addCleanup(cache._CACHES.remove, session_cache)
+        self.pooled = Session("pooled", 7)
+        self.new_session_for_user = mock.Mock(return_value=Session("created", 7))
+        patches = [
+            mock.patch.object(sessions, "SESSIONS", session_cache),
+            mock.patch.object(session_pool, "take", return_value=self.pooled),
+            mock.patch.object(sessions, "new_session_for_user", self.new_session_for_user),
+            mock.patch.object(app, "get_user_context", return_value={}),
+            mock.patch.object(app, "get_assistant_context", return_value={}),
+            mock.patch.object(app, "call_proxy")
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_new_user_gets_a_pooled_session(self):
+        self.assertIs(app.force_create_new_session("U1"), self.pooled)
+
+        self.assertIs(sessions.SESSIONS.get("U1"), self.pooled)
+        self.new_session_for_user.assert_not_called()
+        # it was greeted when made
+        app.call_proxy.assert_not_called()
+
+    def test_saying_hi_starts_over_on_a_pooled_session(self):
+        sessions.SESSIONS.set("U1", Session("current", 7))
+        slack_event = SlackEvent(EventType.MESSAGE, "1600000000.000100", "D1", "U1", "hi", "Ev1")
+
+        with mock.patch.object(app, "call_assistant") as call_assistant:
+            app.respond_to_message(slack_event)
+
+        self.assertIs(call_assistant.call_args[0][3], self.pooled)
+        self.assertEqual(list(self.pooled.turns), [(USER, "hi")])
+
+    def test_empty_pool_creates_and_greets_a_session(self):
+        session_pool.take.return_value = None
+
+        app.force_create_new_session("U1")
+
+        self.new_session_for_user.assert_called_once()
+        self.assertEqual(app.call_proxy.call_args[0][0], "hi")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import settings
+
+
+class BotIdTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        patches = [
+            mock.patch.object(settings, "BOT_ID", None),
+            mock.patch.object(settings, "AT_BOT", None),
+            mock.patch.object(settings, "AT_BOT_PATTERN", None),
+            mock.patch.object(settings, "BOT_ID_CACHE_FILE", Path(self.folder.name) / "bot_id.json")
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_resolves_from_slack_on_first_use_and_saves_it(self):
+        with mock.patch.object(settings, "get_slack_bot_id", return_value="UBOT") as auth_test:
+            self.assertEqual(settings.get_bot_id(), "UBOT")
+            self.assertEqual(settings.get_bot_id(), "UBOT")
+
+        auth_test.assert_called_once()
+        self.assertEqual(settings.AT_BOT, "<@UBOT>")
+        with open(settings.BOT_ID_CACHE_FILE) as cache_file:
+            self.assertEqual(json.load(cache_file)["bot_id"], "UBOT")
+
+    def test_uses_saved_id_for_the_same_token(self):
+        with open(settings.BOT_ID_CACHE_FILE, "w") as cache_file:
+            json.dump({"token": settings._token_hash(), "bot_id": "USAVED"}, cache_file)
+
+        with mock.patch.object(settings, "get_slack_bot_id", return_value="USAVED"), \
+                mock.patch("threading.Thread") as refresh:
+            self.assertEqual(settings.get_bot_id(), "USAVED")
+        refresh.return_value.start.assert_called_once()
+
+    def test_ignores_id_saved_for_another_token(self):
+        with open(settings.BOT_ID_CACHE_FILE, "w") as cache_file:
+            json.dump({"token": "other", "bot_id": "UOTHER"}, cache_file)
+
+        with mock.patch.object(settings, "get_slack_bot_id", return_value="UBOT"):
+            self.assertEqual(settings.get_bot_id(), "UBOT")
+
+    def test_mention_pattern_removes_the_mention_and_its_space(self):
+        settings._set_bot_id("UBOT")
+
+        pattern = settings.get_at_bot_pattern()
+        self.assertEqual(pattern.sub("", "<@UBOT> book a room"), "book a room")
+        self.assertEqual(pattern.sub("", "hey <@UBOT> book a room"), "hey book a room")
+        self.assertEqual(pattern.sub("", "hey <@UOTHER>"), "hey <@UOTHER>")
+
+
+if __name__ == '__main__':
+    unittest.main()
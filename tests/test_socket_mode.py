@@ -0,0 +1,135 @@
+import json
+import threading
+import unittest
+from unittest import mock
+
+import app
+import dispatcher
+import socket_mode
+from classes import EventType, SlackEvent
+
+
+class FakeConnection(object):
+    """Hands out the given messages, then the disconnect envelope slack sends before it closes a connection"""
+
+    def __init__(self, messages, fail_send=False):
+        self.messages = list(messages) + [json.dumps({"type": "disconnect", "reason": "refresh_requested"})]
+        self.fail_send = fail_send
+        self.sent = []
+
+    def recv(self):
+        return self.messages.pop(0)
+
+    def send(self, data):
+        if self.fail_send:
+            raise ConnectionError("connection lost")
+        self.sent.append(data)
+
+    def ping(self):
+        pass
+
+
+def get_envelope(number):
+    return json.dumps({"envelope_id": "env-" + str(number), "type": "events_api", "payload": {
+        "event_id": "Ev" + str(number), "event": {"type": "message", "channel_type": "im", "text": "hi"}}})
+
+
+class SocketModeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = socket_mode.SocketModeClient("xapp-test", max_in_flight=3, reconnect_max_seconds=1,
+                                                   read_timeout=1)
+        slack_event = SlackEvent(EventType.APP_MENTION, "1600000000.000100", "D1", "U1", "hi", "Ev0")
+        patches = [
+            mock.patch.object(app, "check_event", return_value=("OK", 200, slack_event)),
+            mock.patch.object(app, "get_lane", return_value="U1"),
+            mock.patch.object(app, "get_coalesce_key", return_value="hi")
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def free_slots(self):
+        return self.client._slots._value
+
+    def test_coalesced_envelopes_free_their_slot(self):
+        with mock.patch.object(dispatcher, "submit", return_value=dispatcher.COALESCED):
+            self.client._read(FakeConnection([get_envelope(number) for number in range(5)]))
+
+        self.assertEqual(self.free_slots(), 3)
+        self.assertEqual(self.client.stats()["in_flight"], 0)
+        self.assertEqual(self.client.stats()["coalesced"], 5)
+
+    def test_rejected_envelopes_free_their_slot(self):
+        with mock.patch.object(dispatcher, "submit", return_value=dispatcher.REJECTED):
+            self.client._read(FakeConnection([get_envelope(number) for number in range(5)]))
+
+        self.assertEqual(self.free_slots(), 3)
+        self.assertEqual(self.client.stats()["rejected"], 5)
+
+    def test_queued_envelope_holds_its_slot_until_it_runs(self):
+        jobs = []
+
+        def submit(func, *args, lane=None, coalesce_key=None):
+            jobs.append((func, args))
+            return dispatcher.QUEUED
+
+        with mock.patch.object(dispatcher, "submit", side_effect=submit):
+            self.client._read(FakeConnection([get_envelope(0), get_envelope(1)]))
+
+        self.assertEqual(self.free_slots(), 1)
+        self.assertEqual(self.client.stats()["in_flight"], 2)
+
+        handled = mock.Mock()
+        for func, args in jobs:
+            func(handled, *args[1:])
+        self.assertEqual(handled.call_count, 2)
+        self.assertEqual(self.free_slots(), 3)
+        self.assertEqual(self.client.stats()["in_flight"], 0)
+
+    def test_envelope_that_fails_to_route_frees_its_slot_and_reading_goes_on(self):
+        with mock.patch.object(app, "check_event", side_effect=KeyError("event_id")):
+            connection = FakeConnection([get_envelope(0), get_envelope(1)])
+            self.client._read(connection)
+
+        self.assertEqual(self.free_slots(), 3)
+        # both were acknowledged, then the disconnect was read
+        self.assertEqual(len(connection.sent), 2)
+
+    def test_failed_ack_frees_the_slot(self):
+        with self.assertRaises(ConnectionError):
+            self.client._read(FakeConnection([get_envelope(0)], fail_send=True))
+
+        self.assertEqual(self.free_slots(), 3)
+
+    def test_invalid_message_frees_the_slot(self):
+        with self.assertRaises(ValueError):
+            self.client._read(FakeConnection(["not json"]))
+
+        self.assertEqual(self.free_slots(), 3)
+
+    def test_coalesced_duplicates_on_a_real_dispatcher_free_their_slots(self):
+        running = dispatcher.Dispatcher(pool_size=1, max_queue=10)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        started = []
+
+        def block(slack_event):
+            started.append(slack_event)
+            release.wait(5)
+
+        with mock.patch.object(dispatcher, "submit", side_effect=running.submit), \
+                mock.patch.object(app, "handle_message", side_effect=block):
+            # the first one runs, the second waits in the lane and the third is merged into it
+            self.client._read(FakeConnection([get_envelope(number) for number in range(3)]))
+            self.assertEqual(self.free_slots(), 1)
+            release.set()
+            self.assertTrue(running.shutdown(5))
+
+        self.assertEqual(len(started), 2)
+        self.assertEqual(self.free_slots(), 3)
+        self.assertEqual(self.client.stats()["in_flight"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,293 @@
+import unittest
+from unittest import mock
+
+import app
+import cache
+import sessions
+import settings
+import store
+import upstream
+from classes import EventType, SlackEvent
+from tests.redis_stub import RedisStub
+
+
+class StoreTestCase(unittest.TestCase):
+    """Points the store client at a stand-in server, the tests run with the LOCAL cache TYPE so the prefix is set
+    here"""
+
+    def setUp(self):
+        self.stub = RedisStub().start()
+        self.addCleanup(self.stub.stop)
+        self.client = store.RedisClient(self.stub.url, pool_size=2, timeout=2.0)
+        patches = [
+            mock.patch.object(store, "_CLIENT", self.client),
+            mock.patch.object(settings, "REDIS_PREFIX", "test:", create=True)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def count(self, name):
+        return self.stub.names().count(name)
+
+
+class RedisClientTest(StoreTestCase):
+
+    def test_pipeline_returns_every_reply_in_order(self):
+        replies = self.client.pipeline([("SET", "a", "1"), ("GET", "a"), ("BOGUS",), ("GET", "missing"),
+                                        ("SADD", "s", "x", "y")])
+
+        self.assertEqual(replies[:2], ["OK", b"1"])
+        self.assertIsInstance(replies[2], store.RedisError)
+        self.assertEqual(replies[3:], [None, 2])
+
+    def test_execute_raises_an_error_reply(self):
+        with self.assertRaises(store.RedisError):
+            self.client.execute("BOGUS")
+
+    def test_connections_are_reused(self):
+        for number in range(5):
+            self.client.execute("SET", "key", number)
+
+        self.assertEqual(self.stub.connections, 1)
+        self.assertEqual(self.client.execute("GET", "key"), b"4")
+
+    def test_authenticates_and_selects_the_database_on_connect(self):
+        self.stub.password = "p@ss"
+        client = store.RedisClient(self.stub.url.replace("//", "//:p%40ss@")[:-1] + "2")
+
+        self.assertEqual(client.execute("PING"), "PONG")
+        self.assertEqual(self.stub.names()[:2], ["AUTH", "SELECT"])
+        self.assertEqual(self.stub.commands[1][1], b"2")
+
+    def test_wrong_password_fails_to_connect(self):
+        self.stub.password = "secret"
+
+        with self.assertRaises(store.RedisError):
+            store.RedisClient(self.stub.url.replace("//", "//:wrong@")).execute("PING")
+
+
+class RedisCacheTest(StoreTestCase):
+
+    def setUp(self):
+        super(RedisCacheTest, self).setUp()
+        self.now = 1000.0
+        patch = mock.patch("time.time", side_effect=lambda: self.now)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.cache = store.RedisCache("session", ttl=60)
+
+    def test_values_round_trip_through_the_store(self):
+        self.cache.set("U1", {"id": "session-1", "history": ["hi", "café"]})
+
+        self.assertEqual(self.cache.get("U1"), {"id": "session-1", "history": ["hi", "café"]})
+        self.assertIn(b"test:session:U1", self.stub.data)
+        self.assertIsNone(self.cache.get("U2"))
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 1})
+
+    def test_values_expire_after_the_ttl(self):
+        self.cache.set("U1", 1)
+        self.cache.set("U2", 2, ttl=120)
+        self.now += 60
+
+        self.assertIsNone(self.cache.get("U1"))
+        self.assertEqual(self.cache.get("U2"), 2)
+
+    def test_add_only_sets_a_key_that_isnt_stored(self):
+        self.assertTrue(self.cache.add("Ev1", 1, ttl=10))
+        self.assertFalse(self.cache.add("Ev1", 2, ttl=10))
+
+        self.assertEqual(self.stub.commands[-1], [b"SET", b"test:session:Ev1", b"2", b"PX", b"10000", b"NX"])
+        self.assertEqual(self.cache.get("Ev1"), 1)
+        self.now += 10
+        self.assertTrue(self.cache.add("Ev1", 3, ttl=10))
+
+    def test_pop_returns_and_deletes(self):
+        self.cache.set("U1", 1)
+
+        self.assertEqual(self.cache.pop("U1"), 1)
+        self.assertEqual(self.cache.pop("U1", "gone"), "gone")
+        with self.assertRaises(KeyError):
+            del self.cache["U1"]
+
+    def test_encode_and_decode_are_applied(self):
+        shared_cache = store.RedisCache("user", encode=sorted, decode=set)
+        shared_cache.set("U1", {"b", "a"})
+
+        self.assertEqual(self.stub.data[b"test:user:U1"], b'["a","b"]')
+        self.assertEqual(shared_cache.get("U1"), {"a", "b"})
+
+    def test_clear_and_len_only_see_the_caches_keys(self):
+        other = store.RedisCache("user")
+        for key in "abc":
+            self.cache.set(key, 1)
+        other.set("a", 1)
+
+        self.assertEqual(len(self.cache), 3)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(other.get("a"), 1)
+
+
+class BatchTest(StoreTestCase):
+
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        self.sessions = store.RedisCache("session")
+        self.users = store.RedisCache("user")
+        self.sessions.set("U1", "session-1")
+        self.users.set("U1", {"name": "Jane"})
+        self.stub.commands.clear()
+
+    def test_get_many_fetches_in_one_round_trip(self):
+        with mock.patch.object(self.client, "pipeline", wraps=self.client.pipeline) as pipeline:
+            values = store.get_many([(self.sessions, "U1"), (self.users, "U1"), (self.users, "U2")])
+
+        self.assertEqual(values, ["session-1", {"name": "Jane"}, None])
+        pipeline.assert_called_once()
+
+    def test_reads_are_remembered_within_a_batch(self):
+        with store.batch():
+            store.get_many([(self.sessions, "U1"), (self.users, "U1")])
+            self.assertEqual(self.sessions.get("U1"), "session-1")
+            self.assertEqual(self.users["U1"], {"name": "Jane"})
+
+        self.assertEqual(self.count("GET"), 2)
+        # outside a batch every read goes to the store
+        self.sessions.get("U1")
+        self.assertEqual(self.count("GET"), 3)
+
+    def test_writes_are_held_back_until_the_outermost_batch_ends(self):
+        with mock.patch.object(self.client, "pipeline", wraps=self.client.pipeline) as pipeline:
+            with store.batch():
+                self.sessions.set("U1", "session-2")
+                with store.batch():
+                    self.users.set("U1", {"name": "Jo"})
+                    self.sessions.set("U1", "session-3")
+                # the nested batch ending doesn't write
+                self.assertEqual(self.stub.commands, [])
+                # but reads in the batch see the writes
+                self.assertEqual(self.sessions.get("U1"), "session-3")
+            self.assertIsNone(store._current_batch())
+
+        pipeline.assert_called_once()
+        self.assertEqual(self.stub.names(), ["SET", "SET"])
+        self.assertEqual(self.sessions.get("U1"), "session-3")
+        self.assertEqual(self.users.get("U1"), {"name": "Jo"})
+
+    def test_pop_in_a_batch_drops_the_pending_write(self):
+        with store.batch():
+            self.sessions.set("U1", "session-2")
+            self.assertEqual(self.sessions.pop("U1"), "session-1")
+
+        self.assertNotIn("SET", self.stub.names())
+        self.assertIsNone(self.sessions.get("U1"))
+
+    def test_writes_are_sent_when_the_batch_fails(self):
+        with self.assertRaises(RuntimeError):
+            with store.batch():
+                self.sessions.set("U1", "session-2")
+                raise RuntimeError("boom")
+
+        self.assertEqual(self.sessions.get("U1"), "session-2")
+
+
+class RedisSetCacheTest(StoreTestCase):
+
+    def setUp(self):
+        super(RedisSetCacheTest, self).setUp()
+        self.now = 1000.0
+        patch = mock.patch("time.time", side_effect=lambda: self.now)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.threads = store.RedisSetCache("thread", 2, ttl=60)
+
+    def test_has_member_tells_a_missing_set_from_a_missing_member(self):
+        self.assertIsNone(self.threads.has_member("1600000000.000100", "U1"))
+        self.threads.add_member("1600000000.000100", "U1")
+
+        self.assertTrue(self.threads.has_member("1600000000.000100", "U1"))
+        self.assertFalse(self.threads.has_member("1600000000.000100", "U2"))
+        self.assertEqual(self.stub.names()[-2:], ["EXISTS", "SISMEMBER"])
+
+    def test_set_expires_without_a_new_member(self):
+        self.threads.add_member("t1", "U1")
+        self.now += 30
+        self.threads.add_member("t1", "U2")
+        self.now += 59
+
+        self.assertTrue(self.threads.has_member("t1", "U1"))
+        self.now += 1
+        self.assertIsNone(self.threads.has_member("t1", "U1"))
+        # the next add forgets it in the index too
+        self.threads.add_member("t2", "U1")
+        self.assertEqual(len(self.threads), 1)
+
+    def test_evicts_the_least_recently_added_to_past_max_size(self):
+        for thread, user in (("t1", "U1"), ("t2", "U1"), ("t1", "U2"), ("t3", "U1")):
+            self.now += 1
+            self.threads.add_member(thread, user)
+
+        # t1 was added to after t2, so t2 went
+        self.assertIsNone(self.threads.has_member("t2", "U1"))
+        self.assertTrue(self.threads.has_member("t1", "U1"))
+        self.assertTrue(self.threads.has_member("t3", "U1"))
+        self.assertEqual(self.count("ZPOPMIN"), 1)
+        self.assertEqual(self.threads.stats()["size"], 2)
+        self.assertEqual(self.threads.stats()["evictions"], 1)
+
+    def test_clear_drops_the_index(self):
+        self.threads.add_member("t1", "U1")
+        self.threads.clear()
+
+        self.assertEqual(len(self.threads), 0)
+        self.assertEqual(self.stub.data, {})
+
+
+class StoreOutageTest(StoreTestCase):
+
+    def setUp(self):
+        super(StoreOutageTest, self).setUp()
+        self.sessions = store.RedisCache("session")
+        self.users = store.RedisCache("user")
+
+    def test_store_that_went_away_raises_unavailable(self):
+        self.sessions.set("U1", "session-1")
+        self.stub.stop()
+
+        # the pooled connection was dropped, then there is nothing to connect to
+        for _ in range(2):
+            with self.assertRaises(store.StoreUnavailableError):
+                self.sessions.get("U1")
+
+    def test_failed_write_back_is_logged_not_raised(self):
+        with self.assertLogs("store", "ERROR") as logged:
+            with store.batch():
+                self.sessions.set("U1", "session-1")
+                self.users.set("U1", {"name": "Jane"})
+                self.stub.stop()
+
+        self.assertIn("Failed to write 2 values", logged.output[0])
+
+    def test_turn_answers_with_the_degraded_message(self):
+        patches = [
+            mock.patch.object(settings, "TYPE", "REDIS"),
+            mock.patch.object(sessions, "SESSIONS", self.sessions),
+            mock.patch.object(cache, "user_cache", self.users),
+            mock.patch.object(settings, "get_bot_id", return_value="UBOT")
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.stub.stop()
+        slack_event = SlackEvent(EventType.APP_MENTION, "1600000000.000100", "D1", "U1", "book a room", "Ev1")
+
+        with mock.patch.object(app, "post_to_slack") as post_to_slack:
+            app.handle_message(slack_event)
+
+        post_to_slack.assert_called_once_with(slack_event, settings.UPSTREAM_DEGRADED_MESSAGE)
+        self.assertTrue(issubclass(store.StoreUnavailableError, upstream.UpstreamUnavailableError))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+
+import app
+import async_app
+import async_http_client
+import http_client
+import settings
+import upstream
+from classes import Session
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, content=b"{}"):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.content = content
+        self.text = content.decode("utf-8")
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patch = mock.patch("time.monotonic", side_effect=lambda: self.now)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.breaker = upstream.CircuitBreaker("test", failure_threshold=3, reset_seconds=10)
+
+    def fail(self, times):
+        for _ in range(times):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.failure()
+
+    def test_opens_after_failure_threshold_in_a_row(self):
+        self.fail(2)
+        self.assertEqual(self.breaker.stats()["state"], upstream.CLOSED)
+        self.fail(1)
+
+        self.assertEqual(self.breaker.stats()["state"], upstream.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.stats()["rejected"], 1)
+
+    def test_success_resets_the_failures(self):
+        self.fail(2)
+        self.breaker.success()
+        self.fail(2)
+
+        self.assertEqual(self.breaker.stats()["state"], upstream.CLOSED)
+
+    def test_release_keeps_the_failures(self):
+        self.fail(2)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.release()
+        self.fail(1)
+
+        self.assertEqual(self.breaker.stats()["state"], upstream.OPEN)
+
+    def test_half_open_lets_one_probe_through_then_closes_on_success(self):
+        self.fail(3)
+        self.now += 10
+
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.stats()["state"], upstream.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.success()
+
+        self.assertEqual(self.breaker.stats()["state"], upstream.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_opens_it_again(self):
+        self.fail(3)
+        self.now += 10
+        self.fail(1)
+
+        self.assertEqual(self.breaker.stats()["state"], upstream.OPEN)
+        self.assertEqual(self.breaker.stats()["opened"], 2)
+        self.now += 9
+        self.assertFalse(self.breaker.allow())
+
+    def test_released_probe_lets_another_through(self):
+        self.fail(3)
+        self.now += 10
+        self.assertTrue(self.breaker.allow())
+        self.breaker.release()
+
+        self.assertEqual(self.breaker.stats()["state"], upstream.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+
+
+class RequestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = upstream.CircuitBreaker("proxy", failure_threshold=2, reset_seconds=60)
+        patch = mock.patch.dict(upstream.BREAKERS, {"proxy": self.breaker})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def call(self, response):
+        with mock.patch.object(http_client, "request", return_value=response):
+            return upstream.request("proxy", "POST", "http://proxy.test")
+
+    def test_client_error_is_returned_without_closing_the_breaker(self):
+        self.breaker.failure()
+        self.assertEqual(self.call(FakeResponse(404)).status_code, 404)
+        self.breaker.failure()
+
+        self.assertEqual(self.breaker.stats()["state"], upstream.OPEN)
+
+    def test_server_error_counts_as_failure(self):
+        with self.assertRaises(upstream.UpstreamUnavailableError):
+            self.call(FakeResponse(503))
+        self.assertEqual(self.breaker.stats()["failed"], 1)
+
+    def test_proxy_refusing_every_message_opens_the_breaker(self):
+        session = Session("session-1", 10)
+        for _ in range(2):
+            response = self.call(FakeResponse(401, b'{"message": "Unauthorized"}'))
+            with self.assertRaises(upstream.UpstreamUnavailableError):
+                app.read_proxy_response(response.ok, app.parse_proxy_response(response.content), response.text,
+                                        None, session)
+
+        self.assertEqual(self.breaker.stats()["state"], upstream.OPEN)
+
+    def test_retries_a_server_error_then_returns_the_answer(self):
+        with mock.patch.object(settings, "UPSTREAM_RETRY_BACKOFF", 0), \
+                mock.patch.object(http_client, "request", side_effect=[FakeResponse(502), FakeResponse(200)]):
+            self.assertEqual(upstream.request("proxy", "POST", "http://proxy.test", retries=1).status_code, 200)
+
+        self.assertEqual((self.breaker.stats()["failed"], self.breaker.stats()["state"]), (1, upstream.CLOSED))
+
+    def test_awaited_requests_treat_answers_the_same_way(self):
+        async def request(*args, **kwargs):
+            return answers.pop(0)
+
+        answers = [FakeResponse(502), FakeResponse(404), FakeResponse(502)]
+        with mock.patch.object(settings, "UPSTREAM_RETRY_BACKOFF", 0), \
+                mock.patch.object(async_http_client, "request", side_effect=request):
+            response = asyncio.run(async_app.request_upstream("proxy", "POST", "http://proxy.test", retries=1))
+            self.assertEqual(response.status_code, 404)
+            with self.assertRaises(upstream.UpstreamUnavailableError):
+                asyncio.run(async_app.request_upstream("proxy", "POST", "http://proxy.test"))
+
+        # the 404 neither counted as a failure nor reset the one before it
+        self.assertEqual(self.breaker.stats()["state"], upstream.OPEN)
+
+    def test_invalid_session_is_not_a_failure(self):
+        response = self.call(FakeResponse(400, b'{"message": "Invalid Session"}'))
+        with self.assertRaises(app.InvalidSessionError):
+            app.read_proxy_response(response.ok, app.parse_proxy_response(response.content), response.text,
+                                    None, Session("session-1", 10))
+
+        self.assertEqual(self.breaker.stats()["failed"], 0)
+
+
+class CallBlockingTest(unittest.TestCase):
+
+    def test_runs_in_place_outside_a_turn(self):
+        self.assertEqual(upstream.call_blocking("watson", threading.get_ident), threading.get_ident())
+
+    def test_returns_the_answer_or_raises_the_error_within_the_deadline(self):
+        with upstream.deadline(5):
+            self.assertEqual(upstream.call_blocking("watson", dict, session_id="s1"), {"session_id": "s1"})
+            with self.assertRaises(ZeroDivisionError):
+                upstream.call_blocking("watson", lambda: 1 / 0)
+
+    def test_stops_waiting_at_the_turns_deadline(self):
+        answered = threading.Event()
+        self.addCleanup(answered.set)
+        started = time.monotonic()
+
+        with upstream.deadline(0.2), self.assertRaises(upstream.UpstreamUnavailableError):
+            upstream.call_blocking("watson", answered.wait, 5)
+
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_keeps_the_turns_deadline(self):
+        with upstream.deadline(5):
+            left = upstream.call_blocking("watson", upstream.remaining)
+
+        self.assertGreater(left, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+"""
+Per event tracing, each slack event or button click gets a trace id and every stage it goes through is recorded as a
+timed span, written as one JSON line per span to a rotating file by a background thread
+"""
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import settings
+
+LOGGER = settings.get_logger("tracing")
+
+# (trace id, span id) of the span running in this thread or asyncio task, None when it isn't traced
+_CURRENT = contextvars.ContextVar("trace", default=None)
+
+_LOCK = threading.Lock()
+_PID = None
+_LISTENER = None
+_WRITER = logging.getLogger("slackbot.traces")
+_WRITER.propagate = False
+_WRITER.setLevel(logging.INFO)
+
+
+def _ensure_started():
+    """Starts the file writer thread on first use, and again in a forked child"""
+
+    global _PID, _LISTENER
+
+    if _PID == os.getpid():
+        return
+
+    with _LOCK:
+        if _PID == os.getpid():
+            return
+
+        file_handler = logging.handlers.RotatingFileHandler(settings.TRACING_FILE, maxBytes=settings.TRACING_MAX_BYTES,
+                                                            backupCount=settings.TRACING_BACKUP_COUNT)
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+
+        spans = queue.Queue(settings.TRACING_MAX_QUEUE)
+        _WRITER.handlers.clear()
+        _WRITER.addHandler(_DroppingQueueHandler(spans))
+
+        _LISTENER = logging.handlers.QueueListener(spans, file_handler)
+        _LISTENER.start()
+        _PID = os.getpid()
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Drops spans when the writer falls behind instead of slowing the turn down"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def current():
+    """Returns the (trace id, span id) running now, None when nothing is traced, pass it as parent to span()
+    to continue the trace on another thread"""
+
+    return _CURRENT.get()
+
+
+@contextmanager
+def trace(trace_id, name, **attributes):
+    """Starts a trace for an event or button click with a root span named name, trace_id is the slack
+    event_id or action id, a new one is made up when it is None"""
+
+    if not settings.TRACING or random.random() >= settings.TRACING_SAMPLE_RATE:
+        yield
+        return
+
+    _ensure_started()
+    token = _CURRENT.set((trace_id or uuid.uuid4().hex, None))
+    try:
+        with span(name, **attributes):
+            yield
+    finally:
+        _CURRENT.reset(token)
+
+
+@contextmanager
+def span(name, parent=None, **attributes):
+    """Records the block as a span of the current trace, or of parent from current(), does nothing untraced"""
+
+    context = parent or _CURRENT.get()
+    if context is None:
+        yield
+        return
+
+    _ensure_started()
+    trace_id, parent_id = context
+    span_id = uuid.uuid4().hex[:16]
+    token = _CURRENT.set((trace_id, span_id))
+    started = time.time()
+    started_counter = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as ex:
+        error = type(ex).__name__
+        raise
+    finally:
+        _CURRENT.reset(token)
+        record = {
+            "trace_id": trace_id,
+            "span_id": span_id,
+            "parent_id": parent_id,
+            "name": name,
+            "start": started,
+            "duration_ms": round((time.perf_counter() - started_counter) * 1000, 3),
+            "status": "error" if error else "ok"
+        }
+        if error:
+            record["error"] = error
+        if attributes:
+            record["attributes"] = attributes
+        _WRITER.info(json.dumps(record))
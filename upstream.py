@@ -0,0 +1,271 @@
+"""
+Guards the calls to slack, the TRIRIGA Assistant proxy, Watson and webhooks with per upstream timeouts, a circuit
+breaker and jittered retries, so a failing upstream gets a quick canned reply instead of stopping the bot
+"""
+
+import concurrent.futures
+import contextlib
+import contextvars
+import os
+import random
+import threading
+import time
+
+import requests
+
+import settings
+import capture
+import http_client
+
+LOGGER = settings.get_logger("upstream")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# time.monotonic() the current turn has to be done by, per thread and per asyncio task
+_DEADLINE = contextvars.ContextVar("deadline", default=None)
+
+
+class UpstreamUnavailableError(Exception):
+    """Raised when an upstream is failing, its breaker is open or the turn ran out of time"""
+
+
+class CircuitBreaker(object):
+    """Opens after failure_threshold failures in a row and rejects calls for reset_seconds, then lets one probe
+    through, closing again if it succeeds"""
+
+    def __init__(self, name, failure_threshold, reset_seconds):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._calls = 0
+        self._rejected = 0
+        self._failed = 0
+        self._opened = 0
+
+    def allow(self):
+        """Returns True if a call may go through now"""
+
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self._state = HALF_OPEN
+                self._probing = False
+
+            if self._state == CLOSED or (self._state == HALF_OPEN and not self._probing):
+                self._probing = self._state == HALF_OPEN
+                self._calls += 1
+                return True
+
+            self._rejected += 1
+            return False
+
+    def success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                LOGGER.info(self.name + " is answering again, closing its breaker")
+            self._state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def release(self):
+        """Reports a call whose answer says nothing about the upstream's health, ex: a 4xx, without resetting the
+        failures counted so far, a half open breaker lets another probe through"""
+
+        with self._lock:
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self._failed += 1
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    self._opened += 1
+                    LOGGER.error(self.name + " failed " + str(self._failures) + " times, opening its breaker for " +
+                                 str(self.reset_seconds) + "s")
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self._state,
+                "calls": self._calls,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "opened": self._opened
+            }
+
+
+BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+def get_breaker(name):
+    """Returns the breaker for an upstream, slack, proxy, watson or webhook"""
+
+    breaker = BREAKERS.get(name)
+    if breaker is None:
+        with _BREAKERS_LOCK:
+            breaker = BREAKERS.get(name)
+            if breaker is None:
+                breaker = BREAKERS[name] = CircuitBreaker(name, settings.UPSTREAM_BREAKER_FAILURES,
+                                                          settings.UPSTREAM_BREAKER_RESET_SECONDS)
+    return breaker
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """Upstream calls made inside the block give up once seconds have passed"""
+
+    token = _DEADLINE.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+
+def get_turn_deadline():
+    """Returns how long a turn may take, slack's 3 seconds unless the event was acknowledged first"""
+
+    return settings.UPSTREAM_TURN_DEADLINE if settings.ACK_FIRST else settings.UPSTREAM_SLACK_DEADLINE
+
+
+def remaining():
+    """Returns the seconds left before the current turn's deadline, None when there is none"""
+
+    turn_deadline = _DEADLINE.get()
+    return None if turn_deadline is None else turn_deadline - time.monotonic()
+
+
+def check(name):
+    """Raises UpstreamUnavailableError if the upstream's breaker is open or the turn is out of time,
+    otherwise returns the breaker to report the call's result to"""
+
+    left = remaining()
+    if left is not None and left <= 0:
+        raise UpstreamUnavailableError("Out of time before calling " + name)
+
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        raise UpstreamUnavailableError(name + " is unavailable, its breaker is open")
+    return breaker
+
+
+def get_timeout(name):
+    """Returns the (connect, read) timeout for an upstream, shortened to what is left of the turn"""
+
+    read_timeout = settings.UPSTREAM_TIMEOUTS.get(name, settings.HTTP_TIMEOUT)
+    left = remaining()
+    if left is not None:
+        read_timeout = max(0.1, min(read_timeout, left))
+    return min(settings.HTTP_CONNECT_TIMEOUT, read_timeout), read_timeout
+
+
+# Calls through clients whose timeout is fixed when they are made, ex: the Watson SDK, see call_blocking
+_BLOCKING = None
+_BLOCKING_PID = None
+_BLOCKING_LOCK = threading.Lock()
+
+
+def call_blocking(name, func, *args, **kwargs):
+    """Calls func through a client that can't be given a timeout per call, ex: the Watson SDK, waiting no longer than
+    what is left of the turn. Inside a turn it runs on a thread of its own so the turn can stop waiting, the call is
+    then left to finish within the client's own timeout. Raises UpstreamUnavailableError when the turn runs out of
+    time first"""
+
+    global _BLOCKING, _BLOCKING_PID
+
+    left = remaining()
+    if left is None:
+        return func(*args, **kwargs)
+
+    with _BLOCKING_LOCK:
+        # threads don't survive a fork, a worker starts its own
+        if _BLOCKING_PID != os.getpid():
+            _BLOCKING = concurrent.futures.ThreadPoolExecutor(settings.WORKER_POOL_SIZE, thread_name_prefix=name)
+            _BLOCKING_PID = os.getpid()
+
+    # keeps the turn's trace and deadline
+    future = _BLOCKING.submit(contextvars.copy_context().run, func, *args, **kwargs)
+    try:
+        return future.result(timeout=max(0.1, left))
+    except concurrent.futures.TimeoutError:
+        raise UpstreamUnavailableError("Out of time waiting for " + name) from None
+
+
+def request(name, method, url, retries=0, **kwargs):
+    """Sends a request to an upstream through its breaker, retrying up to retries times with jittered backoff
+    on connection errors and 5xx, only pass retries for calls that are safe to repeat. Raises
+    UpstreamUnavailableError when the last attempt fails too. A 4xx is returned without closing the breaker, the
+    caller reports a failure if it means the upstream is unusable"""
+
+    attempt = 0
+    while True:
+        breaker = check(name)
+        started = time.perf_counter()
+        try:
+            response = http_client.request(method, url, timeout=get_timeout(name), **kwargs)
+        except requests.exceptions.RequestException as ex:
+            response, wait = finish_attempt(name, breaker, started, attempt, retries, error=str(ex))
+        else:
+            response, wait = finish_attempt(name, breaker, started, attempt, retries, response=response,
+                                            data=kwargs.get("data"))
+        if response is not None:
+            return response
+
+        attempt += 1
+        time.sleep(wait)
+
+
+def finish_attempt(name, breaker, started, attempt, retries, response=None, error=None, data=None):
+    """Reports one attempt of a call, its response or the error it failed with, to the breaker and the capture.
+    Returns (response, None) when the response is the answer, (None, wait) when the call should be tried again
+    after waiting, raises UpstreamUnavailableError when it is out of retries. Shared by request and the asyncio
+    engine's awaited calls so both treat answers the same way"""
+
+    if response is None:
+        capture.call(name, time.perf_counter() - started)
+    else:
+        capture.call(name, time.perf_counter() - started, response.status_code, response.content, data)
+        if response.status_code < 400:
+            breaker.success()
+            return response, None
+        if response.status_code < 500:
+            # says nothing about the upstream's health
+            breaker.release()
+            return response, None
+        error = str(response.status_code) + " " + response.text[:200]
+
+    breaker.failure()
+    wait = get_retry_wait(name, attempt, retries)
+    if wait is None:
+        raise UpstreamUnavailableError(name + " failed: " + error)
+    return None, wait
+
+
+def get_retry_wait(name, attempt, retries):
+    """Returns the jittered wait before retrying a failed call, None when it is out of retries or of time"""
+
+    if attempt >= retries:
+        return None
+
+    wait = random.uniform(0, settings.UPSTREAM_RETRY_BACKOFF * (2 ** attempt))
+    left = remaining()
+    if left is not None and left <= wait:
+        return None
+
+    LOGGER.warning("Retrying call to " + name + ", attempt " + str(attempt + 1) + " of " + str(retries))
+    return wait
+
+
+def stats():
+    """Returns every breaker's state and counters"""
+    return {name: breaker.stats() for name, breaker in list(BREAKERS.items())}